@@ -0,0 +1,201 @@
+"""download_log で落としてきた episode を ConnectXGame で再生し、自分の手を深い Minimax で読み直して悪手を探す
+
+usage: python -m connectx.analyze_log.find_blunders <jsons_dir> <team_name> [--depth 8] [--workers 4]
+"""
+
+from __future__ import annotations
+
+from collections.abc import Iterator
+from pathlib import Path
+from typing import Any, Optional, Tuple
+import dataclasses
+import json
+import multiprocessing
+
+import click
+import numpy as np
+
+from connectx.gamesolver import gametree
+from connectx.tutorial import connectx_game, connectx_solver, incremental_scorer
+
+# (columns, rows, inarow, board, next_player, depth)
+Task = Tuple[int, int, int, Tuple[int, ...], int, int]
+
+
+@dataclasses.dataclass
+class Position:
+    episode_id: str
+    step: int
+    config: connectx_game.Config
+    state: connectx_game.ConnectXState  # 自分の石が 1 になるように正規化済み
+    played_col: int
+
+
+@dataclasses.dataclass
+class Blunder:
+    episode_id: str
+    step: int
+    board: str
+    played_col: int
+    best_col: int
+    played_score: float
+    best_score: float
+
+    @property
+    def drop(self) -> float:
+        return self.best_score - self.played_score
+
+
+def iter_positions(episode: dict[str, Any], episode_id: str, team_name: str) -> Iterator[Position]:
+    """episode を初期盤面から ConnectXGame.step で再生し、自分の手番の局面を列挙する"""
+    try:
+        agent_idx = episode["info"]["TeamNames"].index(team_name)
+    except ValueError:
+        return
+    c = episode["configuration"]
+    config = connectx_game.Config(columns=c["columns"], rows=c["rows"], inarow=c["inarow"])
+    game = connectx_game.ConnectXGame(config.columns, config.rows, config.inarow)
+    steps = episode["steps"]
+    my_mark = steps[0][agent_idx]["observation"]["mark"]
+
+    # 正規化後の盤面では mark=1 の agent が先手
+    first_player: connectx_game.Mark = 1 if my_mark == 1 else 2
+    grid = np.zeros((config.rows, config.columns), dtype=np.int64)
+    state = connectx_game.ConnectXState(grid, next_player=first_player, step=0)
+    for t in range(len(steps) - 1):
+        active = [i for i, agent in enumerate(steps[t]) if agent["status"] == "ACTIVE"]
+        if len(active) != 1:
+            break
+        col = steps[t + 1][active[0]]["action"]
+        logged_board = connectx_game.normalize_board(steps[t][0]["observation"]["board"], my_mark)
+        if state.grid.ravel().tolist() != logged_board:
+            raise RuntimeError(f"episode {episode_id}: replayed board does not match the log at step {t}")
+        if game.get_result(state) is not None:
+            break
+        actions = {action.col: action for action in game.get_available_actions(state)}
+        if col not in actions:  # invalid action (None や盤外の列を含む) で負けた。読み直す手がないので局面には含めない
+            if active[0] == agent_idx:
+                print(f"episode {episode_id}: invalid action {col!r} at step {t}")
+            break
+        if active[0] == agent_idx:
+            yield Position(episode_id=episode_id, step=t, config=config, state=state, played_col=col)
+        state = game.step(state, actions[col])
+
+
+def task_key(task: Task) -> str:
+    columns, rows, inarow, board, next_player, depth = task
+    return f"{columns}x{rows}x{inarow}|{depth}|{next_player}|{''.join(str(x) for x in board)}"
+
+
+def evaluate_position(task: Task) -> dict[int, float]:
+    """
+    局面を depth 手読みし、各列に打った場合のスコアを返す (worker process で実行される)。
+    root の手ごとに窓を開けて読み直すので、枝刈りしてもどの手のスコアも境界値ではなく真の値になる
+    """
+    columns, rows, inarow, board, next_player, depth = task
+    grid = np.asarray(board, dtype=np.int64).reshape(rows, columns)
+    state = connectx_game.ConnectXState(grid, next_player=1 if next_player == 1 else 2, step=0)
+    game = connectx_game.ConnectXGame(columns, rows, inarow)
+    tree = gametree.Tree[connectx_game.ConnectXState, connectx_game.ConnectXResult, connectx_game.ConnectXAction]()
+    minimax = connectx_solver.ConnectXMinimax(
+        game,
+        incremental_scorer.IncrementalScorer(columns, rows, inarow),
+        tree,
+        ordering=connectx_solver.killer_history_ordering(columns),
+        pruning=True,
+    )
+    scores = {}
+    for action in game.get_available_actions(state):
+        scores[action.col], _ = minimax.search(depth=depth, state=state, root_actions=[action])
+    return scores
+
+
+def to_task(position: Position, depth: int) -> Task:
+    c = position.config
+    board = tuple(int(x) for x in position.state.grid.ravel())
+    return (c.columns, c.rows, c.inarow, board, position.state.next_player, depth)
+
+
+def find_blunders(
+    positions: list[Position], depth: int, n_workers: int, cache: dict[str, dict[int, float]]
+) -> list[Blunder]:
+    """cache は episode をまたいで共有される (序盤の局面はほぼ毎回同じなので)"""
+    tasks = [to_task(position, depth) for position in positions]
+    todo: dict[str, Task] = {}
+    for task in tasks:
+        key = task_key(task)
+        if key not in cache:
+            todo[key] = task
+    print(f"{len(positions)} positions, {len(todo)} to evaluate ({len(positions) - len(todo)} cached or duplicated)")
+    with multiprocessing.Pool(n_workers) as pool:
+        for key, scores in zip(todo.keys(), pool.imap(evaluate_position, todo.values())):
+            cache[key] = scores
+
+    blunders = []
+    for position, task in zip(positions, tasks):
+        scores = cache[task_key(task)]
+        best_col = max(scores, key=lambda col: scores[col])
+        blunders.append(
+            Blunder(
+                episode_id=position.episode_id,
+                step=position.step,
+                board=str(position.state),
+                played_col=position.played_col,
+                best_col=best_col,
+                played_score=scores[position.played_col],
+                best_score=scores[best_col],
+            )
+        )
+    return blunders
+
+
+def load_cache(cache_file: Optional[Path]) -> dict[str, dict[int, float]]:
+    if cache_file is None or not cache_file.exists():
+        return {}
+    with open(cache_file) as f:
+        raw: dict[str, dict[str, float]] = json.load(f)
+    return {key: {int(col): score for col, score in scores.items()} for key, scores in raw.items()}
+
+
+@click.command()
+@click.argument("jsons_dir", type=click.Path(exists=True, file_okay=False, path_type=Path))
+@click.argument("team_name", type=click.STRING)
+# 判定される agent の読みより十分深くないと、読みの地平線の差が悪手として出てしまう
+@click.option("--depth", type=click.INT, default=8, show_default=True)
+@click.option("--workers", type=click.INT, default=multiprocessing.cpu_count(), show_default=True)
+@click.option("--threshold", type=click.FLOAT, default=100, show_default=True, help="score drop to report")
+@click.option("--cache-file", type=click.Path(dir_okay=False, path_type=Path), default=None)
+@click.option("--out", type=click.Path(dir_okay=False, path_type=Path), default=None)
+def main(
+    jsons_dir: Path,
+    team_name: str,
+    depth: int,
+    workers: int,
+    threshold: float,
+    cache_file: Optional[Path],
+    out: Optional[Path],
+) -> None:
+    positions: list[Position] = []
+    for path in sorted(jsons_dir.glob("*.json")):
+        with open(path) as f:
+            episode = json.load(f)
+        positions.extend(iter_positions(episode, episode_id=path.stem, team_name=team_name))
+
+    cache = load_cache(cache_file)
+    blunders = find_blunders(positions, depth=depth, n_workers=workers, cache=cache)
+    if cache_file is not None:
+        with open(cache_file, "w") as f:
+            json.dump(cache, f)
+
+    blunders = sorted((b for b in blunders if b.drop >= threshold), key=lambda b: b.drop, reverse=True)
+    for b in blunders:
+        print(f"episode {b.episode_id} step {b.step}: played col={b.played_col} ({b.played_score})", end=" ")
+        print(f"but col={b.best_col} ({b.best_score}) was better by {b.drop}")
+        print(b.board)
+    if out is not None:
+        with open(out, "w") as f:
+            json.dump([dict(dataclasses.asdict(b), drop=b.drop) for b in blunders], f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@ from __future__ import annotations
 
 import abc
 import enum
+from collections.abc import Sequence
 from typing import Generic, Optional, TypeVar
 
 
@@ -63,3 +64,44 @@ class Game(abc.ABC, Generic[S, R, A]):
     @abc.abstractmethod
     def step(self, state: S, action: A) -> S:
         pass
+
+    # 以下は複数の state をまとめて扱う batch API。既定の実装は 1 つずつ処理するだけなので、速くしたい Game は上書きする
+
+    def step_many(self, states: Sequence[S], actions: Sequence[A]) -> list[S]:
+        """states[i] に actions[i] を適用した state を返す"""
+        return [self.step(state, action) for state, action in zip(states, actions)]
+
+    def get_result_many(self, states: Sequence[S]) -> list[Optional[R]]:
+        return [self.get_result(state) for state in states]
+
+    def expand_all(self, state: S, actions: Optional[Sequence[A]] = None) -> list[tuple[A, S, Optional[R]]]:
+        """
+        state から actions (省略時は全ての合法手) を打った子の (action, state, result) をまとめて返す。
+        state は終局していない前提。
+        """
+        if actions is None:
+            actions = self.get_available_actions(state)
+        next_states = self.step_many([state] * len(actions), actions)
+        return list(zip(actions, next_states, self.get_result_many(next_states)))
+
+
+class InPlaceGame(Game[S, R, A]):
+    """
+    探索中の state 生成を省くための in-place API を持つ Game。
+    solver は Game がこのクラスのインスタンスなら play/undo で state を書き換えながら読み、そうでなければ step を使う
+    """
+
+    @abc.abstractmethod
+    def to_search_state(self, state: S) -> S:
+        """play/undo で in-place に書き換えてよい、state の複製を返す"""
+        pass
+
+    @abc.abstractmethod
+    def play(self, state: S, action: A) -> None:
+        """to_search_state で作った state に action を適用する"""
+        pass
+
+    @abc.abstractmethod
+    def undo(self, state: S) -> None:
+        """最後に play した action を取り消す"""
+        pass
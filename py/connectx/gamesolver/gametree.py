@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import abc
+import dataclasses
 import uuid
 from collections.abc import Mapping, Sequence
 from typing import Any, Callable, Generic, NewType, Optional, TypeVar
@@ -43,6 +44,7 @@ class Node(Generic[game.S, game.R, game.A]):
         self._parent_edge = parent_edge
         self._properties: dict[str, Any] = {}
         self._children: list[NodeId] = []
+        self._available_actions: Optional[list[game.A]] = None
 
     @property
     def id(self) -> NodeId:
@@ -75,16 +77,50 @@ class Node(Generic[game.S, game.R, game.A]):
     def children(self) -> Sequence[NodeId]:
         return self._children
 
+    def get_available_actions(self, game: game.Game[game.S, game.R, game.A]) -> list[game.A]:
+        """合法手を初回だけ game に問い合わせ、以降はキャッシュを返す。終局していれば空"""
+        if self._available_actions is None:
+            self._available_actions = [] if self._result is not None else game.get_available_actions(self._state)
+        return self._available_actions
+
     def add_child(self, node_id: NodeId) -> None:
         self._children.append(node_id)
 
 
 class Scorer(abc.ABC, Generic[game.S]):
+    # 勝ち負けが決まった局面に付ける PLAYER から見た score。読み切った結果 (tablebase など) を
+    # この scorer の値と同じ尺度で混ぜるときに使う。既定は [-1, 1] の値を返す scorer 用
+    win_score = 1.0
+    loss_score = -1.0
+
     @abc.abstractmethod
     def __call__(self, state: game.S) -> float:
         pass
 
 
+class BatchScorer(Scorer[game.S]):
+    """複数の局面をまとめて評価できる Scorer。探索側は葉を集めて score_batch に一度に渡す"""
+
+    @abc.abstractmethod
+    def score_batch(self, states: Sequence[game.S]) -> list[float]:
+        pass
+
+    def __call__(self, state: game.S) -> float:
+        return self.score_batch([state])[0]
+
+
+@dataclasses.dataclass
+class SearchStats:
+    """solver が直近の探索で数えた値。速度改善の前後で探索の中身が変わっていないかを比べるのに使う"""
+
+    n_nodes: int = 0  # 作った (訪れた) root 以外の node の数
+    n_leaf_evaluations: int = 0  # scorer や playout で評価した局面の数
+
+    def reset(self) -> None:
+        self.n_nodes = 0
+        self.n_leaf_evaluations = 0
+
+
 SC = TypeVar("SC", bound=Scorer)
 RF = Callable[[Node[game.S, game.R, game.A]], float]
 
@@ -96,9 +132,11 @@ class Tree(Generic[game.S, game.R, game.A]):
             raise RuntimeError
         return self._root_node_id
 
-    def __init__(self) -> None:
+    def __init__(self, rng: Optional[random.Random] = None) -> None:
+        """rng: 同点の子から rational な子を選ぶ乱数。省略すると random モジュールの (random.seed で固定できる) ものを使う"""
         self._nodes: dict[str, Node[game.S, game.R, game.A]] = {}
         self._root_node_id: Optional[NodeId] = None
+        self._rng = rng
 
     def add_root_node(self, state: game.S) -> NodeId:
         node = Node[game.S, game.R, game.A](state=state, result=None, parent_edge=None)
@@ -125,11 +163,27 @@ class Tree(Generic[game.S, game.R, game.A]):
         node = self._nodes[node_id]  # maybe raises KeyError
         node.set_property(key=key, value=value)
 
+    def get_node_available_actions(self, node_id: NodeId, game: game.Game[game.S, game.R, game.A]) -> list[game.A]:
+        """Raises KeyError if node does not exist."""
+        node = self._nodes[node_id]  # maybe raises KeyError
+        return node.get_available_actions(game)
+
     def get_node_state_result(self, node_id: NodeId) -> tuple[game.S, Optional[game.R]]:
         """Raises KeyError if node does not exist."""
         node = self._nodes[node_id]  # maybe raises KeyError
         return (node.state, node.result)
 
+    def get_children(self, node_id: NodeId) -> list[tuple[game.A, NodeId]]:
+        """Raises KeyError if node does not exist. すでに消えている子ノードは含めない"""
+        node = self._nodes[node_id]  # maybe raises KeyError
+        children = []
+        for child_node_id in node.children:
+            child_node = self._nodes.get(child_node_id)
+            if child_node is None or child_node.parent_edge is None:
+                continue
+            children.append((child_node.parent_edge.action, child_node_id))
+        return children
+
     def _get_children_with_rational(
         self, node: Node[game.S, game.R, game.A], get_rational_score: RF[game.S, game.R, game.A]
     ) -> tuple[list[Node[game.S, game.R, game.A]], int]:
@@ -146,7 +200,10 @@ class Tree(Generic[game.S, game.R, game.A]):
         aggregator = np.argmin if node.state.next_turn == game.Turn.OPPONENT else np.argmax
         if len(rational_scores) > 0:
             shuff = list(range(len(rational_scores)))
-            random.shuffle(shuff)
+            if self._rng is None:
+                random.shuffle(shuff)
+            else:
+                self._rng.shuffle(shuff)
             rational_idx = shuff[(aggregator([rational_scores[s] for s in shuff]))]
         else:
             rational_idx = -1  # dummy
@@ -1,20 +1,34 @@
 """https://horomary.hatenablog.com/entry/2021/06/21/000500#1-%E5%8E%9F%E5%A7%8B%E3%83%A2%E3%83%B3%E3%83%86%E3%82%AB%E3%83%AB%E3%83%AD%E6%9C%A8%E6%8E%A2%E7%B4%A2
-深さを固定し、そこからランダムプレイアウトするだけの単純な MCTS
+__call__: 深さを固定し、そこからランダムプレイアウトするだけの単純な MCTS
+search: UCT で木を伸ばしながら playout する anytime な MCTS。途中で打ち切れる
+max_nodes を指定すると、木の node 数がそれを超えないよう訪問回数の少ない葉を刈り込み、刈った node を再利用する
+evaluator を指定すると、ランダムプレイアウトの代わりに葉をその値で評価する。search では virtual loss を使って
+eval_batch_size 個の異なる葉を選んでから一度に評価し、__call__ では全ての葉を一度に評価する
+oracle (endgame tablebase など) を指定すると、勝敗が分かる局面は展開時に確定させ、playout もそこで打ち切る
+action_filter を指定すると、展開時にそれが残した手の子だけを作る (大きな盤面で木の幅を抑える用)
 """
 
 from __future__ import annotations
 
-from typing import Generic, Optional, Sequence, Any, Mapping
+from typing import Callable, Generic, Optional, Sequence, Any, Mapping, TypeVar
+import dataclasses
+import math
 import random
+import sys
+import threading
+import time
 
 import numpy as np
 
 from connectx.gamesolver import game, gametree
 
 
+T = TypeVar("T")
+
+
 class MCTSEdge(gametree.Edge[game.A]):
     def __init__(self, action: game.A) -> None:
-        self._action = action
+        super().__init__(action)
 
         self.is_rational = False
 
@@ -35,22 +49,44 @@ class MCTSEdge(gametree.Edge[game.A]):
         return {}
 
 
-class MCTSNode(gametree.Node[game.S, game.A]):
+class MCTSNode(gametree.Node[game.S, game.R, game.A]):
     def __init__(
         self,
         state: game.S,
-        is_terminal: bool,
-        parent_edge: Optional[MCTSEdge],
-        parent_node: Optional["MCTSNode[game.S, game.A]"],
+        result: Optional[game.R],
+        parent_edge: Optional[MCTSEdge[game.A]],
+        parent_node: Optional["MCTSNode[game.S, game.R, game.A]"],
+    ) -> None:
+        super().__init__(state=state, result=result, parent_edge=parent_edge)
+        self._parent_edge: Optional[MCTSEdge[game.A]] = parent_edge
+        self._parent_node = parent_node
+        self._children: Sequence["MCTSNode[game.S, game.R, game.A]"] = []  # type: ignore
+        self.proven: Optional[float] = None
+        self.reset(state=state, result=result, parent_edge=parent_edge, parent_node=parent_node)
+
+    def reset(
+        self,
+        state: game.S,
+        result: Optional[game.R],
+        parent_edge: Optional[MCTSEdge[game.A]],
+        parent_node: Optional["MCTSNode[game.S, game.R, game.A]"],
     ) -> None:
+        """
+        作ったばかりの node と同じ状態に戻し、別の局面の node として使い直す (NodePool が刈り込んだ node を再利用する用)。
+        id はそのまま使う (刈り込まれた node はもう木にないので重複しない)
+        """
         self._state = state
-        self._is_terminal = is_terminal
+        self._result = result
         self._parent_edge = parent_edge
         self._parent_node = parent_node
-
-        self._children: Sequence["MCTSNode[game.S, game.A]"] = []
+        self._available_actions = None
+        self._children = []
         self.is_rational = False
         self._win_rate = (0.0, 0)  # (n_player_win, n_play)
+        # 勝敗が確定していれば PLAYER から見た score (1.0: 勝ち, 0.5: 引き分け, 0.0: 負け)
+        self.proven = None if result is None else result_to_score(result)
+        # action_filter で子を作らなかった合法手があるか。あれば全ての子が確定しても node の結果は確定しない
+        self.pruned = False
 
     @property
     def state(self) -> game.S:
@@ -58,7 +94,7 @@ class MCTSNode(gametree.Node[game.S, game.A]):
 
     @property
     def is_terminal(self) -> bool:
-        return self._is_terminal
+        return self._result is not None
 
     @property
     def is_rational(self) -> bool:
@@ -69,30 +105,43 @@ class MCTSNode(gametree.Node[game.S, game.A]):
         self._is_rational = is_rational
 
     @property
-    def properties(self) -> Mapping[str, Any]:
+    def properties(self) -> Mapping[str, Any]:  # type: ignore
         return {
             "score": self.score,
             "winRate": f"{self.win_rate[0]}/{self.win_rate[1]}",
+            "proven": self.proven,
         }
 
     @property
     def parent_edge(self) -> Optional[MCTSEdge[game.A]]:
         return self._parent_edge
 
-    @property
-    def children(self) -> Sequence["MCTSNode[game.S, game.A]"]:
+    @property  # type: ignore
+    def children(self) -> Sequence["MCTSNode[game.S, game.R, game.A]"]:
         return self._children
 
     @children.setter
-    def children(self, children: Sequence["MCTSNode[game.S, game.A]"]) -> None:
+    def children(self, children: Sequence["MCTSNode[game.S, game.R, game.A]"]) -> None:
         self._children = children
 
     # custom functions
 
     @property
-    def parent_node(self) -> Optional["MCTSNode[game.S, game.A]"]:
+    def parent_node(self) -> Optional["MCTSNode[game.S, game.R, game.A]"]:
         return self._parent_node
 
+    def detach(self) -> None:
+        """親から切り離して、この node を root とする木として使えるようにする"""
+        self._parent_node = None
+
+    def collapse(self) -> list["MCTSNode[game.S, game.R, game.A]"]:
+        """子を切り離して未展開の葉に戻し、切り離した子を返す。訪問回数と確定した結果はそのまま残す"""
+        children = list(self._children)
+        self._children = []
+        for child in children:
+            child.detach()
+        return children
+
     @property
     def win_rate(self) -> tuple[float, int]:
         return self._win_rate
@@ -100,83 +149,565 @@ class MCTSNode(gametree.Node[game.S, game.A]):
     def update_win_rate(self, score: float) -> None:
         self._win_rate = (self._win_rate[0] + score, self._win_rate[1] + 1)
 
+    def revert_win_rate(self, score: float) -> None:
+        """update_win_rate(score) を取り消す (virtual loss を外す用)"""
+        self._win_rate = (self._win_rate[0] - score, self._win_rate[1] - 1)
+
+    @property
+    def n_visits(self) -> int:
+        return self._win_rate[1]
+
     @property
     def score(self) -> float:
+        if self._win_rate[1] == 0:
+            return 0.5
         return self._win_rate[0] / self._win_rate[1]
 
 
-class MCTS(Generic[game.S, game.A]):
-    def __init__(self, game: game.Game[game.S, game.A]) -> None:
-        self._game = game
+@dataclasses.dataclass
+class Progress(Generic[game.A]):
+    action: game.A  # 現時点の最善手 (root の子のうち最も訪問回数が多いもの)
+    confidence: float  # root の子の訪問回数の合計に占める最善手の割合
+    win_rate: float  # 最善手の PLAYER から見た勝率
+    n_playouts: int
+    elapsed: float
+    decided: bool  # 最善手が確定した (これ以上探索しても変わらない)
+
+
+@dataclasses.dataclass
+class MemoryUsage:
+    n_nodes: int  # 木に繋がっている node の数
+    n_free: int  # 刈り込まれて再利用を待っている node の数
+    capacity: Optional[int]  # None: 上限なし
+    n_pruned: int  # これまでに刈り込んだ node の数
+    bytes_per_node: int  # state を含めた node 1 つあたりの大きさの見積もり
+
+    @property
+    def n_bytes(self) -> int:
+        return (self.n_nodes + self.n_free) * self.bytes_per_node
+
+
+def _estimate_size(obj: Any) -> int:
+    """obj とその属性 (1 段だけ) の大きさの合計。numpy 配列はデータ部分も含めて数える"""
+    size = sys.getsizeof(obj)
+    attributes = getattr(obj, "__dict__", None)
+    if attributes is not None:
+        size += sys.getsizeof(attributes) + sum(sys.getsizeof(value) for value in attributes.values())
+    return size
+
+
+class NodePool(Generic[game.S, game.R, game.A]):
+    """
+    MCTSNode の払い出しと回収を行う。capacity を超えそうになったら、子が全て葉である node のうち
+    訪問回数の少ないものから子を刈り込み (未展開の葉に戻し)、刈った node を次の払い出しで再利用する。
+    刈り込みのたびに木を走査するので、1 回で capacity の free_fraction 分はまとめて空ける。
+    """
+
+    def __init__(self, capacity: Optional[int] = None, free_fraction: float = 0.1) -> None:
+        self._capacity = capacity
+        self._free_fraction = free_fraction
+        self._free: list[MCTSNode[game.S, game.R, game.A]] = []
+        self._n_live = 0
+        self._n_pruned = 0
+        self._bytes_per_node = 0
+
+    @property
+    def capacity(self) -> Optional[int]:
+        return self._capacity
+
+    def reset(self, root: MCTSNode[game.S, game.R, game.A]) -> None:
+        """root 以下の木を数え直す。以前の探索の木のうち root 以下に無いものは捨てられたものとみなす"""
+        n_nodes = 0
+        stack = [root]
+        while len(stack) > 0:
+            node = stack.pop()
+            n_nodes += 1
+            stack.extend(node.children)
+        self._n_live = n_nodes
+        self._measure(root)
+
+    def has_room(self, n: int) -> bool:
+        return self._capacity is None or self._n_live + n <= self._capacity
+
+    def acquire(
+        self,
+        state: game.S,
+        result: Optional[game.R],
+        parent_edge: Optional[MCTSEdge[game.A]],
+        parent_node: Optional[MCTSNode[game.S, game.R, game.A]],
+    ) -> MCTSNode[game.S, game.R, game.A]:
+        self._n_live += 1
+        if len(self._free) == 0:
+            return MCTSNode[game.S, game.R, game.A](
+                state=state, result=result, parent_edge=parent_edge, parent_node=parent_node
+            )
+        node = self._free.pop()
+        node.reset(state=state, result=result, parent_edge=parent_edge, parent_node=parent_node)
+        return node
+
+    def make_room(
+        self, root: MCTSNode[game.S, game.R, game.A], keep: MCTSNode[game.S, game.R, game.A], n: int
+    ) -> bool:
+        """
+        n 個の node を払い出せるよう、root 以下の木を刈り込む。keep とその祖先は刈り込まない。
+        空けられなかったら False
+        """
+        if self.has_room(n):
+            return True
+        assert self._capacity is not None
+        protected = set()
+        current_node: Optional[MCTSNode[game.S, game.R, game.A]] = keep
+        while current_node is not None:
+            protected.add(id(current_node))
+            current_node = current_node.parent_node
+        n_target = max(n, int(self._capacity * self._free_fraction))
+        n_freed = 0
+        while n_freed < n_target:
+            candidates = self._collapsible(root, protected)
+            if len(candidates) == 0:
+                break
+            candidates.sort(key=lambda node: node.n_visits)
+            for node in candidates:
+                released = node.collapse()
+                self._free.extend(released)
+                n_freed += len(released)
+                if n_freed >= n_target:
+                    break
+        self._n_live -= n_freed
+        self._n_pruned += n_freed
+        return self.has_room(n)
+
+    def memory_usage(self) -> MemoryUsage:
+        return MemoryUsage(
+            n_nodes=self._n_live,
+            n_free=len(self._free),
+            capacity=self._capacity,
+            n_pruned=self._n_pruned,
+            bytes_per_node=self._bytes_per_node,
+        )
 
-    def __call__(self, depth: int, state: game.S) -> MCTSNode[game.S, game.A]:
+    def _collapsible(
+        self, root: MCTSNode[game.S, game.R, game.A], protected: set[int]
+    ) -> list[MCTSNode[game.S, game.R, game.A]]:
+        """子を持ち、その子が全て葉である node を集める"""
+        candidates = []
+        stack = [root]
+        while len(stack) > 0:
+            node = stack.pop()
+            if len(node.children) == 0:
+                continue
+            if id(node) not in protected and all(len(child.children) == 0 for child in node.children):
+                candidates.append(node)
+            else:
+                stack.extend(node.children)
+        return candidates
+
+    def _measure(self, node: MCTSNode[game.S, game.R, game.A]) -> None:
+        if self._bytes_per_node == 0:
+            self._bytes_per_node = _estimate_size(node) + _estimate_size(node.state)
+
+
+def result_to_score(result: game.R) -> float:
+    """PLAYER から見た勝率に換算する"""
+    if result.winner == game.Turn.PLAYER:
+        return 1.0
+    elif result.winner is None:
+        return 0.5
+    else:
+        return 0.0
+
+
+def win_score(turn: game.Turn) -> float:
+    """turn 側が勝ったときの、PLAYER から見た score"""
+    return 1.0 if turn == game.Turn.PLAYER else 0.0
+
+
+class MCTS(Generic[game.S, game.R, game.A]):
+    _root: Optional[MCTSNode[game.S, game.R, game.A]]
+    _pool: NodePool[game.S, game.R, game.A]
+    _evaluator: Optional[gametree.BatchScorer[game.S]]
+    _oracle: Optional[Callable[[game.S], Optional[float]]]
+    _action_filter: Optional[Callable[[game.S, Sequence[game.A]], list[game.A]]]
+
+    def __init__(
+        self,
+        game: game.Game[game.S, game.R, game.A],
+        n_playouts: int = 30,
+        exploration: float = math.sqrt(2),
+        max_nodes: Optional[int] = None,
+        evaluator: Optional[gametree.BatchScorer[game.S]] = None,
+        eval_batch_size: int = 16,
+        oracle: Optional[Callable[[game.S], Optional[float]]] = None,
+        action_filter: Optional[Callable[[game.S, Sequence[game.A]], list[game.A]]] = None,
+        rng: Optional[random.Random] = None,
+    ) -> None:
+        """
+        max_nodes: search で木に保持する node 数の上限。None なら上限なし
+        evaluator: PLAYER から見て [-1, 1] (1: 勝ち, -1: 負け) の値を返す scorer。
+            指定すると、葉をランダムプレイアウトの代わりにこの値で評価する
+        eval_batch_size: search で evaluator の score_batch に一度に渡す葉の数の上限
+        oracle: 終局していない局面の勝敗が分かれば PLAYER から見た score (1.0/0.5/0.0)、分からなければ None を返す関数
+        action_filter: (state, 合法手) を受け取り、子を作る手を返す関数。少なくとも 1 手は残すこと
+        rng: 展開・選択・playout で使う乱数。省略すると random モジュールの (random.seed で固定できる) ものを使う。
+            time_limit を使わずに種を固定した rng を渡せば、探索は毎回同じになる
+        """
+        self._game = game
+        self._n_playouts = n_playouts
+        self._exploration = exploration
+        self._pool = NodePool(max_nodes)
+        if eval_batch_size <= 0:
+            raise ValueError("eval_batch_size must be positive")
+        self._evaluator = evaluator
+        self._eval_batch_size = eval_batch_size
+        self._oracle = oracle
+        self._action_filter = action_filter
+        self._rng = rng
+        self.stats = gametree.SearchStats()
+        self._root = None
+        self._n_searched = 0
+        self._search_start = 0.0
+
+    def __call__(self, depth: int, state: game.S) -> MCTSNode[game.S, game.R, game.A]:
+        """
+        depth 手先までの全ての局面を展開し、その葉から n_playouts 回ずつ playout する。
+        depth 手先までの node 数が max_nodes を超えるときは RuntimeError (深さの足りない木を返さないように)
+        """
         if depth == 0:
             raise RuntimeError
-        is_terminal, _ = self._game.get_terminal_score(state)
-        if is_terminal:
+        if self._game.get_result(state) is not None:
             raise RuntimeError
 
-        root_node = MCTSNode[game.S, game.A](
-            state=state, is_terminal=is_terminal, parent_edge=None, parent_node=None
-        )
+        root_node = MCTSNode[game.S, game.R, game.A](state=state, result=None, parent_edge=None, parent_node=None)
+        self._pool.reset(root_node)
+        self.stats.reset()
         playout_nodes = self._expand_tree(root_node, depth)
 
-        for node in playout_nodes:
-            for _ in range(30):
-                score = self._playout(node)
+        if self._evaluator is not None:
+            # 葉は全て決まっているので、終局していない葉をまとめて一度に評価する
+            ongoing = [node for node in playout_nodes if not node.is_terminal]
+            for node, score in zip(ongoing, self._evaluate(ongoing, self._evaluator)):
                 self._backprop(node, score)
+            for node in playout_nodes:
+                if node.is_terminal:
+                    self._backprop(node, self._playout(node))
+        else:
+            for node in playout_nodes:
+                for _ in range(self._n_playouts):
+                    score = self._playout(node)
+                    self._backprop(node, score)
 
         self._mark_rational(root_node)
 
         return root_node
 
-    def _expand_tree(self, node: MCTSNode[game.S, game.A], depth: int) -> list[MCTSNode[game.S, game.A]]:
+    def search(
+        self,
+        state: game.S,
+        max_playouts: int,
+        time_limit: Optional[float] = None,
+        on_progress: Optional[Callable[[Progress[game.A]], None]] = None,
+        report_interval: int = 100,
+        root: Optional[MCTSNode[game.S, game.R, game.A]] = None,
+        stop_event: Optional[threading.Event] = None,
+        root_actions: Optional[Sequence[game.A]] = None,
+    ) -> MCTSNode[game.S, game.R, game.A]:
+        """
+        UCT で playout を max_playouts 回 (または time_limit 秒) まで繰り返す。
+        root の最善手の訪問回数のリードが残りの予算で覆らなくなったとき、または最善手が確定したときは早めに打ち切る。
+        探索中は report_interval 回ごとに on_progress が呼ばれる。別スレッドからは current_progress で途中経過を取れる。
+        root に以前の探索の node (state と同じ局面) を渡すと、その部分木を引き継いで探索を続ける。
+        stop_event がセットされると、次の playout の前に打ち切る。
+        max_nodes に達したら訪問回数の少ない葉を刈り込む。刈り込めなければその葉を展開せずに playout する。
+        root の子だけは上限に関わらず展開する。
+        root_actions を渡すと、root ではその手だけを読む (引き継いだ木の root の他の子は捨てる)。
+        """
+        if self._game.get_result(state) is not None:
+            raise RuntimeError("Game is already over.")
+        if root is None:
+            root_node = MCTSNode[game.S, game.R, game.A](state=state, result=None, parent_edge=None, parent_node=None)
+        else:
+            root_node = root
+            root_node.detach()
+        self._root = root_node
+        self._n_searched = 0
+        self._search_start = time.perf_counter()
+        if root_actions is not None and len(root_node.children) > 0:
+            self._restrict_children(root_node, root_actions)
+        self._pool.reset(root_node)
+        self.stats.reset()
+        if len(root_node.children) == 0:
+            self._expand_node(root_node, force=True, actions=root_actions)
+        self._propagate_proof(root_node)
+
+        while self._n_searched < max_playouts and root_node.proven is None:
+            elapsed = time.perf_counter() - self._search_start
+            if time_limit is not None and elapsed >= time_limit:
+                break
+            if stop_event is not None and stop_event.is_set():
+                break
+            n_previous = self._n_searched
+            if self._evaluator is None:
+                node = self._descend(root_node)
+                # 勝敗が確定している node は playout せず、確定した score をそのまま伝播する
+                score = self._playout(node) if node.proven is None else node.proven
+                self._backprop(node, score)
+                self._n_searched += 1
+            else:
+                n_batch = min(self._eval_batch_size, max_playouts - self._n_searched)
+                self._n_searched += self._search_batch(root_node, n_batch, self._evaluator)
+
+            if on_progress is not None and self._n_searched // report_interval > n_previous // report_interval:
+                progress = self.current_progress()
+                if progress is not None:
+                    on_progress(progress)
+            remaining = max_playouts - self._n_searched
+            if time_limit is not None and elapsed > 0:
+                remaining = min(remaining, int(self._n_searched / elapsed * (time_limit - elapsed)))
+            if self._is_decided(root_node) or self._lead_is_safe(root_node, remaining):
+                break
+
+        self._mark_rational(root_node)
+        return root_node
+
+    def memory_usage(self) -> MemoryUsage:
+        """直近の search (または __call__) の木が使っている node の数と大きさの見積もり"""
+        return self._pool.memory_usage()
+
+    def current_progress(self) -> Optional[Progress[game.A]]:
+        """直近の search の途中経過 (または結果)。探索中に別スレッドから呼んでもよい"""
+        root_node = self._root
+        if root_node is None or len(root_node.children) == 0:
+            return None
+        children = list(root_node.children)
+        best = self._best_child(root_node)
+        if best.parent_edge is None:
+            return None
+        total = sum(child.n_visits for child in children)
+        return Progress(
+            action=best.parent_edge.action,
+            confidence=0.0 if total == 0 else best.n_visits / total,
+            win_rate=best.score,
+            n_playouts=self._n_searched,
+            elapsed=time.perf_counter() - self._search_start,
+            decided=self._is_decided(root_node),
+        )
+
+    def _best_child(self, node: MCTSNode[game.S, game.R, game.A]) -> MCTSNode[game.S, game.R, game.A]:
+        """勝ちが確定した手があればそれを、なければ負けが確定していない手のうち最も訪問回数が多い手を選ぶ"""
+        win = win_score(node.state.next_turn)
+        for child in node.children:
+            if child.proven == win:
+                return child
+        if node.proven is not None:  # 全ての手の結果が確定している
+            return max(node.children, key=lambda child: -abs(win - (child.proven or 0.0)))
+        candidates = [child for child in node.children if child.proven != 1.0 - win]
+        return max(candidates, key=lambda child: child.n_visits)
+
+    def _is_decided(self, node: MCTSNode[game.S, game.R, game.A]) -> bool:
+        return node.proven is not None
+
+    def _propagate_proof(self, node: MCTSNode[game.S, game.R, game.A]) -> None:
+        """
+        手番側が勝ちの確定した子を持つか、全ての子 (action_filter で刈った手がないこと) の結果が確定していれば、
+        node の結果も確定する。
+        確定したら親についても同じことを繰り返す。
+        """
+        current_node: Optional[MCTSNode[game.S, game.R, game.A]] = node
+        while current_node is not None and current_node.proven is None and len(current_node.children) > 0:
+            win = win_score(current_node.state.next_turn)
+            proven = [child.proven for child in current_node.children]
+            if win in proven:
+                current_node.proven = win
+            elif all(p is not None for p in proven) and not current_node.pruned:
+                current_node.proven = min((p for p in proven if p is not None), key=lambda p: abs(win - p))
+            else:
+                return
+            current_node = current_node.parent_node
+
+    def _lead_is_safe(self, node: MCTSNode[game.S, game.R, game.A], remaining: int) -> bool:
+        """残り remaining 回の playout を全て 2 番手に回しても、最多訪問の子が入れ替わらない"""
+        visits = sorted((child.n_visits for child in node.children), reverse=True)
+        if len(visits) < 2:
+            return True
+        return visits[0] - visits[1] > remaining
+
+    def _descend(self, root_node: MCTSNode[game.S, game.R, game.A]) -> MCTSNode[game.S, game.R, game.A]:
+        """葉まで降り、訪問済みの葉なら展開して、結果の確定していない子を 1 つ選ぶ。評価 (playout) する node を返す"""
+        node = self._select(root_node)
+        if node.proven is None and node.n_visits > 0:
+            self._pool.make_room(root_node, keep=node, n=len(node.get_available_actions(self._game)))
+            self._expand_node(node)
+            self._propagate_proof(node)
+            candidates = [child for child in node.children if child.proven is None]
+            if node.proven is None and len(candidates) > 0:
+                node = self._choice(candidates)
+        return node
+
+    def _search_batch(
+        self, root_node: MCTSNode[game.S, game.R, game.A], n: int, evaluator: gametree.BatchScorer[game.S]
+    ) -> int:
+        """
+        最大 n 個の葉を選び、まとめて evaluator で評価して伝播する。選んだ葉の数を返す。
+        評価を待つ葉には virtual loss を掛けておき、続けて同じ葉が選ばれないようにする。
+        勝敗が確定した葉はその場で伝播し、展開できずに同じ葉に戻ってきたらそこまでで評価する
+        """
+        leaves: list[MCTSNode[game.S, game.R, game.A]] = []
+        n_selected = 0
+        while n_selected < n and root_node.proven is None:
+            node = self._descend(root_node)
+            if node.proven is not None:
+                self._backprop(node, node.proven)
+            elif any(node is leaf for leaf in leaves):
+                break
+            else:
+                self._apply_virtual_loss(node, revert=False)
+                leaves.append(node)
+            n_selected += 1
+        for leaf in leaves:
+            self._apply_virtual_loss(leaf, revert=True)
+        for leaf, score in zip(leaves, self._evaluate(leaves, evaluator)):
+            self._backprop(leaf, score)
+        return n_selected
+
+    def _apply_virtual_loss(self, node: MCTSNode[game.S, game.R, game.A], revert: bool) -> None:
+        """node から root までの各 node に、その node を選んだ (親の) 手番側の負けを 1 回分足す (revert なら取り除く)"""
+        current_node: Optional[MCTSNode[game.S, game.R, game.A]] = node
+        while current_node is not None:
+            parent_node = current_node.parent_node
+            loss = 0.5 if parent_node is None else 1.0 - win_score(parent_node.state.next_turn)
+            if revert:
+                current_node.revert_win_rate(loss)
+            else:
+                current_node.update_win_rate(loss)
+            current_node = parent_node
+
+    def _select(self, node: MCTSNode[game.S, game.R, game.A]) -> MCTSNode[game.S, game.R, game.A]:
+        """UCB1 で葉まで降りる。手番側から見た勝率を最大化する"""
+        while len(node.children) > 0:
+            # 結果が確定した子は読まない
+            candidates = [child for child in node.children if child.proven is None]
+            if len(candidates) == 0:
+                return node
+            unvisited = [child for child in candidates if child.n_visits == 0]
+            if len(unvisited) > 0:
+                return self._choice(unvisited)
+            log_n = math.log(node.n_visits)
+            maximize = node.state.next_turn != game.Turn.OPPONENT
+
+            def ucb(child: MCTSNode[game.S, game.R, game.A]) -> float:
+                exploit = child.score if maximize else 1.0 - child.score
+                return exploit + self._exploration * math.sqrt(log_n / child.n_visits)
+
+            node = max(candidates, key=ucb)
+        return node
+
+    def _expand_tree(
+        self, node: MCTSNode[game.S, game.R, game.A], depth: int
+    ) -> list[MCTSNode[game.S, game.R, game.A]]:
         prev_level_nodes = [node]
         for _ in range(depth):
-            current_level_nodes: list[MCTSNode[game.S, game.A]] = []
+            current_level_nodes: list[MCTSNode[game.S, game.R, game.A]] = []
             for node in prev_level_nodes:
-                current_level_nodes.extend(self._expand_node(node))
+                next_nodes = self._expand_node(node)
+                if not node.is_terminal and len(node.children) == 0:
+                    memory = self._pool.memory_usage()
+                    raise RuntimeError(
+                        f"expanding {depth} plies needs more than max_nodes={memory.capacity} nodes "
+                        f"({memory.n_nodes} already in the tree)"
+                    )
+                current_level_nodes.extend(next_nodes)
             prev_level_nodes = current_level_nodes
         return current_level_nodes
 
-    def _expand_node(self, node: MCTSNode[game.S, game.A]) -> list[MCTSNode[game.S, game.A]]:
-        if node.is_terminal:
-            return [node]
-        available_actions = self._game.get_available_actions(node.state)
-        next_states = [
-            (self._game.step(node.state, action), MCTSEdge[game.A](action)) for action in available_actions
+    def _restrict_children(self, node: MCTSNode[game.S, game.R, game.A], actions: Sequence[game.A]) -> None:
+        kept = [
+            child for child in node.children if child.parent_edge is not None and child.parent_edge.action in actions
         ]
-        next_is_terminals = [self._game.get_terminal_score(state[0])[0] for state in next_states]
+        if len(kept) < len(node.children):
+            node.children = kept
+            node.pruned = True
+            node.proven = None  # 捨てた子で確定していたかもしれないので、残った子から確定し直す
 
+    def _expand_node(
+        self,
+        node: MCTSNode[game.S, game.R, game.A],
+        force: bool = False,
+        actions: Optional[Sequence[game.A]] = None,
+    ) -> list[MCTSNode[game.S, game.R, game.A]]:
+        """
+        node の子を作る。node 数の上限に掛かる (force でない) ときは展開せず、node 自身を葉として返す。
+        actions を渡すと、合法手のうちその手の子だけを作る (action_filter は使わない)
+        """
+        if node.is_terminal:
+            return [node]
+        available_actions = node.get_available_actions(self._game)
+        if actions is not None:
+            kept_actions = [action for action in available_actions if action in actions]
+            node.pruned = len(kept_actions) < len(available_actions)
+            available_actions = kept_actions
+        elif self._action_filter is not None:
+            kept_actions = self._action_filter(node.state, available_actions)
+            node.pruned = len(kept_actions) < len(available_actions)
+            available_actions = kept_actions
+        if not force and not self._pool.has_room(len(available_actions)):
+            return [node]
         next_nodes = [
-            MCTSNode[game.S, game.A](state=state, is_terminal=is_terminal, parent_edge=edge, parent_node=node)
-            for (state, edge), is_terminal in zip(next_states, next_is_terminals)
+            self._pool.acquire(state=state, result=result, parent_edge=MCTSEdge[game.A](action), parent_node=node)
+            for action, state, result in self._game.expand_all(node.state, available_actions)
         ]
         node.children = next_nodes
+        self.stats.n_nodes += len(next_nodes)
+        if self._oracle is not None:
+            for next_node in next_nodes:
+                if not next_node.is_terminal:
+                    next_node.proven = self._oracle(next_node.state)
         return next_nodes
 
-    def _playout(self, node: MCTSNode[game.S, game.A]) -> float:
-        state = node.state
-        while True:
-            is_terminal, score = self._game.get_terminal_score(state)
-            if is_terminal:
-                if score > 0:
-                    return 1.0
-                elif score == 0:
-                    return 0.5
-                else:
-                    return 0.0
+    def _evaluate(
+        self, nodes: Sequence[MCTSNode[game.S, game.R, game.A]], evaluator: gametree.BatchScorer[game.S]
+    ) -> list[float]:
+        """終局していない node をまとめて評価し、[-1, 1] の値を PLAYER から見た勝率 [0, 1] に直して返す"""
+        if len(nodes) == 0:
+            return []
+        self.stats.n_leaf_evaluations += len(nodes)
+        values = evaluator.score_batch([node.state for node in nodes])
+        return [min(max((value + 1.0) / 2.0, 0.0), 1.0) for value in values]
+
+    def _playout(self, node: MCTSNode[game.S, game.R, game.A]) -> float:
+        result = node.result
+        if result is not None:
+            return result_to_score(result)
+        self.stats.n_leaf_evaluations += 1
+        # in-place API があれば playout ごとに一度だけ state を複製し、以降は書き換えながら進める
+        in_place = self._game if isinstance(self._game, game.InPlaceGame) else None
+        state = node.state if in_place is None else in_place.to_search_state(node.state)
+        while result is None:
+            if self._oracle is not None:
+                proven = self._oracle(state)
+                if proven is not None:
+                    return proven
             available_actions = self._game.get_available_actions(state)
-            action = random.choice(available_actions)
-            state = self._game.step(state, action)
-
-    def _backprop(self, node: MCTSNode[game.S, game.A], score: float) -> None:
-        current_node: Optional[MCTSNode[game.S, game.A]] = node
+            action = self._choice(available_actions)
+            if in_place is None:
+                state = self._game.step(state, action)
+            else:
+                in_place.play(state, action)
+            result = self._game.get_result(state)
+        return result_to_score(result)
+
+    def _choice(self, candidates: Sequence[T]) -> T:
+        """rng がなければ random モジュールの関数を使う (random.seed で固定できるように)"""
+        if self._rng is None:
+            return random.choice(candidates)
+        return self._rng.choice(candidates)
+
+    def _backprop(self, node: MCTSNode[game.S, game.R, game.A], score: float) -> None:
+        current_node: Optional[MCTSNode[game.S, game.R, game.A]] = node
         while current_node is not None:
             current_node.update_win_rate(score)
             current_node = current_node.parent_node
 
-    def _mark_rational(self, node: MCTSNode[game.S, game.A]) -> None:
+    def _mark_rational(self, node: MCTSNode[game.S, game.R, game.A]) -> None:
         node.is_rational = True
         if node.parent_edge is not None:
             node.parent_edge.is_rational = True
@@ -188,3 +719,27 @@ class MCTS(Generic[game.S, game.A]):
         aggregator = np.argmin if node.state.next_turn == game.Turn.OPPONENT else np.argmax
         rational_node = node.children[int(aggregator(next_scores))]
         self._mark_rational(rational_node)
+
+
+def to_dict(node: MCTSNode[game.S, game.R, game.A]) -> dict[str, Any]:
+    """gametree.Tree.to_dict と同じ形式 (gametree-viz で読める) に変換する。_mark_rational 済みの前提"""
+    edge = node.parent_edge
+    return {
+        "id": node.id,
+        "repr": str(node.state),
+        "isTerminal": node.is_terminal,
+        "isRational": node.is_rational,
+        "properties": node.properties,
+        "parentEdge": (
+            None
+            if edge is None
+            else {
+                "id": edge.id,
+                "repr": str(edge.action),
+                "turn": edge.action.turn.name.lower(),
+                "isRational": edge.is_rational,
+                "properties": edge.properties,
+            }
+        ),
+        "children": [to_dict(child) for child in node.children],
+    }
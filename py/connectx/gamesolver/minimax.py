@@ -1,68 +1,271 @@
 from __future__ import annotations
 
-from typing import Generic, Optional
+from typing import Generic, Iterator, Optional, Sequence
+import math
+import time
 
-from connectx.gamesolver import game, gametree
+import numpy as np
+
+from connectx.gamesolver import game, gametree, ordering
+
+# search で deadline を確かめる間隔 (node 数)
+DEADLINE_CHECK_INTERVAL = 256
+
+
+class SearchTimeout(Exception):
+    """search が deadline までに読み終わらなかった"""
+
+    pass
 
 
 class Minimax(Generic[game.S, game.R, game.A, gametree.SC]):
+    _root_actions: Optional[list[game.A]]
+
     def __init__(
-        self, game: game.Game[game.S, game.R, game.A], scorer: gametree.SC, tree: gametree.Tree[game.S, game.R, game.A]
+        self,
+        game: game.Game[game.S, game.R, game.A],
+        scorer: gametree.SC,
+        tree: gametree.Tree[game.S, game.R, game.A],
+        ordering: Optional[ordering.MoveOrdering[game.S, game.A]] = None,
+        pruning: bool = False,
     ) -> None:
         self._game = game
         self._scorer = scorer
         self._tree = tree
+        self._ordering = ordering
+        self._pruning = pruning
+        self._root_actions = None
+        self._deadline: Optional[float] = None
+        self._next_deadline_check = 0
+        self.stats = gametree.SearchStats()
 
-    def __call__(self, depth: int, state: game.S) -> None:
+    def __call__(self, depth: int, state: game.S, root_actions: Optional[Sequence[game.A]] = None) -> None:
+        """root_actions を渡すと、root ではその手だけを読む"""
         if self._game.get_result(state=state) is not None:
             raise RuntimeError("Game is already over.")
+        self._root_actions = None if root_actions is None else list(root_actions)
+        self.stats.reset()
         root_node_id = self._tree.add_root_node(state=state)
-        self._call_core_safe(depth=depth, node_id=root_node_id)
+        self._call_core_safe(depth=depth, node_id=root_node_id, ply=0, alpha=-math.inf, beta=math.inf)
         # self._mark_rational(root_node)
 
-    def _call_core_safe(self, depth: int, node_id: gametree.NodeId) -> None:
+    def _call_core_safe(self, depth: int, node_id: gametree.NodeId, ply: int, alpha: float, beta: float) -> None:
         try:
-            self._call_core(depth, node_id)
+            self._call_core(depth, node_id, ply, alpha, beta)
         except KeyError:  # すでにノードがない
             return
 
-    def _call_core(self, depth: int, node_id: gametree.NodeId) -> None:
-        """与えられた node_id に対する score を計算する (つまり、この関数が呼ばれた時点で node はすでに tree に追加されている前提)"""
+    def _call_core(self, depth: int, node_id: gametree.NodeId, ply: int, alpha: float, beta: float) -> None:
+        """与えられた node_id に対する score を計算する (つまり、この関数が呼ばれた時点で node はすでに tree に追加されている前提)
+
+        pruning が有効なときは alpha-beta 法で枝刈りする。窓 (alpha, beta) の外に出た score は真の値ではなく上界/下界なので、
+        その旨を "bound" property に記録する。
+        """
         state, result = self._tree.get_node_state_result(node_id=node_id)
         if result is not None:  # ゲーム終了
+            self.stats.n_leaf_evaluations += 1
             score = self._scorer(state)
             self._tree.assign_node_property(node_id, "score", score)
             return
         if depth == 0:
+            self.stats.n_leaf_evaluations += 1
             score = self._scorer(state)
             self._tree.assign_node_property(node_id, "score", score)
             return
         # ゲーム継続; 木を成長させつつ再帰呼び出し
-        next_actions = self._game.get_available_actions(state)
-        next_states = [self._game.step(state, action) for action in next_actions]
-        next_results = [self._game.get_result(state=state) for state in next_states]
-        children = []
-        for next_action, next_state, next_result in zip(next_actions, next_states, next_results):
-            child_node_id = self._tree.grow(
-                parent_node_id=node_id, action=next_action, state=next_state, result=next_result
-            )
-            self._call_core_safe(depth=depth - 1, node_id=child_node_id)
-            children.append(child_node_id)
-        # 子ノードのスコアを集約して自分のスコアを計算
+        next_actions = self._tree.get_node_available_actions(node_id, self._game)
+        if ply == 0 and self._root_actions is not None:
+            next_actions = [action for action in next_actions if action in self._root_actions]
+        if self._ordering is not None:
+            next_actions = self._ordering.order(state, next_actions, ply)
+        maximize = state.next_turn != game.Turn.OPPONENT
+        original_alpha, original_beta = alpha, beta
         scores: list[float] = []
-        for child_node_id in children:
-            try:
-                score = self._tree.get_node_property(node_id=child_node_id, key="score")
+        if depth == 1 and isinstance(self._scorer, gametree.BatchScorer):
+            # 子は全て葉なので、枝刈りせずにまとめて評価する
+            scores = self._grow_leaves(node_id, state, next_actions, self._scorer)
+            best_idx = int(np.argmax(scores) if maximize else np.argmin(scores))
+            cutoff = scores[best_idx] >= beta if maximize else scores[best_idx] <= alpha
+            if self._pruning and cutoff and self._ordering is not None:
+                self._ordering.on_cutoff(state, next_actions[best_idx], ply, depth)
+        else:
+            if self._pruning:
+                # cutoff の後の子は作らずに済むよう、読む直前に 1 つずつ作る
+                children = self._iter_children(state, next_actions)
+            else:
+                # 全ての子を読むので、expand_all でまとめて作る
+                children = iter(self._game.expand_all(state, next_actions))
+            for next_action, next_state, next_result in children:
+                child_node_id = self._tree.grow(
+                    parent_node_id=node_id, action=next_action, state=next_state, result=next_result
+                )
+                self.stats.n_nodes += 1
+                self._call_core_safe(depth=depth - 1, node_id=child_node_id, ply=ply + 1, alpha=alpha, beta=beta)
+                try:
+                    score = self._tree.get_node_property(node_id=child_node_id, key="score")
+                except KeyError:  # 子ノードが存在しない場合はスキップ
+                    continue
                 scores.append(score)
-            except KeyError:  # 子ノードが存在しない場合はスキップ
-                pass
-        aggregator = min if state.next_turn == game.Turn.OPPONENT else max
+                if maximize:
+                    alpha = max(alpha, score)
+                else:
+                    beta = min(beta, score)
+                if self._pruning and alpha >= beta:
+                    if self._ordering is not None:
+                        self._ordering.on_cutoff(state, next_action, ply, depth)
+                    break
+        # 子ノードのスコアを集約して自分のスコアを計算
+        aggregator = max if maximize else min
         score = aggregator(scores)
         self._tree.assign_node_property(node_id, "score", score)
+        if self._pruning:
+            if score <= original_alpha:
+                self._tree.assign_node_property(node_id, "bound", "upper")
+            elif score >= original_beta:
+                self._tree.assign_node_property(node_id, "bound", "lower")
+
+    def _iter_children(
+        self, state: game.S, next_actions: list[game.A]
+    ) -> Iterator[tuple[game.A, game.S, Optional[game.R]]]:
+        """expand_all と同じ (action, state, result) を、取り出されるたびに 1 つずつ作る"""
+        for next_action in next_actions:
+            next_state = self._game.step(state, next_action)
+            yield next_action, next_state, self._game.get_result(next_state)
+
+    def _grow_leaves(
+        self,
+        node_id: gametree.NodeId,
+        state: game.S,
+        next_actions: list[game.A],
+        scorer: gametree.BatchScorer[game.S],
+    ) -> list[float]:
+        """node の子を全て tree に追加し、score_batch で一度に評価する"""
+        children = self._game.expand_all(state, next_actions)
+        child_node_ids = [
+            self._tree.grow(parent_node_id=node_id, action=next_action, state=next_state, result=next_result)
+            for next_action, next_state, next_result in children
+        ]
+        scores = scorer.score_batch([next_state for _, next_state, _ in children])
+        self.stats.n_nodes += len(children)
+        self.stats.n_leaf_evaluations += len(children)
+        for child_node_id, score in zip(child_node_ids, scores):
+            self._tree.assign_node_property(child_node_id, "score", score)
+        return scores
+
+    def search(
+        self,
+        depth: int,
+        state: game.S,
+        root_actions: Optional[Sequence[game.A]] = None,
+        deadline: Optional[float] = None,
+    ) -> tuple[float, game.A]:
+        """
+        tree を作らずに探索し、(root の score, 最善手) を返す。
+        Game が in-place API を持つ (game.InPlaceGame である) なら、node ごとに state を生成しない。
+        root_actions を渡すと、root ではその手だけを読む。
+        deadline (time.perf_counter() の値) を渡すと、DEADLINE_CHECK_INTERVAL node ごとに時刻を確かめ、
+        過ぎていれば読みかけの結果を捨てて SearchTimeout を投げる。
+        """
+        if depth <= 0:
+            raise ValueError("depth must be positive")
+        if self._game.get_result(state=state) is not None:
+            raise RuntimeError("Game is already over.")
+        self._root_actions = None if root_actions is None else list(root_actions)
+        self._deadline = deadline
+        self._next_deadline_check = DEADLINE_CHECK_INTERVAL
+        self.stats.reset()
+        if isinstance(self._game, game.InPlaceGame):
+            search_state = self._game.to_search_state(state)
+            score, action = self._search_core(depth, search_state, 0, -math.inf, math.inf, in_place=self._game)
+        else:
+            score, action = self._search_core(depth, state, 0, -math.inf, math.inf, in_place=None)
+        if action is None:
+            raise RuntimeError("No available action.")
+        return score, action
+
+    def _search_core(
+        self,
+        depth: int,
+        state: game.S,
+        ply: int,
+        alpha: float,
+        beta: float,
+        in_place: Optional[game.InPlaceGame[game.S, game.R, game.A]],
+    ) -> tuple[float, Optional[game.A]]:
+        """
+        state は終局していない前提。search と同じく、pruning が有効なら窓の外の score は上界/下界になる。
+        in_place を渡すと、state (in_place.to_search_state で作ったもの) を play/undo で書き換えながら読む
+        """
+        if self._deadline is not None and self.stats.n_nodes >= self._next_deadline_check:
+            self._next_deadline_check = self.stats.n_nodes + DEADLINE_CHECK_INTERVAL
+            if time.perf_counter() > self._deadline:
+                raise SearchTimeout
+        next_actions = self._game.get_available_actions(state)
+        if ply == 0 and self._root_actions is not None:
+            next_actions = [action for action in next_actions if action in self._root_actions]
+        if self._ordering is not None:
+            next_actions = self._ordering.order(state, next_actions, ply)
+        maximize = state.next_turn != game.Turn.OPPONENT
+        if depth == 1 and isinstance(self._scorer, gametree.BatchScorer) and len(next_actions) > 0:
+            return self._search_leaves(state, next_actions, ply, alpha, beta, self._scorer)
+        best_score = -math.inf if maximize else math.inf
+        best_action: Optional[game.A] = None
+        for next_action in next_actions:
+            if in_place is not None:
+                in_place.play(state, next_action)
+                next_state = state
+            else:
+                next_state = self._game.step(state, next_action)
+            self.stats.n_nodes += 1
+            if depth == 1 or self._game.get_result(state=next_state) is not None:
+                self.stats.n_leaf_evaluations += 1
+                score = self._scorer(next_state)
+            else:
+                score, _ = self._search_core(depth - 1, next_state, ply + 1, alpha, beta, in_place)
+            if in_place is not None:
+                in_place.undo(state)
+            if (maximize and score > best_score) or (not maximize and score < best_score) or best_action is None:
+                best_score, best_action = score, next_action
+            if maximize:
+                alpha = max(alpha, score)
+            else:
+                beta = min(beta, score)
+            if self._pruning and alpha >= beta:
+                if self._ordering is not None:
+                    self._ordering.on_cutoff(state, next_action, ply, depth)
+                break
+        return best_score, best_action
+
+    def _search_leaves(
+        self,
+        state: game.S,
+        next_actions: list[game.A],
+        ply: int,
+        alpha: float,
+        beta: float,
+        scorer: gametree.BatchScorer[game.S],
+    ) -> tuple[float, Optional[game.A]]:
+        """子は全て葉なので、枝刈りせずに score_batch でまとめて評価する。子の state は in-place でなく step で作る"""
+        scores = scorer.score_batch(self._game.step_many([state] * len(next_actions), next_actions))
+        self.stats.n_nodes += len(next_actions)
+        self.stats.n_leaf_evaluations += len(next_actions)
+        maximize = state.next_turn != game.Turn.OPPONENT
+        best_idx = int(np.argmax(scores) if maximize else np.argmin(scores))
+        best_score, best_action = scores[best_idx], next_actions[best_idx]
+        cutoff = best_score >= beta if maximize else best_score <= alpha
+        if self._pruning and cutoff and self._ordering is not None:
+            self._ordering.on_cutoff(state, best_action, ply, 1)
+        return best_score, best_action
 
 
 def get_rational_score(node: gametree.Node) -> float:
     score: float = node.properties.get("score", float("-Inf"))
+    # 枝刈りされた node の score は境界値なので、真の値はそれより厳密に悪い (良い) 側にあるものとして扱う
+    bound = node.properties.get("bound")
+    if bound == "upper":
+        score = float(np.nextafter(score, -math.inf))
+    elif bound == "lower":
+        score = float(np.nextafter(score, math.inf))
     return score
 
 
@@ -0,0 +1,70 @@
+"""Minimax の子ノードを訪れる順番を決める。枝刈りと組み合わせると、良い手から読むほど探索ノード数が減る"""
+
+from __future__ import annotations
+
+import abc
+from collections import defaultdict
+from typing import Callable, Generic, Optional
+
+from connectx.gamesolver import game
+
+
+class MoveOrdering(abc.ABC, Generic[game.S, game.A]):
+    @abc.abstractmethod
+    def order(self, state: game.S, actions: list[game.A], ply: int) -> list[game.A]:
+        """ply は探索の root からの手数"""
+        pass
+
+    def on_cutoff(self, state: game.S, action: game.A, ply: int, depth: int) -> None:
+        """action で beta cut が起きたときに呼ばれる。depth は残り探索深さ"""
+        pass
+
+
+class StaticOrdering(MoveOrdering[game.S, game.A]):
+    """key の小さい順に並べるだけの、学習しない順序付け"""
+
+    def __init__(self, key: Callable[[game.A], float]) -> None:
+        self._key = key
+
+    def order(self, state: game.S, actions: list[game.A], ply: int) -> list[game.A]:
+        return sorted(actions, key=self._key)
+
+
+class KillerHistoryOrdering(MoveOrdering[game.S, game.A]):
+    """killer move (ply ごとに最近 cut を起こした手) を先頭に、残りを history の大きい順に並べる
+
+    テーブルは同じインスタンスを使っている限り、反復深化の反復や手をまたいで引き継がれる。
+    history が同じ手同士は base の順序を保つ。
+    """
+
+    def __init__(self, base: Optional[MoveOrdering[game.S, game.A]] = None, n_killers: int = 2) -> None:
+        self._base = base
+        self._n_killers = n_killers
+        self._killers: defaultdict[int, list[game.A]] = defaultdict(list)
+        self._history: defaultdict[game.A, int] = defaultdict(int)
+
+    def order(self, state: game.S, actions: list[game.A], ply: int) -> list[game.A]:
+        if self._base is not None:
+            actions = self._base.order(state, actions, ply)
+        killers = self._killers.get(ply, [])
+
+        def key(action: game.A) -> tuple[int, int]:
+            killer_rank = killers.index(action) if action in killers else len(killers)
+            return (killer_rank, -self._history.get(action, 0))
+
+        return sorted(actions, key=key)
+
+    def on_cutoff(self, state: game.S, action: game.A, ply: int, depth: int) -> None:
+        killers = self._killers[ply]
+        if action in killers:
+            killers.remove(action)
+        killers.insert(0, action)
+        del killers[self._n_killers :]
+        self._history[action] += depth * depth
+        if self._base is not None:
+            self._base.on_cutoff(state, action, ply, depth)
+
+    def age(self) -> None:
+        """history を半減させて古い情報の影響を薄める。手番ごとに呼ぶ想定"""
+        for action in self._history:
+            self._history[action] //= 2
@@ -0,0 +1,86 @@
+"""相手の手番の間も、自分の手を打った後の局面から MCTS の探索を別スレッドで続ける (pondering)
+
+相手の手が分かったら探索を止め、実際の局面に対応する部分木を次の探索の root に昇格させる。
+相手の手で試合が終わると次の promote は呼ばれないので、pondering は max_playouts と max_time でも打ち切る。
+試合を終えるときは stop を呼ぶこと。
+"""
+
+from __future__ import annotations
+
+from collections.abc import Hashable
+from typing import Callable, Generic, Optional
+import threading
+
+from connectx.gamesolver import game, mcts
+
+
+class Ponderer(Generic[game.S, game.R, game.A]):
+    _node: Optional[mcts.MCTSNode[game.S, game.R, game.A]]
+    _thread: Optional[threading.Thread]
+
+    def __init__(
+        self,
+        mcts: mcts.MCTS[game.S, game.R, game.A],
+        key: Callable[[game.S], Hashable],
+        max_playouts: int = 200_000,
+        max_time: float = 30.0,
+    ) -> None:
+        """key は局面が同じかどうかを判定するための関数。max_playouts と max_time (秒) は 1 回の pondering の上限"""
+        self._mcts = mcts
+        self._key = key
+        self._max_playouts = max_playouts
+        self._max_time = max_time
+        self._stop_event = threading.Event()
+        self._node = None
+        self._thread = None
+        self._n_pondered = 0
+
+    @property
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def n_pondered(self) -> int:
+        """直近の pondering で行った playout の数"""
+        return self._n_pondered
+
+    def start(self, node: mcts.MCTSNode[game.S, game.R, game.A]) -> None:
+        """node (自分の手を打った後の局面) 以下の探索をバックグラウンドで始める。結果が確定していれば何もしない"""
+        self.stop()
+        if node.is_terminal or node.proven is not None:
+            return
+        self._node = node
+        self._stop_event.clear()
+        self._thread = threading.Thread(
+            target=self._mcts.search,
+            kwargs=dict(
+                state=node.state,
+                max_playouts=self._max_playouts,
+                time_limit=self._max_time,
+                root=node,
+                stop_event=self._stop_event,
+            ),
+            daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+        progress = self._mcts.current_progress()
+        self._n_pondered = 0 if progress is None else progress.n_playouts
+
+    def promote(self, state: game.S) -> Optional[mcts.MCTSNode[game.S, game.R, game.A]]:
+        """pondering を止め、state (相手が打った後の局面) に一致する子 node を返す。読んでいなければ None"""
+        self.stop()
+        node, self._node = self._node, None
+        if node is None:
+            return None
+        key = self._key(state)
+        for child in node.children:
+            if self._key(child.state) == key:
+                return child
+        return None
@@ -0,0 +1,150 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Generic, Iterator, Mapping, Optional
+import dataclasses
+import json
+
+import numpy as np
+
+from connectx.gamesolver import game, gametree
+
+
+@dataclasses.dataclass
+class CacheStats:
+    size: int
+    capacity: int
+    hits: int
+    warm_hits: int
+    misses: int
+    evictions: int
+
+    @property
+    def hit_rate(self) -> float:
+        n = self.hits + self.warm_hits + self.misses
+        return 0.0 if n == 0 else (self.hits + self.warm_hits) / n
+
+
+class WarmCache:
+    """CachedScorer.save で書き出した評価値を memory-map したまま引く (読み込み時に parse しない)
+
+    ファイルは shape (2, N) の uint64 の .npy で、0 行目が昇順の key、1 行目が float64 の score を uint64 として詰めたもの。
+    同じ名前で拡張子が .json のファイルに、評価値を作ったときの設定 (盤面の大きさや scorer など) を書いておく
+    """
+
+    def __init__(self, path: Path, meta: Mapping[str, Any]) -> None:
+        """meta はこのキャッシュを使う側の設定。ファイルに書かれた設定と食い違えば、別の評価値なので ValueError"""
+        table = np.load(path, mmap_mode="r")
+        if table.ndim != 2 or table.shape[0] != 2 or table.dtype != np.uint64:
+            raise ValueError(f"{path} is not a score cache file")
+        meta_path = path.with_suffix(".json")
+        if not meta_path.exists():
+            raise ValueError(f"{path} has no {meta_path.name}; the settings it was made with are unknown")
+        with open(meta_path) as f:
+            self.meta: dict[str, Any] = json.load(f)
+        mismatches = [key for key, value in meta.items() if self.meta.get(key) != value]
+        if len(mismatches) > 0:
+            raise ValueError(
+                f"{path} was made with different settings: "
+                + ", ".join(f"{key}={self.meta.get(key)!r} (expected {meta[key]!r})" for key in mismatches)
+            )
+        self._keys = table[0]
+        self._scores = table[1].view(np.float64)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def get(self, key: int) -> Optional[float]:
+        if key >= 2**64 or len(self._keys) == 0:
+            return None
+        idx = int(np.searchsorted(self._keys, np.uint64(key)))
+        if idx < len(self._keys) and int(self._keys[idx]) == key:
+            return float(self._scores[idx])
+        return None
+
+    def items(self) -> Iterator[tuple[int, float]]:
+        """(key, score) を key の昇順に返す"""
+        return zip(self._keys.tolist(), self._scores.tolist())
+
+
+class CachedScorer(gametree.Scorer[game.S], Generic[game.S]):
+    """任意の Scorer の前に置く、容量制限つきの LRU 評価値キャッシュ
+
+    key には局面を一意に表す整数を返す関数を渡す (ConnectX なら connectx_game.position_key)。
+    手や試合をまたいで同じ CachedScorer を使い回すことで、同一局面の再評価を省く。
+    """
+
+    def __init__(
+        self,
+        scorer: gametree.Scorer[game.S],
+        key: Callable[[game.S], int],
+        capacity: int = 1_000_000,
+        warm_cache: Optional[WarmCache] = None,
+    ) -> None:
+        if capacity <= 0:
+            raise ValueError("capacity must be positive")
+        self._scorer = scorer
+        self.win_score = scorer.win_score
+        self.loss_score = scorer.loss_score
+        self._key = key
+        self._capacity = capacity
+        self._warm_cache = warm_cache
+        self._cache: OrderedDict[int, float] = OrderedDict()
+        self._hits = 0
+        self._warm_hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def __call__(self, state: game.S) -> float:
+        key = self._key(state)
+        score = self._cache.get(key)
+        if score is not None:
+            self._cache.move_to_end(key)
+            self._hits += 1
+            return score
+        if self._warm_cache is not None:
+            score = self._warm_cache.get(key)
+        if score is not None:
+            self._warm_hits += 1
+        else:
+            self._misses += 1
+            score = self._scorer(state)
+        self._cache[key] = score
+        if len(self._cache) > self._capacity:
+            self._cache.popitem(last=False)
+            self._evictions += 1
+        return score
+
+    @property
+    def stats(self) -> CacheStats:
+        return CacheStats(
+            size=len(self._cache),
+            capacity=self._capacity,
+            hits=self._hits,
+            warm_hits=self._warm_hits,
+            misses=self._misses,
+            evictions=self._evictions,
+        )
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+    def save(self, path: Path, meta: Mapping[str, Any]) -> None:
+        """
+        キャッシュ (と warm cache) の中身を WarmCache で memory-map できる形式で書き出す。
+        meta (盤面の大きさや scorer など、評価値を作ったときの設定) は同じ名前の .json に書く
+        """
+        entries = dict(self._cache)
+        if self._warm_cache is not None:
+            for key, score in self._warm_cache.items():
+                entries.setdefault(key, score)
+        if any(key >= 2**64 or key < 0 for key in entries):
+            raise ValueError("keys must fit in uint64 to be saved")
+        keys = np.array(sorted(entries), dtype=np.uint64)
+        scores = np.array([entries[int(key)] for key in keys], dtype=np.float64)
+        table = np.stack([keys, scores.view(np.uint64)])
+        with open(path, "wb") as f:
+            np.save(f, table)
+        with open(path.with_suffix(".json"), "w") as f:
+            json.dump(dict(meta, size=len(keys)), f)
@@ -0,0 +1,170 @@
+"""connectx.serving.server の client
+
+AgentClient は 1 つの接続の上で複数の request を並行に送り、id で response を振り分ける。
+main は空の盤面から games 局を並行に打ち (相手はランダム)、1 手あたりの応答時間と fallback の数を表示する負荷試験。
+その前に、不正な request にも server が error を返す (接続が止まらない) ことを確かめる。
+
+usage: python -m connectx.serving.client [--port 8765] [--games 100]
+"""
+
+from __future__ import annotations
+
+from typing import Any, Optional
+import asyncio
+import dataclasses
+import itertools
+import json
+import random
+import time
+
+import click
+import numpy as np
+
+from connectx.tutorial import connectx_game
+
+
+class AgentClient:
+    _reader: Optional[asyncio.StreamReader]
+    _writer: Optional[asyncio.StreamWriter]
+    _receiver: Optional[asyncio.Task[None]]
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8765) -> None:
+        self._host = host
+        self._port = port
+        self._reader = None
+        self._writer = None
+        self._receiver = None
+        self._ids = itertools.count()
+        self._pending: dict[int, asyncio.Future[dict[str, Any]]] = {}
+
+    async def connect(self) -> None:
+        self._reader, self._writer = await asyncio.open_connection(self._host, self._port)
+        self._receiver = asyncio.ensure_future(self._receive(self._reader))
+
+    async def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+        if self._receiver is not None:
+            await self._receiver
+
+    async def _receive(self, reader: asyncio.StreamReader) -> None:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            response = json.loads(line)
+            future = self._pending.pop(response["id"], None)
+            if future is not None:
+                future.set_result(response)
+        for future in self._pending.values():
+            future.set_exception(ConnectionError("server closed the connection"))
+        self._pending.clear()
+
+    async def request(
+        self, obs: connectx_game.Observation, config: connectx_game.Config, deadline: Optional[float] = None
+    ) -> dict[str, Any]:
+        """response の dict (action, elapsed, timed_out) をそのまま返す"""
+        if self._writer is None:
+            raise RuntimeError("call connect() first")
+        request_id = next(self._ids)
+        request: dict[str, Any] = dict(
+            id=request_id, observation=dataclasses.asdict(obs), configuration=dataclasses.asdict(config)
+        )
+        if deadline is not None:
+            request["deadline"] = deadline
+        future = asyncio.get_event_loop().create_future()
+        self._pending[request_id] = future
+        self._writer.write(json.dumps(request).encode() + b"\n")
+        await self._writer.drain()
+        response: dict[str, Any] = await future
+        if "error" in response:
+            raise ValueError(response["error"])
+        return response
+
+    async def act(
+        self, obs: connectx_game.Observation, config: connectx_game.Config, deadline: Optional[float] = None
+    ) -> int:
+        response = await self.request(obs, config, deadline)
+        return int(response["action"])
+
+
+async def play_random_opponent(
+    client: AgentClient, config: connectx_game.Config, seed: int, latencies: list[float], n_timeouts: list[int]
+) -> None:
+    """server が先手 (mark 1)、ランダムな手が後手で 1 局打つ"""
+    rng = random.Random(seed)
+    connectx = connectx_game.ConnectXGame(config.columns, config.rows, config.inarow)
+    state = connectx_game.ConnectXState(
+        np.zeros((config.rows, config.columns), dtype=np.int64), next_player=1, step=0
+    )
+    while connectx.get_result(state) is None:
+        if state.next_player == 1:
+            obs = connectx_game.Observation(
+                board=state.grid.ravel().tolist(), mark=1, remainingOverageTime=0, step=state.step
+            )
+            start = time.perf_counter()
+            response = await client.request(obs, config)
+            latencies.append(time.perf_counter() - start)
+            n_timeouts[0] += int(response["timed_out"])
+            col = int(response["action"])
+        else:
+            col = rng.choice(connectx.get_available_actions(state)).col
+        action = next(a for a in connectx.get_available_actions(state) if a.col == col)
+        state = connectx.step(state, action)
+
+
+async def check_bad_requests(client: AgentClient, host: str, port: int, config: connectx_game.Config) -> None:
+    """不正な request それぞれに error の response が返ることを確かめる。返らなければ timeout で失敗する"""
+    n_cells = config.rows * config.columns
+    bad_observations: dict[str, tuple[list[int], int]] = {  # (board, mark)
+        "short board": ([0] * (n_cells - 1), 1),
+        "full board": ([1, 2] * (n_cells // 2), 1),
+        "bad mark": ([0] * n_cells, 3),
+    }
+    for name, (board, mark) in bad_observations.items():
+        obs = connectx_game.Observation(board=board, mark=mark, remainingOverageTime=0, step=0)  # type: ignore
+        try:
+            await asyncio.wait_for(client.request(obs, config), timeout=config.actTimeout + 5.0)
+        except ValueError as e:
+            print(f"{name}: {e}")
+        else:
+            raise AssertionError(f"{name}: the server accepted a bad request")
+    # 壊れた JSON は id を読めないので、別の接続で 1 行送って 1 行受け取る
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(b"not json\n")
+    await writer.drain()
+    response = json.loads(await asyncio.wait_for(reader.readline(), timeout=5.0))
+    writer.close()
+    if "error" not in response:
+        raise AssertionError("invalid JSON: the server did not return an error")
+    print(f"invalid JSON: {response['error']}")
+
+
+async def run_load_test(host: str, port: int, games: int, config: connectx_game.Config) -> None:
+    client = AgentClient(host, port)
+    await client.connect()
+    await check_bad_requests(client, host, port, config)
+    latencies: list[float] = []
+    n_timeouts = [0]
+    start = time.perf_counter()
+    await asyncio.gather(*(play_random_opponent(client, config, seed, latencies, n_timeouts) for seed in range(games)))
+    await client.close()
+    print(f"{games} games, {len(latencies)} moves in {time.perf_counter() - start:.1f}s")
+    print(
+        f"latency: mean {np.mean(latencies):.3f}s, p99 {np.percentile(latencies, 99):.3f}s, "
+        f"max {np.max(latencies):.3f}s, {n_timeouts[0]} fallback moves"
+    )
+
+
+@click.command()
+@click.option("--host", type=click.STRING, default="127.0.0.1", show_default=True)
+@click.option("--port", type=click.INT, default=8765, show_default=True)
+@click.option("--games", type=click.INT, default=100, show_default=True)
+@click.option("--act-timeout", type=click.FLOAT, default=2.0, show_default=True)
+def main(host: str, port: int, games: int, act_timeout: float) -> None:
+    config = connectx_game.Config(columns=7, rows=6, inarow=4, actTimeout=act_timeout)
+    asyncio.run(run_load_test(host, port, games, config))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+"""多数の対局の手をまとめて返す、ローカルの agent server
+
+1 行 1 JSON の request (id, observation, configuration, 省略可の deadline 秒) を受け取り、
+1 行 1 JSON の response (id, action, elapsed, timed_out) を返す。1 つの接続で複数の request を並行に送ってよい。
+request が不正なとき (JSON でない、盤面の大きさが合わない、打てる列がないなど) は (id, error) を返す。
+worker で探索が失敗したときは fallback の手に worker_error を添えて返す。
+
+探索は ProcessPoolExecutor の worker で行う。worker ごとに盤面の大きさ別の minimax_agent.Agent を 1 つずつ持つ。
+評価値キャッシュは局面ごとの値なので、その worker が担当する全ての対局で共有する。
+killer/history テーブルと手の記録は試合ごとの状態で、Agent は step が戻ったとき (別の試合の手が来たとき) に捨てる。
+1 つの worker に複数の対局の手が交互に来ると、それらはほぼ 1 手ごとに作り直されることになる。
+eval_cache.npy (warm cache) と tablebase.npy は全ての worker が memory-map するので、OS の page cache を共有する。
+
+deadline (既定は configuration の actTimeout) は request を受け取った時点から数える。
+worker の探索は残り時間に収まるよう持ち時間を縮め、deadline を過ぎれば読みかけでも打ち切る
+(打ち切らないと、遅れた request が worker を塞いで後の request も次々に遅れる)。
+最初の反復すら間に合わなければ、中央寄りの合法手を代わりに返す。
+
+usage: python -m connectx.serving.server [--port 8765] [--workers 4] [--warm-cache eval_cache.npy] [--scalable]
+"""
+
+from __future__ import annotations
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Optional
+import asyncio
+import dataclasses
+import json
+import multiprocessing
+import time
+
+import click
+import numpy as np
+
+from connectx.gamesolver import minimax
+from connectx.tutorial import connectx_game, minimax_agent, time_manager
+
+
+@dataclasses.dataclass
+class WorkerOptions:
+    depth: int
+    cache_capacity: int
+    warm_cache: Optional[Path]
+    tablebase_path: Optional[Path]
+    scalable: bool
+
+
+# 以下は worker process ごとの状態
+_options: Optional[WorkerOptions] = None
+_agents: dict[tuple[int, int, int], minimax_agent.Agent] = {}
+
+
+def _init_worker(options: WorkerOptions) -> None:
+    """標準の盤面の agent は先に作って warm-up し、最初の request で準備の時間を払わないようにする"""
+    global _options
+    _options = options
+    _agents.clear()
+    _get_agent(connectx_game.Config(columns=7, rows=6, inarow=4))
+
+
+def _get_agent(config: connectx_game.Config) -> minimax_agent.Agent:
+    """盤面の大きさごとに 1 つだけ作り、同じ大きさの対局で使い回す"""
+    assert _options is not None
+    config_key = (config.columns, config.rows, config.inarow)
+    agent = _agents.get(config_key)
+    if agent is None:
+        agent = minimax_agent.Agent(
+            depth=_options.depth,
+            outdir=None,
+            cache_capacity=_options.cache_capacity,
+            warm_cache=_options.warm_cache,
+            # server は何局でも打ち続けるので、手の記録は残さない (残すとメモリが増え続ける)
+            timer=time_manager.TimeManager(max_history=0),
+            tablebase_path=_options.tablebase_path,
+            scalable=_options.scalable,
+        )
+        agent.warm_up(config)
+        _agents[config_key] = agent
+    return agent
+
+
+def fallback_action(obs: connectx_game.Observation, config: connectx_game.Config) -> int:
+    """探索が間に合わないときの手。合法手のうち最も中央に近い列 (合法手があることは parse_request で確かめてある)"""
+    top = np.asarray(obs.board[: config.columns])
+    legal = [col for col in range(config.columns) if top[col] == 0]
+    return min(legal, key=lambda col: abs(2 * col - (config.columns - 1)))
+
+
+def parse_request(request: dict[str, Any]) -> tuple[connectx_game.Observation, connectx_game.Config]:
+    """
+    kaggle の observation/configuration には余分な key もあるので、使う field だけを取り出す。
+    盤面の大きさが合わない、または打てる列がないときは ValueError
+    """
+    obs = request["observation"]
+    config = request["configuration"]
+    observation = connectx_game.Observation(
+        board=list(obs["board"]),
+        mark=obs["mark"],
+        remainingOverageTime=obs.get("remainingOverageTime", 0),
+        step=obs["step"],
+    )
+    configuration = connectx_game.Config(
+        columns=int(config["columns"]),
+        rows=int(config["rows"]),
+        inarow=int(config["inarow"]),
+        actTimeout=float(config.get("actTimeout", 2.0)),
+    )
+    if len(observation.board) != configuration.rows * configuration.columns:
+        raise ValueError(
+            f"board has {len(observation.board)} cells, expected {configuration.rows}x{configuration.columns}"
+        )
+    if observation.mark not in (1, 2):
+        raise ValueError(f"mark must be 1 or 2, got {observation.mark!r}")
+    if all(cell != 0 for cell in observation.board[: configuration.columns]):
+        raise ValueError("board has no legal move")
+    return observation, configuration
+
+
+def act(obs: connectx_game.Observation, config: connectx_game.Config, deadline: float) -> tuple[int, bool]:
+    """
+    worker process で実行される。deadline は time.time() での締め切り。
+    (action, 探索せずに fallback_action を返したか) を返す
+    """
+    remaining = deadline - time.time()
+    if remaining <= 0:  # queue で待っている間に締め切りを過ぎた
+        return fallback_action(obs, config), True
+    search_deadline = time.perf_counter() + remaining
+    act_timeout = min(config.actTimeout, remaining)
+    limited_obs = dataclasses.replace(
+        obs, remainingOverageTime=int(max(min(obs.remainingOverageTime, remaining - act_timeout), 0))
+    )
+    limited_config = dataclasses.replace(config, actTimeout=act_timeout)
+    try:
+        return _get_agent(config)(limited_obs, limited_config, deadline=search_deadline), False
+    except minimax.SearchTimeout:
+        return fallback_action(obs, config), True
+
+
+class AgentServer:
+    def __init__(self, executor: ProcessPoolExecutor, grace: float = 0.2) -> None:
+        """grace: worker の結果をこの秒数だけ deadline を過ぎても待つ (process 間の受け渡しの分)"""
+        self._executor = executor
+        self._grace = grace
+        self.n_requests = 0
+        self.n_timeouts = 0
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        tasks: set[asyncio.Task[None]] = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                task = asyncio.ensure_future(self._respond(line, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if len(tasks) > 0:
+                await asyncio.wait(tasks)
+        finally:
+            writer.close()
+
+    async def _respond(self, line: bytes, writer: asyncio.StreamWriter) -> None:
+        """どんな request にも必ず 1 行返す (返さないと client は待ち続ける)"""
+        start = time.time()
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            response: dict[str, Any] = dict(id=None, error=f"invalid JSON: {e}")
+        else:
+            if isinstance(request, dict):
+                response = await self.handle_request(request, start)
+            else:
+                response = dict(id=None, error="request must be a JSON object")
+        writer.write(json.dumps(response).encode() + b"\n")
+        await writer.drain()
+
+    async def handle_request(self, request: dict[str, Any], received: float) -> dict[str, Any]:
+        self.n_requests += 1
+        request_id = request.get("id")
+        try:
+            obs, config = parse_request(request)
+            deadline = received + float(request.get("deadline", config.actTimeout))
+        except (KeyError, TypeError, ValueError) as e:
+            return dict(id=request_id, error=f"invalid request: {e!r}")
+        loop = asyncio.get_event_loop()
+        future = loop.run_in_executor(self._executor, act, obs, config, deadline)
+        response: dict[str, Any] = dict(id=request_id)
+        try:
+            action, timed_out = await asyncio.wait_for(
+                future, timeout=max(deadline - time.time(), 0.0) + self._grace
+            )
+        except asyncio.TimeoutError:
+            # worker の探索は deadline で打ち切られるので、ここに来るのは結果の受け渡しが grace より遅れたとき
+            action, timed_out = fallback_action(obs, config), True
+        except Exception as e:
+            # 盤面は検証済みなので、worker が失敗しても fallback_action は返せる
+            action, timed_out = fallback_action(obs, config), True
+            response["worker_error"] = repr(e)
+        if timed_out:
+            self.n_timeouts += 1
+        response.update(action=action, elapsed=time.time() - received, timed_out=timed_out)
+        return response
+
+
+async def serve(host: str, port: int, workers: int, options: WorkerOptions) -> None:
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(options,)) as executor:
+        server = AgentServer(executor)
+        async with await asyncio.start_server(server.handle_connection, host, port) as socket_server:
+            print(f"serving on {host}:{port} with {workers} workers")
+            await socket_server.serve_forever()
+
+
+@click.command()
+@click.option("--host", type=click.STRING, default="127.0.0.1", show_default=True)
+@click.option("--port", type=click.INT, default=8765, show_default=True)
+@click.option("--workers", type=click.INT, default=multiprocessing.cpu_count(), show_default=True)
+@click.option("--depth", type=click.INT, default=10, show_default=True)
+@click.option("--cache-capacity", type=click.INT, default=100_000, show_default=True)
+@click.option("--warm-cache", type=click.Path(exists=True, dir_okay=False, path_type=Path), default=None)
+@click.option("--tablebase", type=click.Path(exists=True, dir_okay=False, path_type=Path), default=None)
+@click.option("--scalable", is_flag=True, help="search with ScalableSearch (for large boards)")
+def main(
+    host: str,
+    port: int,
+    workers: int,
+    depth: int,
+    cache_capacity: int,
+    warm_cache: Optional[Path],
+    tablebase: Optional[Path],
+    scalable: bool,
+) -> None:
+    options = WorkerOptions(
+        depth=depth, cache_capacity=cache_capacity, warm_cache=warm_cache, tablebase_path=tablebase, scalable=scalable
+    )
+    asyncio.run(serve(host, port, workers, options))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""空きマスが max_empty 個以下の局面を読み切って tablebase (connectx.tutorial.tablebase) を作る
+
+7x6 盤でも該当する局面を全て列挙することはできないので、実際に現れる局面の周りだけを解く。
+ランダムな対局 (または selfplay の shard の局面) から空きマスが max_empty 個になるまでランダムに打ち進め、
+そこから終局まで完全に読む。読んだ途中の局面も全て収録する。
+
+usage: python -m connectx.training.make_tablebase <out.npy> [--max-empty 10] [--games 1000] [--shards-dir DIR]
+"""
+
+from __future__ import annotations
+
+from pathlib import Path
+from typing import Optional, Tuple
+import functools
+import multiprocessing
+import random
+
+import click
+import numpy as np
+
+from connectx.training import selfplay
+from connectx.tutorial import connectx_game, tablebase
+
+# (columns, rows, inarow, board, next_player, max_empty, seed)
+SolveTask = Tuple[int, int, int, Tuple[int, ...], int, int, int]
+
+
+@functools.lru_cache(maxsize=None)
+def _get_memo(columns: int, rows: int, inarow: int) -> dict[int, int]:
+    """worker process ごとに持ち、同じ worker が解いた局面を使い回す"""
+    return {}
+
+
+def solve_from(task: SolveTask) -> dict[int, int]:
+    """seed の局面から空きマスが max_empty 個になるまでランダムに打ち、そこから読み切る (worker process で実行される)"""
+    columns, rows, inarow, board, next_player, max_empty, seed = task
+    rng = random.Random(seed)
+    connectx = connectx_game.ConnectXGame(columns, rows, inarow)
+    grid = np.asarray(board, dtype=np.int64).reshape(rows, columns)
+    state = connectx.to_search_state(connectx_game.ConnectXState(grid, 1 if next_player == 1 else 2, step=0))
+    if connectx.get_result(state) is not None:
+        return {}
+    while tablebase.count_empty(state.grid) > max_empty:
+        state.play(rng.choice(connectx.get_available_actions(state)).col)
+        if connectx.get_result(state) is not None:
+            return {}
+    solved: dict[int, int] = {}
+    tablebase.solve(state, inarow, _get_memo(columns, rows, inarow), solved)
+    return solved
+
+
+def seed_tasks(
+    columns: int, rows: int, inarow: int, max_empty: int, games: int, shards_dir: Optional[Path], seed: int
+) -> list[SolveTask]:
+    empty_board = tuple([0] * (rows * columns))
+    tasks: list[SolveTask] = [
+        (columns, rows, inarow, empty_board, 1, max_empty, seed * games + i) for i in range(games)
+    ]
+    if shards_dir is not None:
+        for shard in selfplay.load_shards(shards_dir):
+            for record in shard:
+                board = tuple(int(x) for x in record["board"].ravel())
+                if len(board) != rows * columns:
+                    raise click.UsageError(f"{shards_dir} has positions of a different board size")
+                tasks.append((columns, rows, inarow, board, int(record["next_player"]), max_empty, len(tasks)))
+    return tasks
+
+
+@click.command()
+@click.argument("out", type=click.Path(dir_okay=False, path_type=Path))
+@click.option("--max-empty", type=click.INT, default=10, show_default=True)
+@click.option("--games", type=click.INT, default=1000, show_default=True, help="random games used as seeds")
+@click.option("--shards-dir", type=click.Path(exists=True, file_okay=False, path_type=Path), default=None)
+@click.option("--columns", type=click.INT, default=7, show_default=True)
+@click.option("--rows", type=click.INT, default=6, show_default=True)
+@click.option("--inarow", type=click.INT, default=4, show_default=True)
+@click.option("--workers", type=click.INT, default=multiprocessing.cpu_count(), show_default=True)
+@click.option("--seed", type=click.INT, default=0, show_default=True)
+def main(
+    out: Path,
+    max_empty: int,
+    games: int,
+    shards_dir: Optional[Path],
+    columns: int,
+    rows: int,
+    inarow: int,
+    workers: int,
+    seed: int,
+) -> None:
+    try:
+        tablebase.check_board_size(columns, rows)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    tasks = seed_tasks(columns, rows, inarow, max_empty, games, shards_dir, seed)
+    entries: dict[int, int] = {}
+    with multiprocessing.Pool(workers) as pool:
+        for i, found in enumerate(pool.imap_unordered(solve_from, tasks, chunksize=8)):
+            entries.update(found)
+            if (i + 1) % 100 == 0:
+                print(f"{i + 1}/{len(tasks)} seeds, {len(entries)} positions")
+    tablebase.save(out, entries, columns, rows, inarow, max_empty)
+    print(f"wrote {len(entries)} positions to {out}")
+
+
+if __name__ == "__main__":
+    main()
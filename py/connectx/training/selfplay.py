@@ -0,0 +1,274 @@
+"""ConnectXScorer の重みなどを調整するための教師データを self-play で作る
+
+対局は multiprocessing で並列に行い、各手番で epsilon の確率でランダムな手を打って局面をばらけさせる。
+出てきた局面は左右反転を同一視した key で重複を除き、終局の結果と深い Minimax の score を付けて
+outdir/shard_00000.npy, ... に structured array として書き出す。np.load(mmap_mode="r") でそのまま読める。
+
+usage: python -m connectx.training.selfplay <outdir> [--games 1000] [--first minimax:3] [--second mcts:500]
+"""
+
+from __future__ import annotations
+
+from pathlib import Path
+from typing import Callable, Optional, Tuple
+import dataclasses
+import functools
+import json
+import multiprocessing
+import random
+
+import click
+import numpy as np
+
+from connectx.gamesolver import game, gametree
+from connectx.tutorial import connectx_game, connectx_solver, incremental_scorer
+
+# (columns, rows, inarow, first player spec, second player spec, epsilon, seed)
+GameTask = Tuple[int, int, int, str, str, float, int]
+# (columns, rows, inarow, board, next_player, depth)
+LabelTask = Tuple[int, int, int, Tuple[int, ...], int, int]
+Player = Callable[[connectx_game.ConnectXGame, connectx_game.ConnectXState], connectx_game.ConnectXAction]
+
+
+@dataclasses.dataclass
+class Position:
+    board: Tuple[int, ...]  # grid.ravel()
+    next_player: int
+    step: int
+    outcome: int  # player (1) から見た終局の結果 (1: 勝ち, 0: 引き分け, -1: 負け)
+
+
+def record_dtype(columns: int, rows: int) -> np.dtype:
+    """shard に書き出す 1 局面分のレコード。value は player (1) から見た Minimax の score"""
+    return np.dtype(
+        [
+            ("board", np.int8, (rows, columns)),
+            ("next_player", np.int8),
+            ("step", np.int16),
+            ("outcome", np.int8),
+            ("value", np.float32),
+        ]
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _get_minimax(columns: int, rows: int, inarow: int) -> connectx_solver.ConnectXMinimax:
+    """worker process ごとに 1 つだけ作り、評価値キャッシュや killer/history テーブルを使い回す"""
+    connectx = connectx_game.ConnectXGame(columns, rows, inarow)
+    tree = gametree.Tree[connectx_game.ConnectXState, connectx_game.ConnectXResult, connectx_game.ConnectXAction]()
+    return connectx_solver.ConnectXMinimax(
+        connectx,
+        incremental_scorer.IncrementalScorer(columns, rows, inarow),
+        tree,
+        ordering=connectx_solver.killer_history_ordering(columns),
+        pruning=True,
+    )
+
+
+def make_player(spec: str, columns: int, rows: int, inarow: int) -> Player:
+    """spec: "random", "minimax:<depth>" または "mcts:<n_playouts>" """
+    name, _, arg = spec.partition(":")
+    if name == "random":
+        return lambda connectx, state: random.choice(connectx.get_available_actions(state))
+    if name == "minimax":
+        depth = int(arg or 3)
+        minimax = _get_minimax(columns, rows, inarow)
+        return lambda connectx, state: minimax.search(depth=depth, state=state)[1]
+    if name == "mcts":
+        n_playouts = int(arg or 500)
+
+        def mcts_player(
+            connectx: connectx_game.ConnectXGame, state: connectx_game.ConnectXState
+        ) -> connectx_game.ConnectXAction:
+            searcher = connectx_solver.ConnectXMCTS(connectx)
+            searcher.search(state, max_playouts=n_playouts)
+            progress = searcher.current_progress()
+            assert progress is not None
+            return progress.action
+
+        return mcts_player
+    raise ValueError(f"unknown player: {spec}")
+
+
+def outcome_of(result: connectx_game.ConnectXResult) -> int:
+    if result.winner == game.Turn.PLAYER:
+        return 1
+    if result.winner == game.Turn.OPPONENT:
+        return -1
+    return 0
+
+
+def play_game(task: GameTask) -> list[Position]:
+    """1 局打って、終局までの (終局した局面を除く) 全ての局面を返す (worker process で実行される)"""
+    columns, rows, inarow, first, second, epsilon, seed = task
+    random.seed(seed)  # MCTS は random モジュールを使う
+    connectx = connectx_game.ConnectXGame(columns, rows, inarow)
+    players = {1: make_player(first, columns, rows, inarow), 2: make_player(second, columns, rows, inarow)}
+    state = connectx_game.ConnectXState(np.zeros((rows, columns), dtype=np.int64), next_player=1, step=0)
+    history: list[connectx_game.ConnectXState] = []
+    result = connectx.get_result(state)
+    while result is None:
+        history.append(state)
+        if random.random() < epsilon:
+            action = random.choice(connectx.get_available_actions(state))
+        else:
+            action = players[state.next_player](connectx, state)
+        state = connectx.step(state, action)
+        result = connectx.get_result(state)
+    outcome = outcome_of(result)
+    return [
+        Position(board=tuple(int(x) for x in s.grid.ravel()), next_player=s.next_player, step=s.step, outcome=outcome)
+        for s in history
+    ]
+
+
+def label_position(task: LabelTask) -> float:
+    """局面を depth 手読んだ score (worker process で実行される)"""
+    columns, rows, inarow, board, next_player, depth = task
+    grid = np.asarray(board, dtype=np.int64).reshape(rows, columns)
+    state = connectx_game.ConnectXState(grid, next_player=1 if next_player == 1 else 2, step=0)
+    n_empty = int((grid == 0).sum())
+    score, _ = _get_minimax(columns, rows, inarow).search(depth=min(depth, n_empty), state=state)
+    return score
+
+
+class ShardWriter:
+    """レコードを shard_size 件ずつ outdir/shard_{index:05d}.npy に書き出す"""
+
+    def __init__(self, outdir: Path, dtype: np.dtype, shard_size: int, start_index: int = 0) -> None:
+        self._outdir = outdir
+        self._dtype = dtype
+        self._shard_size = shard_size
+        self._index = start_index
+        self._buffer: list[np.ndarray] = []
+        self._n_buffered = 0
+        self.paths: list[Path] = []
+
+    def add(self, records: np.ndarray) -> None:
+        self._buffer.append(records)
+        self._n_buffered += len(records)
+        if self._n_buffered >= self._shard_size:
+            records = np.concatenate(self._buffer)
+            n_full = len(records) // self._shard_size * self._shard_size
+            for start in range(0, n_full, self._shard_size):
+                self._write(records[start : start + self._shard_size])
+            self._buffer = [records[n_full:]]
+            self._n_buffered = len(records) - n_full
+
+    def close(self) -> None:
+        if self._n_buffered > 0:
+            self._write(np.concatenate(self._buffer))
+        self._buffer = []
+        self._n_buffered = 0
+
+    def _write(self, records: np.ndarray) -> None:
+        path = self._outdir / f"shard_{self._index:05d}.npy"
+        tmp_path = path.with_suffix(".tmp.npy")
+        np.save(tmp_path, records)
+        tmp_path.rename(path)  # 書きかけの shard を読ませない
+        self.paths.append(path)
+        self._index += 1
+
+
+def shard_paths(outdir: Path) -> list[Path]:
+    return sorted(path for path in outdir.glob("shard_*.npy") if not path.name.endswith(".tmp.npy"))
+
+
+def load_shards(outdir: Path) -> list[np.ndarray]:
+    """全ての shard を memory-map して返す"""
+    return [np.load(path, mmap_mode="r") for path in shard_paths(outdir)]
+
+
+def load_seen_keys(outdir: Path) -> set[int]:
+    """既にある shard の局面の key。続けて生成するときに重複させないために使う"""
+    seen = set()
+    for records in load_shards(outdir):
+        for board in records["board"]:
+            seen.add(connectx_game.canonical_key(board))
+    return seen
+
+
+@click.command()
+@click.argument("outdir", type=click.Path(file_okay=False, path_type=Path))
+@click.option("--games", type=click.INT, default=1000, show_default=True)
+@click.option(
+    "--first", type=click.STRING, default="minimax:3", show_default=True, help="random, minimax:<depth> or mcts:<n>"
+)
+@click.option("--second", type=click.STRING, default="minimax:3", show_default=True)
+@click.option("--epsilon", type=click.FLOAT, default=0.1, show_default=True, help="probability of a random move")
+@click.option("--label-depth", type=click.INT, default=6, show_default=True)
+@click.option("--columns", type=click.INT, default=7, show_default=True)
+@click.option("--rows", type=click.INT, default=6, show_default=True)
+@click.option("--inarow", type=click.INT, default=4, show_default=True)
+@click.option("--shard-size", type=click.INT, default=100_000, show_default=True)
+@click.option("--batch-games", type=click.INT, default=200, show_default=True, help="games played between labelings")
+@click.option("--workers", type=click.INT, default=multiprocessing.cpu_count(), show_default=True)
+@click.option("--seed", type=click.INT, default=0, show_default=True)
+def main(
+    outdir: Path,
+    games: int,
+    first: str,
+    second: str,
+    epsilon: float,
+    label_depth: int,
+    columns: int,
+    rows: int,
+    inarow: int,
+    shard_size: int,
+    batch_games: int,
+    workers: int,
+    seed: int,
+) -> None:
+    outdir.mkdir(parents=True, exist_ok=True)
+    for spec in (first, second):
+        make_player(spec, columns, rows, inarow)  # spec の誤りは対局を始める前に知らせる
+    meta_path = outdir / "meta.json"
+    meta = dict(columns=columns, rows=rows, inarow=inarow, label_depth=label_depth)
+    if meta_path.exists():
+        with open(meta_path) as f:
+            previous: dict[str, Optional[int]] = json.load(f)
+        if any(previous.get(key) != value for key, value in meta.items()):
+            raise click.UsageError(f"{outdir} already has shards generated with {previous}")
+
+    seen = load_seen_keys(outdir)
+    writer = ShardWriter(outdir, record_dtype(columns, rows), shard_size, start_index=len(shard_paths(outdir)))
+    n_positions = 0
+    n_new = 0
+    with multiprocessing.Pool(workers) as pool:
+        for batch_start in range(0, games, batch_games):
+            tasks: list[GameTask] = [
+                (columns, rows, inarow, first, second, epsilon, seed * games + game_idx)
+                for game_idx in range(batch_start, min(batch_start + batch_games, games))
+            ]
+            new_positions: list[Position] = []
+            for positions in pool.imap_unordered(play_game, tasks):
+                n_positions += len(positions)
+                for position in positions:
+                    key = connectx_game.canonical_key(np.asarray(position.board).reshape(rows, columns))
+                    if key not in seen:
+                        seen.add(key)
+                        new_positions.append(position)
+
+            label_tasks: list[LabelTask] = [
+                (columns, rows, inarow, p.board, p.next_player, label_depth) for p in new_positions
+            ]
+            values = pool.map(label_position, label_tasks, chunksize=max(1, len(label_tasks) // (workers * 4)))
+
+            records = np.zeros(len(new_positions), dtype=record_dtype(columns, rows))
+            records["board"] = np.asarray([p.board for p in new_positions], dtype=np.int8).reshape(-1, rows, columns)
+            records["next_player"] = [p.next_player for p in new_positions]
+            records["step"] = [p.step for p in new_positions]
+            records["outcome"] = [p.outcome for p in new_positions]
+            records["value"] = values
+            writer.add(records)
+            n_new += len(records)
+            print(f"{batch_start + len(tasks)}/{games} games, {n_new} new unique positions out of {n_positions}")
+    writer.close()
+
+    with open(meta_path, "w") as f:
+        json.dump(dict(meta, first=first, second=second, epsilon=epsilon), f)
+    print(f"wrote {len(writer.paths)} shards to {outdir}")
+
+
+if __name__ == "__main__":
+    main()
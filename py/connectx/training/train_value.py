@@ -0,0 +1,118 @@
+"""selfplay の shard から value_model.ValueModel を学習し、重みを .npz に書き出す
+
+目的変数は終局の結果 (player から見て 1: 勝ち, 0: 引き分け, -1: 負け)。左右反転した局面も同じ結果として学習に使う。
+NumPy だけで mini-batch の Adam を回す。
+
+usage: python -m connectx.training.train_value <shards_dir> <out.npz> [--hidden 128,64] [--epochs 10]
+"""
+
+from __future__ import annotations
+
+from pathlib import Path
+import json
+
+import click
+import numpy as np
+
+from connectx.training import selfplay
+from connectx.tutorial import value_model
+
+
+class Adam:
+    def __init__(self, params: list[np.ndarray], lr: float, beta1: float = 0.9, beta2: float = 0.999) -> None:
+        self._params = params
+        self._lr = lr
+        self._beta1 = beta1
+        self._beta2 = beta2
+        self._m = [np.zeros_like(p) for p in params]
+        self._v = [np.zeros_like(p) for p in params]
+        self._t = 0
+
+    def step(self, grads: list[np.ndarray]) -> None:
+        self._t += 1
+        for p, g, m, v in zip(self._params, grads, self._m, self._v):
+            m *= self._beta1
+            m += (1 - self._beta1) * g
+            v *= self._beta2
+            v += (1 - self._beta2) * g * g
+            m_hat = m / (1 - self._beta1**self._t)
+            v_hat = v / (1 - self._beta2**self._t)
+            p -= self._lr * m_hat / (np.sqrt(v_hat) + 1e-8)
+
+
+def backward(
+    model: value_model.ValueModel, activations: list[np.ndarray], target: np.ndarray
+) -> tuple[float, list[np.ndarray], list[np.ndarray]]:
+    """平均二乗誤差とその各層の重み・バイアスに対する勾配"""
+    prediction = activations[-1][:, 0]
+    diff = prediction - target
+    loss = float(np.mean(diff * diff))
+    # tanh の微分は 1 - y^2
+    delta = (2.0 * diff / len(target) * (1.0 - prediction * prediction))[:, None]
+    grad_w: list[np.ndarray] = []
+    grad_b: list[np.ndarray] = []
+    for i in reversed(range(len(model.weights))):
+        grad_w.append(activations[i].T @ delta)
+        grad_b.append(delta.sum(axis=0))
+        if i > 0:
+            delta = (delta @ model.weights[i].T) * (activations[i] > 0)  # ReLU の微分
+    return loss, grad_w[::-1], grad_b[::-1]
+
+
+def load_dataset(shards_dir: Path) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """(盤面, 手番, 結果)。左右反転した局面を加えて 2 倍にする"""
+    shards = selfplay.load_shards(shards_dir)
+    if len(shards) == 0:
+        raise click.UsageError(f"no shards in {shards_dir}")
+    grids = np.concatenate([shard["board"] for shard in shards])
+    next_players = np.concatenate([shard["next_player"] for shard in shards])
+    outcomes = np.concatenate([shard["outcome"] for shard in shards]).astype(np.float32)
+    return (
+        np.concatenate([grids, grids[:, :, ::-1]]),
+        np.concatenate([next_players, next_players]),
+        np.concatenate([outcomes, outcomes]),
+    )
+
+
+@click.command()
+@click.argument("shards_dir", type=click.Path(exists=True, file_okay=False, path_type=Path))
+@click.argument("out", type=click.Path(dir_okay=False, path_type=Path))
+@click.option("--hidden", type=click.STRING, default="128,64", show_default=True, help="hidden layer sizes")
+@click.option("--epochs", type=click.INT, default=10, show_default=True)
+@click.option("--batch-size", type=click.INT, default=256, show_default=True)
+@click.option("--lr", type=click.FLOAT, default=1e-3, show_default=True)
+@click.option("--valid-fraction", type=click.FLOAT, default=0.1, show_default=True)
+@click.option("--seed", type=click.INT, default=0, show_default=True)
+def main(
+    shards_dir: Path, out: Path, hidden: str, epochs: int, batch_size: int, lr: float, valid_fraction: float, seed: int
+) -> None:
+    with open(shards_dir / "meta.json") as f:
+        meta = json.load(f)
+    grids, next_players, outcomes = load_dataset(shards_dir)
+    x = value_model.features(grids, next_players)
+
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(x))
+    n_valid = int(len(x) * valid_fraction)
+    valid_idx, train_idx = order[:n_valid], order[n_valid:]
+
+    layer_sizes = [x.shape[1]] + [int(size) for size in hidden.split(",") if size] + [1]
+    model = value_model.ValueModel.random(layer_sizes, seed=seed)
+    optimizer = Adam(model.weights + model.biases, lr=lr)
+    for epoch in range(epochs):
+        rng.shuffle(train_idx)
+        losses = []
+        for start in range(0, len(train_idx), batch_size):
+            batch = train_idx[start : start + batch_size]
+            loss, grad_w, grad_b = backward(model, model.forward(x[batch]), outcomes[batch])
+            optimizer.step(grad_w + grad_b)
+            losses.append(loss)
+        valid_loss = float(np.mean((model.predict(x[valid_idx]) - outcomes[valid_idx]) ** 2)) if n_valid > 0 else 0.0
+        print(f"epoch {epoch + 1}: train {np.mean(losses):.4f}, valid {valid_loss:.4f}")
+
+    model.save(out)
+    print(f"saved a {meta['rows']}x{meta['columns']} value model to {out}")
+
+
+if __name__ == "__main__":
+    main()
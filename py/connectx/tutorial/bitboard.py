@@ -0,0 +1,155 @@
+"""大きな盤面用の bitboard (Python の int なので 64 マスを超えても使える) と、line potential による候補手の絞り込み
+
+bit の位置は connectx_game.position_key と同じで、列ごとに下から (rows + 1) bit を使う (一番上の 1 bit は常に 0 の番兵)。
+番兵があるので、縦・横・斜めの並びをシフトと AND だけで調べても列をまたいで誤検出しない。
+
+局面は (current, mask) の組で表す。current は手番側の石、mask は両者の石。
+"""
+
+from __future__ import annotations
+
+from collections.abc import Sequence
+import functools
+
+import numpy as np
+
+from connectx.tutorial import connectx_game
+
+WIN_SCORE = 1_000_000.0
+
+
+@functools.lru_cache(maxsize=None)
+def _potential_weights(inarow: int) -> tuple[float, ...]:
+    """window に自分の石が n 個あり、相手の石がないときの重み。あと 1 石のものを特に重くする"""
+    weights = [0.0] + [4.0**n for n in range(1, inarow)] + [WIN_SCORE]
+    weights[inarow - 1] *= 4
+    return tuple(weights)
+
+
+def popcount(x: int) -> int:
+    return bin(x).count("1")
+
+
+class BitBoard:
+    """盤面の大きさごとに 1 つ作り、マスク類を使い回す"""
+
+    def __init__(self, columns: int, rows: int, inarow: int) -> None:
+        self.columns = columns
+        self.rows = rows
+        self.inarow = inarow
+        self.height = rows + 1  # 番兵を含めた 1 列の bit 数
+        self.bottom = sum(1 << (col * self.height) for col in range(columns))
+        self.board_mask = self.bottom * ((1 << rows) - 1)
+        self.column_masks = [((1 << rows) - 1) << (col * self.height) for col in range(columns)]
+        self.top_masks = [1 << (rows - 1 + col * self.height) for col in range(columns)]
+        self.weights = _potential_weights(inarow)
+        windows = connectx_game.window_indices(columns, rows, inarow).tolist()
+        self.windows = [sum(1 << self._bit_of(cell // columns, cell % columns) for cell in w) for w in windows]
+        self.cell_windows: dict[int, list[int]] = {}
+        for w_mask, w in zip(self.windows, windows):
+            for cell in w:
+                self.cell_windows.setdefault(self._bit_of(cell // columns, cell % columns), []).append(w_mask)
+
+    def _bit_of(self, row: int, col: int) -> int:
+        """grid の (row, col) (row は上から数える) に対応する bit の位置"""
+        return col * self.height + (self.rows - 1 - row)
+
+    def from_grid(self, grid: np.ndarray, next_player: int) -> tuple[int, int]:
+        current = 0
+        mask = 0
+        for row, col in zip(*np.nonzero(grid)):
+            bit = 1 << self._bit_of(int(row), int(col))
+            mask |= bit
+            if grid[row, col] == next_player:
+                current |= bit
+        return current, mask
+
+    def can_play(self, mask: int, col: int) -> bool:
+        return (mask & self.top_masks[col]) == 0
+
+    def legal_columns(self, mask: int) -> list[int]:
+        return [col for col in range(self.columns) if (mask & self.top_masks[col]) == 0]
+
+    def move_bit(self, mask: int, col: int) -> int:
+        """col に置いたときに石が入る bit"""
+        return (mask + (1 << (col * self.height))) & self.column_masks[col]
+
+    def play(self, current: int, mask: int, col: int) -> tuple[int, int]:
+        """col に置いた後の (current, mask)。current は次の手番側 (= 相手) の石になる"""
+        new_mask = mask | self.move_bit(mask, col)
+        return current ^ mask, new_mask
+
+    def is_win(self, stones: int) -> bool:
+        for shift in (1, self.height, self.height + 1, self.height - 1):
+            run = stones
+            for i in range(1, self.inarow):
+                run &= stones >> (shift * i)
+                if run == 0:
+                    break
+            if run != 0:
+                return True
+        return False
+
+    def is_full(self, mask: int) -> bool:
+        return mask == self.board_mask
+
+    def evaluate(self, current: int, mask: int) -> float:
+        """手番側から見た line potential の差"""
+        opponent = current ^ mask
+        score = 0.0
+        for w in self.windows:
+            mine = w & current
+            theirs = w & opponent
+            if mine and not theirs:
+                score += self.weights[popcount(mine)]
+            elif theirs and not mine:
+                score -= self.weights[popcount(theirs)]
+        return score
+
+    def move_potential(self, current: int, mask: int, col: int) -> float:
+        """col に置くことで伸ばせる自分の line と、塞げる相手の line の重みの合計"""
+        bit = self.move_bit(mask, col)
+        opponent = current ^ mask
+        potential = 0.0
+        for w in self.cell_windows[bit.bit_length() - 1]:
+            mine = w & current
+            theirs = w & opponent
+            if not theirs:
+                potential += self.weights[popcount(mine) + 1]
+            if not mine:
+                potential += self.weights[popcount(theirs) + 1]
+        return potential
+
+    def candidates(self, current: int, mask: int, max_candidates: int) -> list[int]:
+        """
+        line potential の大きい順に最大 max_candidates 列を返す。
+        すぐ勝てる手があればそれだけを、相手のすぐ勝てるマスを塞ぐ手があればそれを必ず含める
+        """
+        columns = self.legal_columns(mask)
+        opponent = current ^ mask
+        forced = []
+        for col in columns:
+            bit = self.move_bit(mask, col)
+            if self.is_win(current | bit):
+                return [col]
+            if self.is_win(opponent | bit):
+                forced.append(col)
+        if len(forced) > 0:
+            return forced
+        ranked = sorted(columns, key=lambda col: -self.move_potential(current, mask, col))
+        return ranked[:max_candidates]
+
+
+class CandidateFilter:
+    """MCTS の action_filter に渡す、line potential で候補手を絞り込む関数"""
+
+    def __init__(self, columns: int, rows: int, inarow: int, max_candidates: int = 5) -> None:
+        self._bitboard = BitBoard(columns, rows, inarow)
+        self._max_candidates = max_candidates
+
+    def __call__(
+        self, state: connectx_game.ConnectXState, actions: Sequence[connectx_game.ConnectXAction]
+    ) -> list[connectx_game.ConnectXAction]:
+        current, mask = self._bitboard.from_grid(state.grid, state.next_player)
+        keep = set(self._bitboard.candidates(current, mask, self._max_candidates))
+        return [action for action in actions if action.col in keep]
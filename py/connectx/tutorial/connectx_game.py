@@ -4,11 +4,16 @@ from collections.abc import Iterable, Sequence
 from typing import Callable, Optional
 
 import dataclasses
+import functools
 import itertools
 
 import numpy as np
 from numpy.lib.stride_tricks import sliding_window_view
-from typing_extensions import Literal
+
+try:
+    from typing import Literal
+except ImportError:  # python 3.7 では typing_extensions が必要
+    from typing_extensions import Literal  # type: ignore
 
 from connectx.gamesolver import game
 
@@ -28,6 +33,7 @@ class Config:
     columns: int
     rows: int
     inarow: int
+    actTimeout: float = 2.0
 
 
 class ConnectXState(game.State):
@@ -35,6 +41,14 @@ class ConnectXState(game.State):
         self.grid = grid
         self.next_player = next_player
         self.step = step
+        self._legal_mask: Optional[int] = None
+
+    @property
+    def legal_mask(self) -> int:
+        """石を置ける列の bitmask (bit c が立っていれば列 c に置ける)。初回アクセス時に計算してキャッシュする"""
+        if self._legal_mask is None:
+            self._legal_mask = sum(1 << int(c) for c in np.flatnonzero(self.grid[0] == 0))
+        return self._legal_mask
 
     @property
     def next_turn(self) -> game.Turn:
@@ -47,6 +61,42 @@ class ConnectXState(game.State):
         return "\n".join("".join(str(x) for x in row) for row in self.grid.tolist())
 
 
+class ConnectXSearchState(ConnectXState):
+    """play/undo で grid を in-place に書き換える探索用の state"""
+
+    def __init__(self, grid: np.ndarray, next_player: Mark, step: int) -> None:
+        super().__init__(grid, next_player, step)
+        self.heights = [int(h) for h in np.count_nonzero(grid, axis=0)]
+        self.moves: list[tuple[int, int]] = []  # (row, col)
+        self._legal_mask = self.legal_mask  # 以降は play/undo で更新する
+
+    @property
+    def last_move(self) -> Optional[tuple[int, int]]:
+        return self.moves[-1] if len(self.moves) > 0 else None
+
+    def play(self, col: int) -> None:
+        rows = self.grid.shape[0]
+        if self.heights[col] >= rows:
+            raise RuntimeError("Not playable")
+        row = rows - 1 - self.heights[col]
+        self.grid[row, col] = self.next_player
+        self.heights[col] += 1
+        if row == 0:
+            self._legal_mask = self.legal_mask & ~(1 << col)
+        self.moves.append((row, col))
+        self.next_player = 1 if self.next_player == 2 else 2
+        self.step += 1
+
+    def undo(self) -> None:
+        row, col = self.moves.pop()
+        self.grid[row, col] = 0
+        self.heights[col] -= 1
+        if row == 0:
+            self._legal_mask = self.legal_mask | (1 << col)
+        self.next_player = 1 if self.next_player == 2 else 2
+        self.step -= 1
+
+
 class ConnectXResult(game.Result):
     def __init__(self, winner: Optional[game.Turn]) -> None:
         self._winner = winner
@@ -63,6 +113,15 @@ class ConnectXAction(game.Action):
         self.col = col
         self._turn = turn
 
+    @classmethod
+    def of(cls, col: int, turn: game.Turn) -> ConnectXAction:
+        """(col, turn) ごとに使い回される ConnectXAction を返す"""
+        key = (col, turn)
+        action = _interned_actions.get(key)
+        if action is None:
+            action = _interned_actions[key] = cls(col, turn)
+        return action
+
     def __str__(self) -> str:
         return f"col={self.col}"
 
@@ -77,11 +136,16 @@ class ConnectXAction(game.Action):
     def __hash__(self) -> int:
         return self.col
 
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, ConnectXAction):
+            return NotImplemented
+        return self.col == other.col and self.turn == other.turn
+
     def __repr__(self) -> str:
         return f"ConnectXAction<col={self.col}>"
 
 
-class ConnectXGame(game.Game[ConnectXState, ConnectXResult, ConnectXAction]):
+class ConnectXGame(game.InPlaceGame[ConnectXState, ConnectXResult, ConnectXAction]):
     def __init__(self, columns: int, rows: int, inarow: int) -> None:
         self.columns = columns
         self.rows = rows
@@ -92,17 +156,26 @@ class ConnectXGame(game.Game[ConnectXState, ConnectXResult, ConnectXAction]):
         state が最終状態 (それ以上手がない) であれば Result を返す。
         そうでない場合、None を返す。
         """
-        for window in generate_windows(state.grid, self.inarow):
-            if (window == 1).sum() == self.inarow:
-                return ConnectXResult(winner=game.Turn.PLAYER)
-            elif (window == 2).sum() == self.inarow:
-                return ConnectXResult(winner=game.Turn.OPPONENT)
-        if len(self.get_available_actions(state)) == 0:  # draw
+        if isinstance(state, ConnectXSearchState) and state.last_move is not None:
+            # 探索中は直前の手を通る line だけ見ればよい
+            row, col = state.last_move
+            if is_winning_move(state.grid, row, col, self.inarow):
+                return ConnectXResult(winner=game.Turn.PLAYER if state.grid[row, col] == 1 else game.Turn.OPPONENT)
+            if min(state.heights) >= self.rows:  # draw
+                return ConnectXResult(winner=None)
+            return None
+        windows = get_windows(state.grid, self.inarow)
+        if (windows == 1).all(axis=1).any():
+            return ConnectXResult(winner=game.Turn.PLAYER)
+        if (windows == 2).all(axis=1).any():
+            return ConnectXResult(winner=game.Turn.OPPONENT)
+        if state.legal_mask == 0:  # draw
             return ConnectXResult(winner=None)
         return None
 
     def get_available_actions(self, state: ConnectXState) -> list[ConnectXAction]:
-        return [ConnectXAction(c, state.next_turn) for c in range(self.columns) if state.grid[0][c] == 0]
+        """返り値の list は同じ (legal_mask, 手番) の state 間で共有されるので、呼び出し側で変更しないこと"""
+        return actions_from_mask(state.legal_mask, state.next_turn)
 
     def step(self, state: ConnectXState, action: ConnectXAction) -> ConnectXState:
         row = get_playable_row(state.grid[:, action.col])
@@ -110,7 +183,116 @@ class ConnectXGame(game.Game[ConnectXState, ConnectXResult, ConnectXAction]):
         next_grid = state.grid.copy()
         next_grid[row, action.col] = state.next_player
         next_player: Literal[1, 2] = 1 if state.next_player == 2 else 2
-        return ConnectXState(next_grid, next_player, state.step + 1)
+        next_state = ConnectXState(next_grid, next_player, state.step + 1)
+        next_state._legal_mask = state.legal_mask & ~(1 << action.col) if row == 0 else state.legal_mask
+        return next_state
+
+    def step_many(self, states: Sequence[ConnectXState], actions: Sequence[ConnectXAction]) -> list[ConnectXState]:
+        """
+        全ての盤面を 1 つの (N, rows, columns) 配列にまとめて、石を一度に置く。
+        返す state の grid はその配列の view なので、書き換えないこと (in-place に使うなら to_search_state で複製する)
+        """
+        if len(states) == 0:
+            return []
+        grids = np.stack([state.grid for state in states])
+        marks = np.array([state.next_player for state in states])
+        next_states, _ = self._place_many(states, grids, marks, actions)
+        return next_states
+
+    def get_result_many(self, states: Sequence[ConnectXState]) -> list[Optional[ConnectXResult]]:
+        if len(states) == 0:
+            return []
+        grids = np.stack([state.grid for state in states])
+        windows = get_windows_batch(grids, self.inarow)
+        player_won = (windows == 1).all(axis=-1).any(axis=-1).tolist()
+        opponent_won = (windows == 2).all(axis=-1).any(axis=-1).tolist()
+        results: list[Optional[ConnectXResult]] = []
+        for state, p, o in zip(states, player_won, opponent_won):
+            if p:
+                results.append(ConnectXResult(winner=game.Turn.PLAYER))
+            elif o:
+                results.append(ConnectXResult(winner=game.Turn.OPPONENT))
+            elif state.legal_mask == 0:  # draw
+                results.append(ConnectXResult(winner=None))
+            else:
+                results.append(None)
+        return results
+
+    def expand_all(
+        self, state: ConnectXState, actions: Optional[Sequence[ConnectXAction]] = None
+    ) -> list[tuple[ConnectXAction, ConnectXState, Optional[ConnectXResult]]]:
+        """子の勝敗は、置いた石を通る window だけをまとめて調べて判定する (state は終局していない前提)"""
+        if actions is None:
+            actions = self.get_available_actions(state)
+        if len(actions) == 0:
+            return []
+        grids = np.repeat(state.grid[np.newaxis], len(actions), axis=0)
+        marks = np.full(len(actions), state.next_player)
+        next_states, cells = self._place_many([state] * len(actions), grids, marks, actions)
+        windows = cell_window_indices(self.columns, self.rows, self.inarow)[cells]  # (N, 窓の数, inarow)
+        flat_grids = grids.reshape(len(actions), -1)
+        won = (flat_grids[np.arange(len(actions))[:, np.newaxis, np.newaxis], windows] == state.next_player)
+        won_list = won.all(axis=-1).any(axis=-1).tolist()
+        winner = game.Turn.PLAYER if state.next_player == 1 else game.Turn.OPPONENT
+        children: list[tuple[ConnectXAction, ConnectXState, Optional[ConnectXResult]]] = []
+        for action, next_state, is_won in zip(actions, next_states, won_list):
+            if is_won:
+                result: Optional[ConnectXResult] = ConnectXResult(winner=winner)
+            elif next_state.legal_mask == 0:  # draw
+                result = ConnectXResult(winner=None)
+            else:
+                result = None
+            children.append((action, next_state, result))
+        return children
+
+    def _place_many(
+        self,
+        states: Sequence[ConnectXState],
+        grids: np.ndarray,
+        marks: np.ndarray,
+        actions: Sequence[ConnectXAction],
+    ) -> tuple[list[ConnectXState], np.ndarray]:
+        """grids (states の盤面を積んだもの) に actions の石を in-place に置き、(子の state, 置いたマスの番号) を返す"""
+        cols = np.array([action.col for action in actions])
+        batch_idx = np.arange(len(actions))
+        rows = self.rows - 1 - np.count_nonzero(grids[batch_idx, :, cols], axis=1)
+        if (rows < 0).any():
+            raise RuntimeError("Not playable")
+        grids[batch_idx, rows, cols] = marks
+        next_states = []
+        for grid, state, col, row in zip(grids, states, cols.tolist(), rows.tolist()):
+            next_player: Literal[1, 2] = 1 if state.next_player == 2 else 2
+            next_state = ConnectXState(grid, next_player, state.step + 1)
+            next_state._legal_mask = state.legal_mask & ~(1 << col) if row == 0 else state.legal_mask
+            next_states.append(next_state)
+        return next_states, rows * self.columns + cols
+
+    def to_search_state(self, state: ConnectXState) -> ConnectXSearchState:
+        return ConnectXSearchState(state.grid.copy(), state.next_player, state.step)
+
+    def play(self, state: ConnectXState, action: ConnectXAction) -> None:
+        if not isinstance(state, ConnectXSearchState):
+            raise TypeError("play requires a state made by to_search_state")
+        state.play(action.col)
+
+    def undo(self, state: ConnectXState) -> None:
+        if not isinstance(state, ConnectXSearchState):
+            raise TypeError("undo requires a state made by to_search_state")
+        state.undo()
+
+
+_interned_actions: dict[tuple[int, game.Turn], ConnectXAction] = {}
+
+
+@functools.lru_cache(maxsize=4096)
+def actions_from_mask(legal_mask: int, turn: game.Turn) -> list[ConnectXAction]:
+    actions = []
+    col = 0
+    while legal_mask >> col:
+        if (legal_mask >> col) & 1:
+            actions.append(ConnectXAction.of(col, turn))
+        col += 1
+    return actions
 
 
 def get_playable_row(col: np.ndarray) -> int:
@@ -122,12 +304,70 @@ def get_playable_row(col: np.ndarray) -> int:
     return row
 
 
+def is_winning_move(grid: np.ndarray, row: int, col: int, inarow: int) -> bool:
+    """(row, col) の石を通る line に inarow 個以上同じ石が並んでいるか"""
+    mark = grid[row, col]
+    rows, columns = grid.shape
+    for dr, dc in ((0, 1), (1, 0), (1, 1), (1, -1)):
+        count = 1
+        for sign in (1, -1):
+            r, c = row + sign * dr, col + sign * dc
+            while 0 <= r < rows and 0 <= c < columns and grid[r, c] == mark:
+                count += 1
+                r, c = r + sign * dr, c + sign * dc
+        if count >= inarow:
+            return True
+    return False
+
+
+def normalize_board(board: Sequence[int], mark: int) -> list[int]:
+    """自分 (mark) の石を 1、相手の石を 2 にそろえる"""
+    if mark == 1:
+        return list(board)
+    return [{0: 0, 1: 2, 2: 1}[x] for x in board]
+
+
+def own_view_state(obs: Observation, config: Config) -> ConnectXState:
+    """
+    obs の盤面を normalize_board で手番側 (obs.mark) の石が 1 になるようにそろえ、player (1) の手番の局面にする。
+    scorer の値・評価値キャッシュ・tablebase は player (1) から見たものなので、mark が 2 のときもこの局面で読む
+    """
+    grid = np.asarray(normalize_board(obs.board, obs.mark), dtype=np.int64).reshape(config.rows, config.columns)
+    return ConnectXState(grid, next_player=1, step=obs.step)
+
+
+def position_key(grid: np.ndarray) -> int:
+    """盤面を一意に表す整数。
+
+    列ごとに下から (rows + 1) bit を使い、player (1) の石の位置に 1 を立て、積まれた石の直上に番兵の 1 を立てる。
+    重力に従う盤面であれば衝突しない。7x6 盤なら 49 bit に収まる。
+    """
+    rows, columns = grid.shape
+    bits = np.zeros((columns, rows + 1), dtype=bool)
+    bits[:, :rows] = grid[::-1].T == 1
+    bits[np.arange(columns), np.count_nonzero(grid, axis=0)] = True
+    return int.from_bytes(np.packbits(bits.ravel(), bitorder="little").tobytes(), "little")
+
+
+def state_key(state: ConnectXState) -> int:
+    return position_key(state.grid)
+
+
+def canonical_key(grid: np.ndarray) -> int:
+    """左右反転した盤面と同じ値になる key (position_key の小さい方)"""
+    return min(position_key(grid), position_key(grid[:, ::-1]))
+
+
 def generate_horizontal_windows(grid: np.ndarray, inarow: int) -> Iterable[np.ndarray]:
-    return itertools.chain.from_iterable(sliding_window_view(row, inarow) for row in grid)  # type: ignore
+    return itertools.chain.from_iterable(
+        sliding_window_view(row, inarow) for row in grid if len(row) >= inarow  # type: ignore
+    )
 
 
 def generate_vertical_windows(grid: np.ndarray, inarow: int) -> Iterable[np.ndarray]:
-    return itertools.chain.from_iterable(sliding_window_view(col, inarow) for col in grid.T)  # type: ignore
+    return itertools.chain.from_iterable(
+        sliding_window_view(col, inarow) for col in grid.T if len(col) >= inarow  # type: ignore
+    )
 
 
 def generate_positive_diagonal_windows(grid: np.ndarray, inarow: int) -> Iterable[np.ndarray]:
@@ -155,3 +395,50 @@ def generate_windows(grid: np.ndarray, inarow: int) -> Iterable[np.ndarray]:
         generate_negative_diagonal_windows,
     )
     return itertools.chain.from_iterable(fn(grid, inarow) for fn in fns)
+
+
+@functools.lru_cache(maxsize=None)
+def window_indices(columns: int, rows: int, inarow: int) -> np.ndarray:
+    """各 window に含まれるマスの grid.ravel() での index を並べた (n_windows, inarow) の表。順序は generate_windows と同じ"""
+    cell_ids = np.arange(rows * columns).reshape(rows, columns)
+    table = np.array([window for window in generate_windows(cell_ids, inarow)], dtype=np.intp).reshape(-1, inarow)
+    table.flags.writeable = False  # cache を共有するので書き換えられないようにする
+    return table
+
+
+@functools.lru_cache(maxsize=None)
+def cell_window_indices(columns: int, rows: int, inarow: int) -> np.ndarray:
+    """
+    マスごとに、そのマスを通る window (に含まれるマスの番号) を並べた (rows * columns, 最大の窓の数, inarow) の表。
+    通る window が少ないマスは、同じ window を繰り返して埋める (勝敗の判定には影響しない)。
+    inarow が columns 以下なら横の、rows 以下なら縦の window が全てのマスを通るので、window のないマスがあるのは
+    inarow が盤面の縦横のどちらよりも大きい (誰も勝てない) ときだけで、そのときは全てのマスに window がなく、
+    表は (rows * columns, 0, inarow) になる
+    """
+    table = window_indices(columns, rows, inarow)
+    cell_windows: list[list[int]] = [[] for _ in range(rows * columns)]
+    for window_id, window in enumerate(table.tolist()):
+        for cell in window:
+            cell_windows[cell].append(window_id)
+    n_max = max(len(ws) for ws in cell_windows)
+    padded = np.zeros((rows * columns, n_max, inarow), dtype=np.intp)
+    if n_max > 0:
+        for cell, ws in enumerate(cell_windows):
+            assert len(ws) > 0  # 0 番のマスで埋めると、そのマスの石だけで勝ちと判定してしまう
+            padded[cell] = table[ws][np.arange(n_max) % len(ws)]
+    padded.flags.writeable = False
+    return padded
+
+
+def get_windows(grid: np.ndarray, inarow: int) -> np.ndarray:
+    """grid の全ての window を (n_windows, inarow) の配列として 1 回の gather で取り出す"""
+    rows, columns = grid.shape
+    windows: np.ndarray = grid.ravel()[window_indices(columns, rows, inarow)]
+    return windows
+
+
+def get_windows_batch(grids: np.ndarray, inarow: int) -> np.ndarray:
+    """(N, rows, columns) の盤面の束から、(N, n_windows, inarow) の window を取り出す"""
+    n_grids, rows, columns = grids.shape
+    windows: np.ndarray = grids.reshape(n_grids, rows * columns)[:, window_indices(columns, rows, inarow)]
+    return windows
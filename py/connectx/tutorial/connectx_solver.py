@@ -1,50 +1,68 @@
 import numpy as np
 
-from connectx.gamesolver import minimax, gametree
+from connectx.gamesolver import mcts, minimax, gametree, ordering
 from connectx.tutorial import connectx_game
 
 
 def mark_playable_grid(grid: np.ndarray) -> np.ndarray:
-    """-1: empty (playable), 0: empty (un-playable), 1: player, 2: opponent"""
-    playable_grid = grid.copy()
-    for col in range(playable_grid.shape[1]):
-        try:
-            row = connectx_game.get_playable_row(playable_grid[:, col])
-        except RuntimeError:
-            continue
-        playable_grid[row, col] = -1
+    """
+    -1: empty (playable), 0: empty (un-playable), 1: player, 2: opponent
+    grid は (rows, columns) でも (N, rows, columns) の束でもよい
+    """
+    empty = grid == 0
+    rows = grid.shape[-2]
+    # 列ごとに一番下の空きマスの行
+    lowest_empty = rows - 1 - np.argmax(empty[..., ::-1, :], axis=-2)
+    playable = np.nonzero(empty.any(axis=-2))  # (batch の index..., 列の index)
+    playable_grid: np.ndarray = grid.copy()
+    playable_grid[playable[:-1] + (lowest_empty[playable], playable[-1])] = -1
     return playable_grid
 
 
+def score_windows(windows: np.ndarray, inarow: int) -> np.ndarray:
+    """
+    mark_playable_grid した盤面の window (..., n_windows, inarow) から、盤面ごとの score (...) を求める。
+    揃った window: player +1_000_000, opponent -10_000
+    このターンで石を置ける空きマスが残り 1 つの window: player +1, opponent -100
+    """
+    n_player = (windows == 1).sum(axis=-1)
+    n_opponent = (windows == 2).sum(axis=-1)
+    # window の中にこのターンで石を置ける場所が残り 1 つで、置けない空きマスはない
+    is_open = ((windows == -1).sum(axis=-1) == 1) & ((windows == 0).sum(axis=-1) == 0)
+    score = (
+        1_000_000.0 * (n_player == inarow)
+        - 10_000.0 * (n_opponent == inarow)
+        + 1.0 * (is_open & (n_player == inarow - 1))
+        - 100.0 * (is_open & (n_opponent == inarow - 1))
+    )
+    return score.sum(axis=-1)  # type: ignore
+
+
 class ConnectXScorer(gametree.Scorer[connectx_game.ConnectXState]):
+    # 揃った window 1 つ分
+    win_score = 1_000_000.0
+    loss_score = -10_000.0
+
     def __init__(self, inarow: int) -> None:
         self.inarow = inarow
 
     def __call__(self, state: connectx_game.ConnectXState) -> float:
-        def _score_window(window: np.ndarray, inarow: int) -> float:
-            if (window == 1).sum() == inarow:
-                return 1_000_000
-            if (window == 2).sum() == inarow:
-                return -10_000
-
-            score = 0.0
-            if (window == -1).sum() == 1 and (window == 0).sum() == 0:  # 4列の中にこのターンで石を置ける場所が残り1つ
-                for color in (1, 2):
-                    if (window == color).sum() == inarow - 1:
-                        if color == 1:
-                            score += 1
-                        else:
-                            score += -100
-            return score
-
-        def score_grid(grid: np.ndarray, inarow: int) -> float:
-            score = 0.0
-            playable_grid = mark_playable_grid(grid)
-            for window in connectx_game.generate_windows(playable_grid, inarow):
-                score += _score_window(window, inarow)
-            return score
-
-        return score_grid(state.grid, self.inarow)
+        windows = connectx_game.get_windows(mark_playable_grid(state.grid), self.inarow)
+        return float(score_windows(windows, self.inarow))
+
+
+def center_first_ordering(
+    columns: int,
+) -> ordering.StaticOrdering[connectx_game.ConnectXState, connectx_game.ConnectXAction]:
+    """中央の列ほど強いので、中央から外側に向かって読む"""
+    center = (columns - 1) / 2
+    return ordering.StaticOrdering(key=lambda action: abs(action.col - center))
+
+
+def killer_history_ordering(
+    columns: int,
+) -> ordering.KillerHistoryOrdering[connectx_game.ConnectXState, connectx_game.ConnectXAction]:
+    return ordering.KillerHistoryOrdering(base=center_first_ordering(columns))
 
 
 class ConnectXMinimax(
@@ -52,11 +70,11 @@ class ConnectXMinimax(
         connectx_game.ConnectXState,
         connectx_game.ConnectXResult,
         connectx_game.ConnectXAction,
-        ConnectXScorer,
+        gametree.Scorer[connectx_game.ConnectXState],
     ]
 ):
     pass
 
 
-# class ConnectXMCTS(mcts.MCTS[connectx_game.ConnectXState, connectx_game.ConnectXAction]):
-#     pass
+class ConnectXMCTS(mcts.MCTS[connectx_game.ConnectXState, connectx_game.ConnectXResult, connectx_game.ConnectXAction]):
+    pass
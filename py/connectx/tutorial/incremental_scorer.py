@@ -0,0 +1,169 @@
+"""ConnectXScorer と同じ score を、盤面の差分だけから更新して求める scorer
+
+window (inarow 個の連続したマス) ごとに両者の石の数を持っておき、石が置かれた/取り除かれたときは
+そのマスを通る window と、打てるマスが移動した列の window だけを計算し直す。
+"""
+
+from __future__ import annotations
+
+from typing import Optional
+import dataclasses
+import functools
+
+import numpy as np
+
+from connectx.gamesolver import gametree
+from connectx.tutorial import connectx_game
+
+
+@dataclasses.dataclass
+class Threats:
+    """あと 1 石で inarow が揃う空きマス (= threat) の数。key は mark"""
+
+    immediate: dict[int, int]  # 今すぐ打てる threat
+    odd: dict[int, int]  # 下から数えて奇数段目 (1, 3, 5, ...) の threat
+    even: dict[int, int]  # 下から数えて偶数段目の threat
+
+
+@functools.lru_cache(maxsize=None)
+def window_table(
+    columns: int, rows: int, inarow: int
+) -> tuple[tuple[tuple[int, ...], ...], tuple[tuple[int, ...], ...]]:
+    """(各 window に含まれるマスの番号, 各マスを通る window の番号) を返す。マスの番号は grid.ravel() の index"""
+    windows = tuple(tuple(window) for window in connectx_game.window_indices(columns, rows, inarow).tolist())
+    cell_windows: list[list[int]] = [[] for _ in range(rows * columns)]
+    for window_id, window in enumerate(windows):
+        for cell in window:
+            cell_windows[cell].append(window_id)
+    return windows, tuple(tuple(ws) for ws in cell_windows)
+
+
+class IncrementalScorer(gametree.Scorer[connectx_game.ConnectXState]):
+    # ConnectXScorer と同じく、揃った window 1 つ分
+    win_score = 1_000_000.0
+    loss_score = -10_000.0
+
+    def __init__(self, columns: int, rows: int, inarow: int) -> None:
+        self.columns = columns
+        self.rows = rows
+        self.inarow = inarow
+        self._windows, self._cell_windows = window_table(columns, rows, inarow)
+        self._window_cell_sums = [sum(window) for window in self._windows]
+        self.reset()
+
+    def reset(self, grid: Optional[np.ndarray] = None) -> None:
+        n_windows = len(self._windows)
+        self._grid = np.zeros(self.rows * self.columns, dtype=np.int8)
+        self._heights = [0] * self.columns
+        self._n_discs = {1: [0] * n_windows, 2: [0] * n_windows}
+        self._filled_cell_sums = [0] * n_windows
+        self._contributions = [0.0] * n_windows
+        self._score = 0.0
+        if grid is not None:
+            self._update([(cell, int(value)) for cell, value in enumerate(grid.ravel()) if value != 0])
+
+    @property
+    def score(self) -> float:
+        return self._score
+
+    def play(self, col: int, mark: connectx_game.Mark) -> None:
+        row = self.rows - 1 - self._heights[col]
+        if row < 0:
+            raise RuntimeError("Not playable")
+        self._update([(row * self.columns + col, mark)])
+
+    def undo(self, col: int) -> None:
+        row = self.rows - self._heights[col]
+        if row >= self.rows:
+            raise RuntimeError("Column is empty")
+        self._update([(row * self.columns + col, 0)])
+
+    def __call__(self, state: connectx_game.ConnectXState) -> float:
+        """保持している盤面と state.grid の差分だけを反映して score を返す"""
+        grid = state.grid.ravel()
+        changed = np.flatnonzero(grid != self._grid)
+        if len(changed) > 0:
+            self._update([(int(cell), int(grid[cell])) for cell in changed])
+        return self._score
+
+    def threats(self) -> Threats:
+        immediate: dict[int, set[int]] = {1: set(), 2: set()}
+        odd: dict[int, set[int]] = {1: set(), 2: set()}
+        even: dict[int, set[int]] = {1: set(), 2: set()}
+        for window_id in range(len(self._windows)):
+            empty = self._single_empty_cell(window_id)
+            if empty is None:
+                continue
+            for mark in (1, 2):
+                if self._n_discs[mark][window_id] != self.inarow - 1:
+                    continue
+                if self._is_playable(empty):
+                    immediate[mark].add(empty)
+                if (self.rows - empty // self.columns) % 2 == 1:
+                    odd[mark].add(empty)
+                else:
+                    even[mark].add(empty)
+        return Threats(
+            immediate={mark: len(cells) for mark, cells in immediate.items()},
+            odd={mark: len(cells) for mark, cells in odd.items()},
+            even={mark: len(cells) for mark, cells in even.items()},
+        )
+
+    def _update(self, changes: list[tuple[int, int]]) -> None:
+        affected: set[int] = set()
+        columns: set[int] = set()
+        for cell, value in changes:
+            old = int(self._grid[cell])
+            if old == value:
+                continue
+            for window_id in self._cell_windows[cell]:
+                if old != 0:
+                    self._n_discs[old][window_id] -= 1
+                    self._filled_cell_sums[window_id] -= cell
+                if value != 0:
+                    self._n_discs[value][window_id] += 1
+                    self._filled_cell_sums[window_id] += cell
+            self._grid[cell] = value
+            affected.update(self._cell_windows[cell])
+            columns.add(cell % self.columns)
+        # 打てるマスが移動した列は、移動前後のマスを通る window の score も変わる
+        for col in columns:
+            before = self._playable_cell(col)
+            self._heights[col] = int(np.count_nonzero(self._grid[col :: self.columns]))
+            after = self._playable_cell(col)
+            for moved in (before, after):
+                if moved is not None:
+                    affected.update(self._cell_windows[moved])
+        for window_id in affected:
+            contribution = self._score_window(window_id)
+            self._score += contribution - self._contributions[window_id]
+            self._contributions[window_id] = contribution
+
+    def _playable_cell(self, col: int) -> Optional[int]:
+        height = self._heights[col]
+        if height >= self.rows:
+            return None
+        return (self.rows - 1 - height) * self.columns + col
+
+    def _is_playable(self, cell: int) -> bool:
+        return self._playable_cell(cell % self.columns) == cell
+
+    def _single_empty_cell(self, window_id: int) -> Optional[int]:
+        if self._n_discs[1][window_id] + self._n_discs[2][window_id] != self.inarow - 1:
+            return None
+        return self._window_cell_sums[window_id] - self._filled_cell_sums[window_id]
+
+    def _score_window(self, window_id: int) -> float:
+        """ConnectXScorer の _score_window と同じ値を返す"""
+        if self._n_discs[1][window_id] == self.inarow:
+            return 1_000_000
+        if self._n_discs[2][window_id] == self.inarow:
+            return -10_000
+        empty = self._single_empty_cell(window_id)
+        if empty is None or not self._is_playable(empty):
+            return 0.0
+        if self._n_discs[1][window_id] == self.inarow - 1:
+            return 1
+        if self._n_discs[2][window_id] == self.inarow - 1:
+            return -100
+        return 0.0
@@ -1,65 +1,169 @@
 import json
-import random
 from pathlib import Path
 from typing import Optional
 import time
 
-import numpy as np
-
-from connectx.gamesolver import gametree
-from connectx.tutorial import connectx_game, connectx_solver
+from connectx.gamesolver import mcts, pondering
+from connectx.tutorial import (
+    bitboard,
+    connectx_game,
+    connectx_solver,
+    scalable_search,
+    tablebase,
+    tactics,
+    time_manager,
+    value_model,
+)
 
 
 class Agent:
     _game: Optional[connectx_game.ConnectXGame]
     _scorer: Optional[connectx_solver.ConnectXScorer]
     _mcts: Optional[connectx_solver.ConnectXMCTS]
-
-    def __init__(self, depth: int, outdir: Optional[Path]) -> None:
-        self._depth = depth
+    _tactics: Optional[tactics.Tactics]
+    _ponderer: Optional[
+        pondering.Ponderer[connectx_game.ConnectXState, connectx_game.ConnectXResult, connectx_game.ConnectXAction]
+    ]
+
+    def __init__(
+        self,
+        n_playouts: int,
+        outdir: Optional[Path],
+        time_limit: Optional[float] = None,
+        timer: Optional[time_manager.TimeManager] = None,
+        ponder: bool = False,
+        max_nodes: Optional[int] = None,
+        tablebase_path: Optional[Path] = None,
+        value_weights: Optional[Path] = None,
+        eval_batch_size: int = 16,
+    ) -> None:
+        """
+        timer を渡すと、time_limit の代わりに timer が決めた持ち時間で探索を打ち切る。
+        ponder=True のときは、手を返した後も相手の手番の間に探索を続け、次の手番でその木を引き継ぐ。
+        試合が終わったら close を呼んで pondering を止めること (新しい試合の最初の手番でも止める)。
+        max_nodes を渡すと、探索木の node 数をそれ以下に抑える (大きな盤面で長く読むとき用)。
+        tablebase_path を渡すと、載っている局面は展開時に勝敗を確定させ、playout もそこで打ち切る。
+        value_weights (value_model.ValueModel の重み) を渡すと、ランダムプレイアウトの代わりにそのモデルで葉を評価する。
+        葉は eval_batch_size 個ずつ集めてまとめて評価する。
+        盤面が大きいとき (scalable_search.is_large_board) は、line potential で絞った候補手の子だけを展開する。
+        探索の前に tactics.Tactics で勝ち・塞ぐべき手を判定し、決まらなければ root の候補手を絞って探索する。
+        """
+        self._n_playouts = n_playouts
+        self._time_limit = time_limit
+        self._timer = timer
+        self._ponder = ponder
+        self._max_nodes = max_nodes
+        self._tablebase = None if tablebase_path is None else tablebase.Tablebase(tablebase_path)
+        self._value_weights = value_weights
+        self._eval_batch_size = eval_batch_size
         self._outdir = outdir
 
         self._game = None
         self._scorer = None
         self._mcts = None
-
-    def _call_core(self, state: connectx_game.ConnectXState) -> connectx_game.ConnectXAction:
+        self._tactics = None
+        self._ponderer = None
+        self._last_step: Optional[int] = None
+
+    def close(self) -> None:
+        """pondering を止める。試合が終わったとき (相手の手で終わり、次の手番が来ないときも) に呼ぶ"""
+        if self._ponderer is not None:
+            self._ponderer.stop()
+
+    def _call_core(
+        self,
+        state: connectx_game.ConnectXState,
+        root_actions: list[connectx_game.ConnectXAction],
+        time_limit: Optional[float],
+    ) -> connectx_game.ConnectXAction:
         start = time.time()
 
         assert self._mcts is not None
-        root_node = self._mcts(self._depth, state)
+        reused = None if self._ponderer is None else self._ponderer.promote(state)
+        root_node = self._mcts.search(
+            state, max_playouts=self._n_playouts, time_limit=time_limit, root=reused, root_actions=root_actions
+        )
 
         self._dump_gametree(root_node)
 
-        shuf = list(range(len(root_node.children)))
-        random.shuffle(shuf)
-        r_children = [root_node.children[s] for s in shuf]
-        scores = [node.score for node in r_children]
-        actions = [node.parent_edge.action for node in r_children if node.parent_edge is not None]
-
-        assert len(scores) == len(actions)
+        progress = self._mcts.current_progress()
+        assert progress is not None
+        memory = self._mcts.memory_usage()
 
         end = time.time()
-        print(end - start)
-        return actions[np.argmax(scores)]
+        print(f"{end - start:.3f}s, {progress.n_playouts} playouts, confidence {progress.confidence:.2f}", end="")
+        print(f", {memory.n_nodes} nodes (~{memory.n_bytes / 2**20:.1f}MiB, pruned {memory.n_pruned})", end="")
+        print("" if reused is None else f", reused {reused.n_visits} playouts from pondering")
+        if self._ponderer is not None:
+            for child in root_node.children:
+                if child.parent_edge is not None and child.parent_edge.action == progress.action:
+                    self._ponderer.start(child)
+        return progress.action
 
     def __call__(self, obs: connectx_game.Observation, config: connectx_game.Config) -> int:
-        if (self._game is None) or (self._scorer is None) or (self._mcts is None):
+        if (self._game is None) or (self._mcts is None):
             self._game = connectx_game.ConnectXGame(config.columns, config.rows, config.inarow)
-            self._mcts = connectx_solver.ConnectXMCTS(self._game)
-
-        grid = np.asarray(obs.board).reshape(config.rows, config.columns)
-        state = connectx_game.ConnectXState(grid, next_player=1, step=obs.step)
-
-        best_action = self._call_core(state)
+            self._tactics = tactics.Tactics(self._game)
+            oracle = None
+            if self._tablebase is not None and self._tablebase.matches(config.columns, config.rows, config.inarow):
+                oracle = self._tablebase.probe_state
+            action_filter = None
+            if scalable_search.is_large_board(config.columns, config.rows):
+                action_filter = bitboard.CandidateFilter(config.columns, config.rows, config.inarow)
+            evaluator = None
+            if self._value_weights is not None:
+                evaluator = value_model.ValueScorer.load(
+                    self._value_weights, config.columns, config.rows, config.inarow
+                )
+            self._mcts = connectx_solver.ConnectXMCTS(
+                self._game,
+                max_nodes=self._max_nodes,
+                evaluator=evaluator,
+                eval_batch_size=self._eval_batch_size,
+                oracle=oracle,
+                action_filter=action_filter,
+            )
+            if self._ponder:
+                self._ponderer = pondering.Ponderer(self._mcts, key=connectx_game.state_key)
+
+        if self._last_step is not None and obs.step <= self._last_step:
+            # 前の試合の pondering が残っていれば止める
+            self.close()
+        self._last_step = obs.step
+
+        # evaluator・tablebase は player (1) から見た値なので、手番側の石を 1 にそろえて読む
+        state = connectx_game.own_view_state(obs, config)
+        assert self._tactics is not None
+        tactical = self._tactics.analyze(state)
+        if tactical.forced is not None:
+            if self._ponderer is not None:
+                self._ponderer.stop()
+            return tactical.forced
+        root_actions = self._tactics.candidate_actions(state, tactical)
+
+        if self._timer is None:
+            best_action = self._call_core(state, root_actions, self._time_limit)
+            return best_action.col
+        start = time.perf_counter()
+        budget = self._timer.budget(
+            act_timeout=config.actTimeout,
+            remaining_overage=obs.remainingOverageTime,
+            n_cells=config.rows * config.columns,
+            complexity=time_manager.measure_complexity(state, config.inarow),
+        )
+        best_action = self._call_core(state, root_actions, budget - (time.perf_counter() - start))
+        self._timer.record(step=obs.step, planned=budget, actual=time.perf_counter() - start)
         return best_action.col
 
     def _dump_gametree(
-        self, root_node: gametree.Node[connectx_game.ConnectXState, connectx_game.ConnectXAction]
+        self,
+        root_node: mcts.MCTSNode[
+            connectx_game.ConnectXState, connectx_game.ConnectXResult, connectx_game.ConnectXAction
+        ],
     ) -> None:
         if self._outdir is None:
             return
         dumpdir = self._outdir / "tree"
         dumpdir.mkdir(exist_ok=True)
         with open(dumpdir / f"{str(root_node.state.step)}.json", "w") as f:
-            json.dump(root_node.to_dict(), f)
+            json.dump(mcts.to_dict(root_node), f)
@@ -1,42 +1,258 @@
 import json
 from pathlib import Path
-from typing import Optional
+from typing import Any, Optional
+import time
 
 import numpy as np
 
-from connectx.gamesolver import gametree, minimax
-from connectx.tutorial import connectx_game, connectx_solver
+from connectx.gamesolver import gametree, minimax, ordering, scorecache
+from connectx.tutorial import (
+    connectx_game,
+    connectx_solver,
+    incremental_scorer,
+    scalable_search,
+    tablebase,
+    tactics,
+    time_manager,
+    value_model,
+)
+
+
+def eval_cache_meta(config: connectx_game.Config) -> dict[str, Any]:
+    """warm cache の評価値を作ったときの設定。CachedScorer.save に渡し、WarmCache を読むときに照合する"""
+    return dict(
+        columns=config.columns,
+        rows=config.rows,
+        inarow=config.inarow,
+        scorer=incremental_scorer.IncrementalScorer.__name__,
+    )
 
 
 class Agent:
     _game: Optional[connectx_game.ConnectXGame]
-    _scorer: Optional[connectx_solver.ConnectXScorer]
+    _scorer: Optional[gametree.Scorer[connectx_game.ConnectXState]]
     _minimax: Optional[connectx_solver.ConnectXMinimax]
+    _ordering: Optional[ordering.KillerHistoryOrdering[connectx_game.ConnectXState, connectx_game.ConnectXAction]]
+    _scalable: Optional[scalable_search.ScalableSearch]
+    _tactics: Optional[tactics.Tactics]
 
-    def __init__(self, depth: int, outdir: Optional[Path]) -> None:
+    def __init__(
+        self,
+        depth: int,
+        outdir: Optional[Path],
+        cache_capacity: int = 100_000,
+        warm_cache: Optional[Path] = None,
+        timer: Optional[time_manager.TimeManager] = None,
+        value_weights: Optional[Path] = None,
+        tablebase_path: Optional[Path] = None,
+        scalable: bool = False,
+    ) -> None:
+        """
+        timer を渡すと、depth を上限に持ち時間いっぱいまで反復深化する。
+        value_weights (value_model.ValueModel の重み) を渡すと、ConnectXScorer の代わりにそのモデルで葉をまとめて評価する。
+        tablebase_path を渡すと、葉の局面が載っていれば scorer の代わりに読み切った結果を使う (盤面の大きさが合うときだけ)。
+        探索の前に tactics.Tactics で勝ち・塞ぐべき手を判定し、決まらなければ候補手を絞って読む。
+        scalable=True にすると、Minimax の代わりに候補手を絞った scalable_search.ScalableSearch で
+        持ち時間 (timer がなければ actTimeout の半分) まで読む (大きな盤面向け)。
+        このとき depth, outdir, value_weights, tablebase_path は使わない。
+        """
         self._depth = depth
         self._outdir = outdir
+        self._cache_capacity = cache_capacity
+        self._warm_cache = warm_cache
+        self._timer = timer
+        self._value_weights = value_weights
+        self._tablebase = None if tablebase_path is None else tablebase.Tablebase(tablebase_path)
+        self._use_scalable = scalable
 
         self._game = None
         self._scorer = None
         self._minimax = None
+        self._ordering = None
+        self._scalable = None
+        self._tactics = None
+        self._config_key: Optional[tuple[int, int, int]] = None
+        self._last_step: Optional[int] = None
+
+    def _setup(self, config: connectx_game.Config) -> None:
+        """config が変わったときだけ game/scorer/ordering を作り直す (kaggle の config は dataclass ではないので値で比べる)"""
+        config_key = (config.columns, config.rows, config.inarow)
+        if config_key == self._config_key:
+            return
+        self._config_key = config_key
+        self._game = connectx_game.ConnectXGame(config.columns, config.rows, config.inarow)
+        self._tactics = tactics.Tactics(self._game)
+        if self._use_scalable:
+            self._scalable = scalable_search.ScalableSearch(config.columns, config.rows, config.inarow)
+            return
+        self._scalable = None
+        if self._value_weights is not None:
+            self._scorer = value_model.ValueScorer.load(
+                self._value_weights, config.columns, config.rows, config.inarow
+            )
+        else:
+            # 評価値キャッシュは手をまたいで使い回す
+            self._scorer = self._cached_scorer(config)
+        if self._tablebase is not None and self._tablebase.matches(config.columns, config.rows, config.inarow):
+            self._scorer = tablebase.with_tablebase(self._scorer, self._tablebase)
+        # killer/history テーブルも (同じ試合の) 手をまたいで使い回す
+        self._ordering = connectx_solver.killer_history_ordering(config.columns)
+
+    def _new_game(self, config: connectx_game.Config) -> None:
+        """前の試合の killer/history と手の記録を捨てる。評価値キャッシュは局面ごとの値なので残す"""
+        if self._ordering is not None:
+            self._ordering = connectx_solver.killer_history_ordering(config.columns)
+        if self._timer is not None:
+            self._timer.reset()
+
+    def _cached_scorer(self, config: connectx_game.Config) -> scorecache.CachedScorer[connectx_game.ConnectXState]:
+        return scorecache.CachedScorer(
+            incremental_scorer.IncrementalScorer(config.columns, config.rows, config.inarow),
+            key=connectx_game.state_key,
+            capacity=self._cache_capacity,
+            warm_cache=(
+                None if self._warm_cache is None else scorecache.WarmCache(self._warm_cache, eval_cache_meta(config))
+            ),
+        )
 
-    def __call__(self, obs: connectx_game.Observation, config: connectx_game.Config) -> int:
-        grid = np.asarray(obs.board).reshape(config.rows, config.columns)
-        state = connectx_game.ConnectXState(grid, next_player=1, step=obs.step)
+    def warm_up(self, config: connectx_game.Config) -> None:
+        """テーブル類の構築と初期局面での浅い探索を先に済ませ、最初の手で準備の時間を払わないようにする"""
+        self._setup(config)
+        if self._scalable is not None:
+            return
+        assert (self._game is not None) and (self._scorer is not None) and (self._ordering is not None)
+        grid = np.zeros((config.rows, config.columns), dtype=np.int64)
+        state = connectx_game.ConnectXState(grid, next_player=1, step=0)
+        tree = gametree.Tree[connectx_game.ConnectXState, connectx_game.ConnectXResult, connectx_game.ConnectXAction]()
+        connectx_minimax = connectx_solver.ConnectXMinimax(
+            self._game, self._scorer, tree, ordering=self._ordering, pruning=True
+        )
+        connectx_minimax.search(depth=min(2, self._depth), state=state)
+
+    def __call__(
+        self, obs: connectx_game.Observation, config: connectx_game.Config, deadline: Optional[float] = None
+    ) -> int:
+        """
+        deadline (time.perf_counter() の値) を渡すと、持ち時間に関わらずそれまでに探索を打ち切る。
+        最初の反復さえ読み終わらなければ minimax.SearchTimeout を投げる (tree を dump するときは使わない)
+        """
+        # scorer・評価値キャッシュ・tablebase は player (1) から見た値なので、手番側の石を 1 にそろえて読む
+        state = connectx_game.own_view_state(obs, config)
         tree = gametree.Tree[connectx_game.ConnectXState, connectx_game.ConnectXResult, connectx_game.ConnectXAction]()
 
-        if (self._game is None) or (self._scorer is None):
-            self._game = connectx_game.ConnectXGame(config.columns, config.rows, config.inarow)
-            self._scorer = connectx_solver.ConnectXScorer(config.inarow)
+        self._setup(config)
+        if self._last_step is not None and obs.step <= self._last_step:
+            self._new_game(config)
+        self._last_step = obs.step
+        assert self._tactics is not None
+        tactical = self._tactics.analyze(state)
+        if tactical.forced is not None:
+            return tactical.forced
+        if self._scalable is not None:
+            return self._search_large(self._scalable, state, obs, config, tactical.candidates, deadline)
+        assert (self._game is not None) and (self._scorer is not None) and (self._ordering is not None)
+        root_actions = self._tactics.candidate_actions(state, tactical)
+        self._ordering.age()
 
-        connectx_minimax = connectx_solver.ConnectXMinimax(self._game, self._scorer, tree)
-        connectx_minimax(depth=self._depth, state=state)
+        connectx_minimax = connectx_solver.ConnectXMinimax(
+            self._game, self._scorer, tree, ordering=self._ordering, pruning=True
+        )
+        if self._outdir is None:
+            # tree を dump しないなら、tree を作らず in-place に探索する
+            if self._timer is None:
+                _, best_action = connectx_minimax.search(
+                    depth=self._depth, state=state, root_actions=root_actions, deadline=deadline
+                )
+            else:
+                best_action = self._search_in_time(
+                    connectx_minimax, state, root_actions, obs, config, self._timer, deadline
+                )
+            return best_action.col
+        connectx_minimax(depth=self._depth, state=state, root_actions=root_actions)
 
         best_action = tree.get_rational_action(get_rational_score=minimax.get_rational_score)
         self._dump_gametree(tree)
         return best_action.col
 
+    def _search_in_time(
+        self,
+        connectx_minimax: connectx_solver.ConnectXMinimax,
+        state: connectx_game.ConnectXState,
+        root_actions: list[connectx_game.ConnectXAction],
+        obs: connectx_game.Observation,
+        config: connectx_game.Config,
+        timer: time_manager.TimeManager,
+        hard_deadline: Optional[float],
+    ) -> connectx_game.ConnectXAction:
+        """
+        持ち時間が尽きるまで 1 手ずつ深く読み直す。読みかけの反復は deadline で打ち切り、最後に読み切った反復の手を返す。
+        次の反復が持ち時間に収まらないと見込まれるときは、打ち切られるだけの反復を始めない。
+        hard_deadline は最初の反復にも効かせる
+        """
+        start = time.perf_counter()
+        complexity = time_manager.measure_complexity(state, config.inarow)
+        budget = timer.budget(
+            act_timeout=config.actTimeout,
+            remaining_overage=obs.remainingOverageTime,
+            n_cells=config.rows * config.columns,
+            complexity=complexity,
+        )
+        deadline = start + budget if hard_deadline is None else min(start + budget, hard_deadline)
+        best_action: Optional[connectx_game.ConnectXAction] = None
+        last_took: Optional[float] = None
+        for depth in range(1, min(self._depth, complexity.n_empty) + 1):
+            iteration_start = time.perf_counter()
+            try:
+                # 最初の反復は持ち時間では打ち切らない (返す手がなくなるので)。hard_deadline を過ぎれば呼び出し側に任せる
+                _, best_action = connectx_minimax.search(
+                    depth=depth,
+                    state=state,
+                    root_actions=root_actions,
+                    deadline=hard_deadline if best_action is None else deadline,
+                )
+            except minimax.SearchTimeout:
+                if best_action is None:
+                    raise
+                break
+            took = time.perf_counter() - iteration_start
+            # 次の反復は、直前の反復と同じ比率で時間が伸びると見込む
+            growth = complexity.branching if last_took is None or last_took <= 0 else took / last_took
+            last_took = took
+            if time.perf_counter() + took * max(growth, 1.0) > deadline:
+                break
+        assert best_action is not None
+        timer.record(step=obs.step, planned=budget, actual=time.perf_counter() - start)
+        return best_action
+
+    def _search_large(
+        self,
+        scalable: scalable_search.ScalableSearch,
+        state: connectx_game.ConnectXState,
+        obs: connectx_game.Observation,
+        config: connectx_game.Config,
+        root_columns: list[int],
+        deadline: Optional[float],
+    ) -> int:
+        start = time.perf_counter()
+        if self._timer is None:
+            budget = config.actTimeout / 2
+        else:
+            budget = self._timer.budget(
+                act_timeout=config.actTimeout,
+                remaining_overage=obs.remainingOverageTime,
+                n_cells=config.rows * config.columns,
+                complexity=time_manager.measure_complexity(state, config.inarow),
+            )
+        result = scalable.search(
+            state.grid,
+            next_player=state.next_player,
+            time_limit=(start + budget if deadline is None else min(start + budget, deadline)) - time.perf_counter(),
+            root_columns=root_columns,
+        )
+        if self._timer is not None:
+            self._timer.record(step=obs.step, planned=budget, actual=time.perf_counter() - start)
+        return result.col
+
     def _dump_gametree(
         self,
         tree: gametree.Tree[connectx_game.ConnectXState, connectx_game.ConnectXResult, connectx_game.ConnectXAction],
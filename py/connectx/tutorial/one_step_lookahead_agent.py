@@ -4,16 +4,20 @@ import numpy as np
 
 from connectx.tutorial import connectx_game
 from connectx.tutorial import connectx_solver
+from connectx.tutorial import tactics
 
 
 def agent(obs: connectx_game.Observation, config: connectx_game.Config) -> int:
     game = connectx_game.ConnectXGame(config.columns, config.rows, config.inarow)
-    minimax = connectx_solver.ConnectXMinimax(game)
-    grid = np.asarray(obs.board).reshape(config.rows, config.columns)
-    state = connectx_game.ConnectXState(grid, next_player=1)
-    scores, actions = minimax.argminimax(1, state, connectx_solver.ConnectXScorer(config.inarow))
-    shuf = list(range(len(scores)))
-    random.shuffle(shuf)
-    scores = [scores[s] for s in shuf]
-    actions = [actions[s] for s in shuf]
-    return actions[np.argmax(scores)].col
+    # score は player (1) から見た値なので、手番側の石を 1 にそろえる
+    state = connectx_game.own_view_state(obs, config)
+    # 1 手先だけを見るので、勝ち・塞ぐべき手と、直後に相手の勝ちを許す手だけを判定する
+    one_step_tactics = tactics.Tactics(game, attack_depth=1, defense_depth=0)
+    tactical = one_step_tactics.analyze(state)
+    if tactical.forced is not None:
+        return tactical.forced
+    actions = one_step_tactics.candidate_actions(state, tactical)
+    random.shuffle(actions)
+    scorer = connectx_solver.ConnectXScorer(config.inarow)
+    scores = [scorer(game.step(state, action)) for action in actions]
+    return actions[int(np.argmax(scores))].col
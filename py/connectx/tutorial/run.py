@@ -53,7 +53,7 @@ if __name__ == "__main__":
     #     print(html, file=f)
     # get_win_percentages(minimax_agent.Agent(outdir) "random")
 
-    # env.run([mcts_agent.Agent(depth=1, outdir=outdir), "random"])
+    # env.run([mcts_agent.Agent(n_playouts=2000, outdir=outdir, time_limit=1.0), "random"])
     # html = env.render(mode="html")
     # with open(outdir / "a.html", "w") as f:
     #     print(html, file=f)
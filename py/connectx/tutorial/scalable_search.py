@@ -0,0 +1,180 @@
+"""大きな盤面 (12x10 で 5 目並べなど) 用の探索
+
+connectx_game.ConnectXGame と Minimax の組み合わせは全ての合法手を読むので、盤面が大きいと浅い深さでも時間が足りない。
+ここでは bitboard.BitBoard の上で、line potential で絞った候補手だけを読む negamax を持ち時間の中で反復深化する。
+置換表は capacity を超えたら捨てて作り直すので、長く読んでもメモリは一定以上増えない。
+"""
+
+from __future__ import annotations
+
+from typing import Optional, Sequence, Tuple
+import dataclasses
+import time
+
+import numpy as np
+
+from connectx.tutorial import bitboard
+
+# 置換表の値の種類
+EXACT = 0
+LOWER = 1
+UPPER = 2
+
+# (depth, value, flag, best_col, pruned)。pruned はその値を読んだ木のどこかで候補手を絞ったか
+TTEntry = Tuple[int, float, int, int, bool]
+
+# 盤面のマスがこれより多いと、mcts_agent は line potential で候補手を絞る
+LARGE_BOARD_CELLS = 64
+
+
+def is_large_board(columns: int, rows: int) -> bool:
+    return columns * rows > LARGE_BOARD_CELLS
+
+
+class _Timeout(Exception):
+    pass
+
+
+@dataclasses.dataclass
+class SearchResult:
+    col: int
+    score: float  # 手番側から見た評価値
+    depth: int  # 読み切った深さ
+    n_nodes: int
+    proven: bool = False  # 候補手を絞らずに勝ち負けが読み切れたか
+
+
+class ScalableSearch:
+    def __init__(
+        self, columns: int, rows: int, inarow: int, max_candidates: int = 5, tt_capacity: int = 200_000
+    ) -> None:
+        """
+        max_candidates: 各局面で読む候補手の数の上限 (すぐ勝てる手・塞ぐべき手はこれに関わらず読む)
+        tt_capacity: 置換表に保持する局面数の上限
+        """
+        self._bitboard = bitboard.BitBoard(columns, rows, inarow)
+        self._max_candidates = max_candidates
+        self._tt_capacity = tt_capacity
+        self._tt: dict[int, TTEntry] = {}
+        self._n_nodes = 0
+        self._deadline = 0.0
+        self._pruned = False
+
+    def search(
+        self,
+        grid: np.ndarray,
+        next_player: int,
+        time_limit: float,
+        max_depth: Optional[int] = None,
+        root_columns: Optional[Sequence[int]] = None,
+    ) -> SearchResult:
+        """
+        grid の局面で next_player が打つ列を、time_limit 秒まで 1 手ずつ深く読み直して選ぶ (終局していない前提)。
+        時間切れになった反復の結果は捨て、最後に読み切った深さの結果を返す。
+        root_columns を渡すと、root ではその列 (tactics.Tactics の候補手など) だけを読む。
+        候補手を絞って読んだ反復の勝ち負けは、絞られた手で覆るかもしれないので、それで反復深化を止めない
+        """
+        start = time.perf_counter()
+        self._deadline = start + time_limit
+        self._n_nodes = 0
+        current, mask = self._bitboard.from_grid(grid, next_player)
+        n_empty = int(grid.size - np.count_nonzero(grid))
+        if max_depth is None:
+            max_depth = n_empty
+        candidates = self._root_candidates(current, mask, root_columns)
+        result = SearchResult(col=candidates[0], score=0.0, depth=0, n_nodes=0)
+        if len(candidates) == 1:
+            return result
+        for depth in range(1, min(max_depth, n_empty) + 1):
+            self._pruned = len(candidates) < len(self._bitboard.legal_columns(mask))
+            try:
+                score, col = self._root(current, mask, depth, candidates)
+            except _Timeout:
+                break
+            proven = abs(score) >= bitboard.WIN_SCORE and not self._pruned
+            result = SearchResult(col=col, score=score, depth=depth, n_nodes=self._n_nodes, proven=proven)
+            if proven:  # 勝ち負けが読み切れた
+                break
+        result.n_nodes = self._n_nodes
+        return result
+
+    def _root_candidates(self, current: int, mask: int, root_columns: Optional[Sequence[int]]) -> list[int]:
+        if root_columns is None:
+            return self._bitboard.candidates(current, mask, self._max_candidates)
+        n_legal = len(self._bitboard.legal_columns(mask))
+        ranked = [col for col in self._bitboard.candidates(current, mask, n_legal) if col in root_columns]
+        return ranked[: self._max_candidates] if len(ranked) > 0 else list(root_columns)
+
+    def _root(self, current: int, mask: int, depth: int, candidates: list[int]) -> tuple[float, int]:
+        alpha = -float("inf")
+        best_col = -1
+        for col in self._tt_first(current, mask, list(candidates)):
+            score = -self._negamax(current, mask, col, depth - 1, -float("inf"), -alpha)
+            if score > alpha:
+                alpha = score
+                best_col = col
+        self._store(current, mask, depth, alpha, EXACT, best_col)
+        return alpha, best_col
+
+    def _negamax(self, current: int, mask: int, col: int, depth: int, alpha: float, beta: float) -> float:
+        """(current, mask) の手番側が col に打った後の局面を、次の手番側から見て評価する"""
+        self._n_nodes += 1
+        if self._n_nodes % 1024 == 0 and time.perf_counter() > self._deadline:
+            raise _Timeout
+        bb = self._bitboard
+        if bb.is_win(current | bb.move_bit(mask, col)):
+            # 早く勝つ手を好むよう、残りの深さの分だけ勝ちの値を大きくする
+            return -(bitboard.WIN_SCORE + depth)
+        current, mask = bb.play(current, mask, col)
+        if bb.is_full(mask):
+            return 0.0
+        if depth == 0:
+            return bb.evaluate(current, mask)
+
+        key = current + mask
+        entry = self._tt.get(key)
+        if entry is not None and entry[0] >= depth:
+            _, value, flag, _, pruned = entry
+            if flag == EXACT or (flag == LOWER and value >= beta) or (flag == UPPER and value <= alpha):
+                self._pruned = self._pruned or pruned
+                return value
+
+        # この局面より下で候補手を絞ったかを数え直し、置換表に一緒に残す
+        outer_pruned = self._pruned
+        self._pruned = False
+        original_alpha = alpha
+        best = -float("inf")
+        best_col = -1
+        for next_col in self._ordered_candidates(current, mask):
+            score = -self._negamax(current, mask, next_col, depth - 1, -beta, -alpha)
+            if score > best:
+                best = score
+                best_col = next_col
+            if best > alpha:
+                alpha = best
+            if alpha >= beta:
+                break
+        flag = UPPER if best <= original_alpha else LOWER if best >= beta else EXACT
+        self._store(current, mask, depth, best, flag, best_col)
+        self._pruned = self._pruned or outer_pruned
+        return best
+
+    def _ordered_candidates(self, current: int, mask: int) -> list[int]:
+        """候補手を絞った局面があれば _pruned に記録する"""
+        candidates = self._bitboard.candidates(current, mask, self._max_candidates)
+        if len(candidates) == self._max_candidates and len(self._bitboard.legal_columns(mask)) > len(candidates):
+            self._pruned = True
+        return self._tt_first(current, mask, candidates)
+
+    def _tt_first(self, current: int, mask: int, candidates: list[int]) -> list[int]:
+        """置換表に前回の最善手があれば先頭に回す"""
+        entry = self._tt.get(current + mask)
+        if entry is not None and entry[3] in candidates:
+            candidates.remove(entry[3])
+            candidates.insert(0, entry[3])
+        return candidates
+
+    def _store(self, current: int, mask: int, depth: int, value: float, flag: int, col: int) -> None:
+        if len(self._tt) >= self._tt_capacity:
+            self._tt.clear()
+        self._tt[current + mask] = (depth, value, flag, col, self._pruned)
@@ -0,0 +1,175 @@
+"""探索の node 数と選んだ手の回帰テスト
+
+種を固定したランダムな対局から取った局面集を、乱数の種を固定した各 solver で読み、
+選んだ手・作った node の数・葉の評価回数 (gametree.SearchStats) を JSON に記録する。
+check は記録 (baseline) と比べて違いを全て表示し、1 つでもあれば終了コード 1 で終わる。
+速度改善の前後で探索の中身が変わっていないことを確かめるのに使う。所要時間は表示するだけで比べない。
+
+usage:
+  python -m connectx.tutorial.search_regression record <baseline.json>
+  python -m connectx.tutorial.search_regression check <baseline.json>
+"""
+
+from __future__ import annotations
+
+from pathlib import Path
+from typing import Any, Callable, Tuple
+import json
+import random
+import sys
+import time
+
+import click
+import numpy as np
+
+from connectx.gamesolver import gametree, minimax
+from connectx.tutorial import connectx_game, connectx_solver, incremental_scorer
+
+COLUMNS, ROWS, INAROW = 7, 6, 4
+CORPUS_SIZE = 24
+CORPUS_SEED = 0
+SEARCH_SEED = 0
+
+# 1 局面を読んで (選んだ列, SearchStats) を返す
+Solver = Callable[[connectx_game.ConnectXGame, connectx_game.ConnectXState], Tuple[int, gametree.SearchStats]]
+
+
+def make_corpus(n_positions: int, seed: int) -> list[connectx_game.ConnectXState]:
+    """ランダムに 4 から 24 手打った、終局していない局面"""
+    rng = random.Random(seed)
+    connectx = connectx_game.ConnectXGame(COLUMNS, ROWS, INAROW)
+    corpus: list[connectx_game.ConnectXState] = []
+    while len(corpus) < n_positions:
+        state = connectx_game.ConnectXState(np.zeros((ROWS, COLUMNS), dtype=np.int64), next_player=1, step=0)
+        for _ in range(rng.randint(4, 24)):
+            state = connectx.step(state, rng.choice(connectx.get_available_actions(state)))
+            if connectx.get_result(state) is not None:
+                break
+        else:
+            corpus.append(state)
+    return corpus
+
+
+def minimax_search(
+    connectx: connectx_game.ConnectXGame, state: connectx_game.ConnectXState
+) -> tuple[int, gametree.SearchStats]:
+    """agent と同じ、tree を作らない alpha-beta (killer/history ordering, IncrementalScorer)"""
+    tree = gametree.Tree[connectx_game.ConnectXState, connectx_game.ConnectXResult, connectx_game.ConnectXAction]()
+    solver = connectx_solver.ConnectXMinimax(
+        connectx,
+        incremental_scorer.IncrementalScorer(COLUMNS, ROWS, INAROW),
+        tree,
+        ordering=connectx_solver.killer_history_ordering(COLUMNS),
+        pruning=True,
+    )
+    _, action = solver.search(depth=5, state=state)
+    return action.col, solver.stats
+
+
+def minimax_tree(
+    connectx: connectx_game.ConnectXGame, state: connectx_game.ConnectXState
+) -> tuple[int, gametree.SearchStats]:
+    """tree を作る Minimax。同点の手は種を固定した rng で選ぶ"""
+    tree = gametree.Tree[connectx_game.ConnectXState, connectx_game.ConnectXResult, connectx_game.ConnectXAction](
+        rng=random.Random(SEARCH_SEED)
+    )
+    solver = connectx_solver.ConnectXMinimax(
+        connectx, connectx_solver.ConnectXScorer(INAROW), tree, ordering=None, pruning=True
+    )
+    solver(depth=3, state=state)
+    return tree.get_rational_action(get_rational_score=minimax.get_rational_score).col, solver.stats
+
+
+def mcts_search(
+    connectx: connectx_game.ConnectXGame, state: connectx_game.ConnectXState
+) -> tuple[int, gametree.SearchStats]:
+    """playout 回数だけで打ち切る (time_limit を使わない) MCTS"""
+    solver = connectx_solver.ConnectXMCTS(connectx, rng=random.Random(SEARCH_SEED))
+    solver.search(state, max_playouts=500)
+    progress = solver.current_progress()
+    assert progress is not None
+    return progress.action.col, solver.stats
+
+
+SOLVERS: dict[str, Solver] = {
+    "minimax": minimax_search,
+    "minimax_tree": minimax_tree,
+    "mcts": mcts_search,
+}
+
+
+def run() -> dict[str, Any]:
+    connectx = connectx_game.ConnectXGame(COLUMNS, ROWS, INAROW)
+    corpus = make_corpus(CORPUS_SIZE, CORPUS_SEED)
+    positions: list[dict[str, Any]] = [
+        dict(board="".join(str(x) for x in state.grid.ravel()), next_player=state.next_player, results={})
+        for state in corpus
+    ]
+    for name, solver in SOLVERS.items():
+        start = time.perf_counter()
+        for position, state in zip(positions, corpus):
+            col, stats = solver(connectx, state)
+            position["results"][name] = dict(
+                col=col, n_nodes=stats.n_nodes, n_leaf_evaluations=stats.n_leaf_evaluations
+            )
+        print(f"{name}: {time.perf_counter() - start:.3f}s for {len(corpus)} positions")
+    return dict(
+        board=dict(columns=COLUMNS, rows=ROWS, inarow=INAROW),
+        corpus=dict(size=CORPUS_SIZE, seed=CORPUS_SEED),
+        search_seed=SEARCH_SEED,
+        positions=positions,
+    )
+
+
+def compare(baseline: dict[str, Any], current: dict[str, Any]) -> list[str]:
+    """違いを 1 行ずつ返す"""
+    if {key: baseline[key] for key in ("board", "corpus", "search_seed")} != {
+        key: current[key] for key in ("board", "corpus", "search_seed")
+    }:
+        return ["the corpus or the seeds differ from the baseline; record a new baseline"]
+    diffs = []
+    for i, (expected, actual) in enumerate(zip(baseline["positions"], current["positions"])):
+        if expected["board"] != actual["board"]:
+            diffs.append(f"position {i}: the corpus differs from the baseline")
+            continue
+        for name in sorted(set(expected["results"]) | set(actual["results"])):
+            before = expected["results"].get(name)
+            after = actual["results"].get(name)
+            if before is None or after is None:
+                diffs.append(f"position {i} {name}: {'added' if before is None else 'removed'}")
+                continue
+            changes = [f"{key} {before[key]} -> {after[key]}" for key in before if before[key] != after.get(key)]
+            if len(changes) > 0:
+                diffs.append(f"position {i} {name}: " + ", ".join(changes))
+    return diffs
+
+
+@click.group()
+def main() -> None:
+    pass
+
+
+@main.command()
+@click.argument("baseline", type=click.Path(dir_okay=False, path_type=Path))
+def record(baseline: Path) -> None:
+    with open(baseline, "w") as f:
+        json.dump(run(), f, indent=1)
+    print(f"wrote {baseline}")
+
+
+@main.command()
+@click.argument("baseline", type=click.Path(exists=True, dir_okay=False, path_type=Path))
+def check(baseline: Path) -> None:
+    with open(baseline) as f:
+        expected = json.load(f)
+    diffs = compare(expected, run())
+    for diff in diffs:
+        print(diff)
+    if len(diffs) > 0:
+        print(f"{len(diffs)} differences from {baseline}")
+        sys.exit(1)
+    print(f"no differences from {baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""空きマスが少ない局面の勝敗 (完全読みの結果) を引く endgame tablebase
+
+ファイルは key (uint64) の昇順に並べた (key, value) の structured array の .npy で、memory-map したまま二分探索で引く。
+key は左右反転を同一視した盤面と手番から作り、value は player (1) から見た勝敗 (1: 勝ち, 0: 引き分け, -1: 負け)。
+同じ名前で拡張子が .json のファイルに、盤面の大きさと収録した空きマスの数の上限を書いておく。
+生成は connectx.training.make_tablebase で行う。
+"""
+
+from __future__ import annotations
+
+from collections.abc import Sequence
+from pathlib import Path
+from typing import Optional
+import json
+
+import numpy as np
+
+from connectx.gamesolver import gametree
+from connectx.tutorial import connectx_game
+
+TABLE_DTYPE = np.dtype([("key", "<u8"), ("value", "i1")])
+
+
+def check_board_size(columns: int, rows: int) -> None:
+    if columns * (rows + 1) + 1 > 64:
+        raise ValueError(f"a {rows}x{columns} board does not fit in a 64-bit tablebase key")
+
+
+def tablebase_key(grid: np.ndarray, next_player: int) -> int:
+    return (connectx_game.canonical_key(grid) << 1) | (1 if next_player == 2 else 0)
+
+
+def count_empty(grid: np.ndarray) -> int:
+    return int(grid.size - np.count_nonzero(grid))
+
+
+def solve(
+    state: connectx_game.ConnectXSearchState,
+    inarow: int,
+    memo: dict[int, int],
+    solved: Optional[dict[int, int]] = None,
+) -> int:
+    """
+    state (終局していない前提) を最後まで読み、player から見た勝敗を返す。
+    読んだ局面の結果は全て memo (tablebase_key -> 勝敗) に入る。solved を渡すと、memo になかった局面だけをそこにも入れる。
+    手番側の勝ちが見つかればそれ以上は読まない
+    """
+    key = tablebase_key(state.grid, state.next_player)
+    value = memo.get(key)
+    if value is not None:
+        return value
+    mover = state.next_player
+    win = 1 if mover == 1 else -1
+    best: Optional[int] = None
+    legal_mask = state.legal_mask
+    col = 0
+    while legal_mask >> col:
+        if (legal_mask >> col) & 1:
+            state.play(col)
+            row, _ = state.moves[-1]
+            if connectx_game.is_winning_move(state.grid, row, col, inarow):
+                value = win
+            elif state.legal_mask == 0:  # draw
+                value = 0
+            else:
+                value = solve(state, inarow, memo, solved)
+            state.undo()
+            if best is None or (value > best if mover == 1 else value < best):
+                best = value
+            if best == win:
+                break
+        col += 1
+    assert best is not None
+    memo[key] = best
+    if solved is not None:
+        solved[key] = best
+    return best
+
+
+def save(path: Path, memo: dict[int, int], columns: int, rows: int, inarow: int, max_empty: int) -> None:
+    table = np.zeros(len(memo), dtype=TABLE_DTYPE)
+    table["key"] = sorted(memo)
+    table["value"] = [memo[int(key)] for key in table["key"]]
+    with open(path, "wb") as f:
+        np.save(f, table)
+    with open(path.with_suffix(".json"), "w") as f:
+        json.dump(dict(columns=columns, rows=rows, inarow=inarow, max_empty=max_empty, size=len(memo)), f)
+
+
+class Tablebase:
+    def __init__(self, path: Path) -> None:
+        table = np.load(path, mmap_mode="r")
+        if table.dtype != TABLE_DTYPE:
+            raise ValueError(f"{path} is not a tablebase file")
+        with open(path.with_suffix(".json")) as f:
+            meta = json.load(f)
+        self.columns: int = meta["columns"]
+        self.rows: int = meta["rows"]
+        self.inarow: int = meta["inarow"]
+        self.max_empty: int = meta["max_empty"]
+        self._keys = table["key"]
+        self._values = table["value"]
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def matches(self, columns: int, rows: int, inarow: int) -> bool:
+        return (self.columns, self.rows, self.inarow) == (columns, rows, inarow)
+
+    def probe(self, grid: np.ndarray, next_player: int) -> Optional[int]:
+        """収録されていれば player から見た勝敗 (1/0/-1) を、なければ None を返す"""
+        if count_empty(grid) > self.max_empty or len(self._keys) == 0:
+            return None
+        key = tablebase_key(grid, next_player)
+        idx = int(np.searchsorted(self._keys, np.uint64(key)))
+        if idx < len(self._keys) and int(self._keys[idx]) == key:
+            return int(self._values[idx])
+        return None
+
+    def probe_state(self, state: connectx_game.ConnectXState) -> Optional[float]:
+        """MCTS の oracle 用。player から見た勝率 (1.0/0.5/0.0) に直して返す"""
+        value = self.probe(state.grid, state.next_player)
+        return None if value is None else (value + 1) / 2
+
+
+class TablebaseScorer(gametree.Scorer[connectx_game.ConnectXState]):
+    """
+    tablebase に載っている局面は読み切った結果を、載っていなければ scorer の値を返す。
+    勝ち負けには scorer の win_score/loss_score (引き分けは 0) を使うので、scorer の値と同じ尺度になる。
+    scorer が score_batch を持つなら、with_tablebase で作ればそれも引き継ぐ
+    """
+
+    def __init__(self, scorer: gametree.Scorer[connectx_game.ConnectXState], tablebase: Tablebase) -> None:
+        self._scorer = scorer
+        self._tablebase = tablebase
+        self.win_score = scorer.win_score
+        self.loss_score = scorer.loss_score
+        self._scores = {1: scorer.win_score, 0: 0.0, -1: scorer.loss_score}
+        self.n_probe_hits = 0
+
+    def __call__(self, state: connectx_game.ConnectXState) -> float:
+        score = self.probe(state)
+        return self._scorer(state) if score is None else score
+
+    def probe(self, state: connectx_game.ConnectXState) -> Optional[float]:
+        """tablebase に載っていれば、その結果を scorer の尺度に直した score を返す"""
+        value = self._tablebase.probe(state.grid, state.next_player)
+        if value is None:
+            return None
+        self.n_probe_hits += 1
+        return self._scores[value]
+
+
+class BatchTablebaseScorer(TablebaseScorer, gametree.BatchScorer[connectx_game.ConnectXState]):
+    """score_batch を持つ scorer 用の TablebaseScorer。tablebase に載っていない局面だけをまとめて scorer に渡す"""
+
+    def __init__(self, scorer: gametree.BatchScorer[connectx_game.ConnectXState], tablebase: Tablebase) -> None:
+        super().__init__(scorer, tablebase)
+        self._batch_scorer = scorer
+
+    def score_batch(self, states: Sequence[connectx_game.ConnectXState]) -> list[float]:
+        probed = [self.probe(state) for state in states]
+        missing = [i for i, score in enumerate(probed) if score is None]
+        scores = dict(zip(missing, self._batch_scorer.score_batch([states[i] for i in missing])))
+        return [scores[i] if score is None else score for i, score in enumerate(probed)]
+
+
+def with_tablebase(
+    scorer: gametree.Scorer[connectx_game.ConnectXState], tablebase: Tablebase
+) -> TablebaseScorer:
+    """scorer が BatchScorer なら、Minimax が葉をまとめて評価できるよう BatchTablebaseScorer で包む"""
+    if isinstance(scorer, gametree.BatchScorer):
+        return BatchTablebaseScorer(scorer, tablebase)
+    return TablebaseScorer(scorer, tablebase)
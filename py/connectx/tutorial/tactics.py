@@ -0,0 +1,122 @@
+"""探索の前に行う、安い戦術判定
+
+- すぐ勝てる列があればそこに打つ
+- 相手がすぐ勝てる列があれば塞ぐ (2 つ以上あれば負けが決まっているので、どれか 1 つを塞ぐ)
+- 自分の手で相手に勝ちを許す手 (直上のマスで相手が勝つ手など) は候補から外す
+- 1 手ごとに threat (次に打てば勝てるマス) を作り、相手に塞がせ続けて二重の threat に持ち込める手順を数手先まで探す
+- 相手にそれを許す手も、他に手があれば候補から外す
+
+手が決まればそれを返し、決まらなければ Minimax/MCTS の root で読む候補手を返す。
+"""
+
+from __future__ import annotations
+
+from typing import Optional
+import dataclasses
+
+from connectx.tutorial import connectx_game
+
+
+@dataclasses.dataclass
+class TacticalResult:
+    forced: Optional[int]  # 探索せずに打つ列。決まらなければ None
+    candidates: list[int]  # root で読む列 (forced があれば [forced])
+    reason: str  # "win", "block", "forced_win", "only_safe" (他の手は全て負ける) または "" (決まらなかった)
+
+
+class Tactics:
+    def __init__(self, game: connectx_game.ConnectXGame, attack_depth: int = 3, defense_depth: int = 2) -> None:
+        """
+        attack_depth: 自分の二重 threat を探す深さ (threat を作る自分の手の数)
+        defense_depth: 候補手ごとに、相手の二重 threat を探す深さ。0 なら相手の直後の勝ちだけを見る
+        """
+        self._game = game
+        self._attack_depth = attack_depth
+        self._defense_depth = defense_depth
+
+    def analyze(self, state: connectx_game.ConnectXState) -> TacticalResult:
+        """state は終局していない前提"""
+        search_state = self._game.to_search_state(state)
+        me = search_state.next_player
+        opponent = 2 if me == 1 else 1
+        legal = self._legal_columns(search_state)
+
+        wins = self.winning_columns(search_state, me)
+        if len(wins) > 0:
+            return TacticalResult(forced=wins[0], candidates=[wins[0]], reason="win")
+        threats = self.winning_columns(search_state, opponent)
+        if len(threats) > 0:
+            return TacticalResult(forced=threats[0], candidates=[threats[0]], reason="block")
+
+        forced_win = self.find_forced_win(search_state, self._attack_depth)
+        if forced_win is not None:
+            return TacticalResult(forced=forced_win, candidates=[forced_win], reason="forced_win")
+
+        safe = [col for col in legal if not self._gives_win(search_state, col, self._defense_depth)]
+        if len(safe) == 0:  # どの手でも負けるなら、全ての手を読ませる
+            safe = legal
+        if len(safe) == 1:
+            return TacticalResult(forced=safe[0], candidates=safe, reason="only_safe")
+        return TacticalResult(forced=None, candidates=safe, reason="")
+
+    def candidate_actions(
+        self, state: connectx_game.ConnectXState, result: TacticalResult
+    ) -> list[connectx_game.ConnectXAction]:
+        """result.candidates を Minimax/MCTS の root_actions に渡せる形に直す"""
+        return [action for action in self._game.get_available_actions(state) if action.col in result.candidates]
+
+    def winning_columns(self, state: connectx_game.ConnectXSearchState, mark: int) -> list[int]:
+        """mark の石を置けば inarow 個並ぶ列 (手番に関わらず調べる)"""
+        grid = state.grid
+        wins = []
+        for col in self._legal_columns(state):
+            row = self._game.rows - 1 - state.heights[col]
+            grid[row, col] = mark
+            if connectx_game.is_winning_move(grid, row, col, self._game.inarow):
+                wins.append(col)
+            grid[row, col] = 0
+        return wins
+
+    def find_forced_win(self, state: connectx_game.ConnectXSearchState, depth: int) -> Optional[int]:
+        """
+        手番側が threat を作り続けて (相手は毎回それを塞ぐしかない)、depth 手以内に二重の threat に持ち込める最初の手。
+        state は手番側がすぐには勝てない前提 (相手がすぐ勝てる局面では、それを塞ぎつつ threat を作る手だけが残る)
+        """
+        if depth <= 0:
+            return None
+        me = state.next_player
+        opponent = 2 if me == 1 else 1
+        for col in self._legal_columns(state):
+            state.play(col)
+            try:
+                if len(self.winning_columns(state, opponent)) > 0:
+                    continue  # 相手が先に勝つ
+                threats = self.winning_columns(state, me)
+                if len(threats) >= 2:
+                    return col
+                if len(threats) == 1 and depth > 1:
+                    # 相手は塞ぐしかない。塞いだ後も相手に勝ちがなければ続ける
+                    state.play(threats[0])
+                    try:
+                        if len(self.winning_columns(state, me)) > 0:
+                            return col  # 塞いだマスの直上で勝てる
+                        if self.find_forced_win(state, depth - 1) is not None:
+                            return col
+                    finally:
+                        state.undo()
+            finally:
+                state.undo()
+        return None
+
+    def _gives_win(self, state: connectx_game.ConnectXSearchState, col: int, depth: int) -> bool:
+        """col に打つと、相手がすぐ勝てる、または相手に depth 手以内の二重 threat を許す"""
+        state.play(col)
+        try:
+            if len(self.winning_columns(state, state.next_player)) > 0:
+                return True
+            return self.find_forced_win(state, depth) is not None
+        finally:
+            state.undo()
+
+    def _legal_columns(self, state: connectx_game.ConnectXSearchState) -> list[int]:
+        return [col for col in range(self._game.columns) if state.heights[col] < self._game.rows]
@@ -0,0 +1,78 @@
+"""1 試合を通した持ち時間 (actTimeout + remainingOverageTime) の配分を決める"""
+
+from __future__ import annotations
+
+from collections import deque
+from typing import Optional
+import dataclasses
+import math
+
+from connectx.tutorial import connectx_game, incremental_scorer
+
+
+@dataclasses.dataclass
+class Complexity:
+    n_empty: int  # 空きマスの数
+    branching: int  # 合法手の数
+    max_branching: int  # 列の数
+    n_threats: int  # 両者の threat (あと 1 石で揃うマス) の数
+
+
+@dataclasses.dataclass
+class MoveTiming:
+    step: int
+    planned: float
+    actual: float
+
+
+def measure_complexity(state: connectx_game.ConnectXState, inarow: int) -> Complexity:
+    rows, columns = state.grid.shape
+    scorer = incremental_scorer.IncrementalScorer(columns, rows, inarow)
+    scorer.reset(state.grid)
+    threats = scorer.threats()
+    return Complexity(
+        n_empty=int((state.grid == 0).sum()),
+        branching=bin(state.legal_mask).count("1"),
+        max_branching=columns,
+        n_threats=sum(threats.odd.values()) + sum(threats.even.values()),
+    )
+
+
+class TimeManager:
+    """
+    1 手あたりの持ち時間 = (actTimeout - safety_margin) + 残りの overage を残りの手数で割ったもの x 局面の重み。
+    重みは中盤 (盤面が半分埋まったあたり) で最大になり、合法手や threat が多い局面ほど大きくする。
+    1 手で使う overage は、残りの overage を残りの手数で等分した量の max_overage_share 倍までに抑える
+    (1 手で使い込んで、残りの手が actTimeout だけで打つことにならないように)。
+    record した手の記録は直近の max_history 手分だけ残す (None なら全て)。
+    """
+
+    def __init__(
+        self, safety_margin: float = 0.5, max_overage_share: float = 2.0, max_history: Optional[int] = None
+    ) -> None:
+        self._safety_margin = safety_margin
+        self._max_overage_share = max_overage_share
+        self._history: deque[MoveTiming] = deque(maxlen=max_history)
+
+    @property
+    def history(self) -> list[MoveTiming]:
+        return list(self._history)
+
+    def budget(self, act_timeout: float, remaining_overage: float, n_cells: int, complexity: Complexity) -> float:
+        base = max(act_timeout - self._safety_margin, 0.0)
+        n_my_moves_left = max((complexity.n_empty + 1) // 2, 1)
+        filled = 1.0 - complexity.n_empty / n_cells
+        phase_weight = 0.5 + math.sin(math.pi * filled)
+        complexity_weight = (0.5 + complexity.branching / complexity.max_branching) * (
+            1.0 + 0.25 * min(complexity.n_threats, 4)
+        )
+        share = max(remaining_overage, 0.0) / n_my_moves_left
+        overage = min(share * phase_weight * complexity_weight, share * self._max_overage_share)
+        return base + overage
+
+    def record(self, step: int, planned: float, actual: float) -> None:
+        self._history.append(MoveTiming(step=step, planned=planned, actual=actual))
+
+    def reset(self) -> None:
+        """試合が変わったときに、前の試合の手の記録を捨てる"""
+        self._history.clear()
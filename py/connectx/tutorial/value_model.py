@@ -0,0 +1,132 @@
+"""NumPy だけで評価できる小さな価値関数 (MLP) と、それを探索の葉の評価に使う scorer
+
+入力は両者の石の位置 (2 x rows x columns の 0/1) と手番 (player の手番なら 1)。
+出力は player (1) から見た勝ち負けの見積もりで、tanh で [-1, 1] に収める。
+重みは connectx.training.train_value が書き出す .npz (W0, b0, W1, b1, ...) を読み込む。
+"""
+
+from __future__ import annotations
+
+from collections.abc import Sequence
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from connectx.gamesolver import gametree
+from connectx.tutorial import connectx_game
+
+_MAX_ESTIMATE = 0.999
+
+
+def features(grids: np.ndarray, next_players: np.ndarray) -> np.ndarray:
+    """(N, rows, columns) の盤面と (N,) の手番から、(N, 2 * rows * columns + 1) の入力を作る"""
+    n_grids = grids.shape[0]
+    return np.concatenate(
+        [
+            (grids == 1).reshape(n_grids, -1),
+            (grids == 2).reshape(n_grids, -1),
+            (np.asarray(next_players) == 1).reshape(n_grids, 1),
+        ],
+        axis=1,
+    ).astype(np.float32)
+
+
+class ValueModel:
+    """隠れ層が ReLU、出力層が tanh の全結合ネットワーク"""
+
+    def __init__(self, weights: Sequence[np.ndarray], biases: Sequence[np.ndarray]) -> None:
+        if len(weights) != len(biases) or len(weights) == 0:
+            raise ValueError("weights and biases must be non-empty and of the same length")
+        for w, b, next_w in zip(weights, biases, list(weights[1:]) + [None]):
+            if w.ndim != 2 or b.shape != (w.shape[1],) or (next_w is not None and next_w.shape[0] != w.shape[1]):
+                raise ValueError("inconsistent layer shapes")
+        if weights[-1].shape[1] != 1:
+            raise ValueError("the last layer must have a single output")
+        self.weights = [np.asarray(w, dtype=np.float32) for w in weights]
+        self.biases = [np.asarray(b, dtype=np.float32) for b in biases]
+
+    @property
+    def n_inputs(self) -> int:
+        return int(self.weights[0].shape[0])
+
+    @classmethod
+    def random(cls, layer_sizes: Sequence[int], seed: Optional[int] = None) -> ValueModel:
+        """He 初期化した重みで作る。layer_sizes は入力から出力 (1) までの各層の幅"""
+        rng = np.random.default_rng(seed)
+        weights = [
+            rng.normal(0.0, np.sqrt(2.0 / n_in), size=(n_in, n_out)).astype(np.float32)
+            for n_in, n_out in zip(layer_sizes[:-1], layer_sizes[1:])
+        ]
+        biases = [np.zeros(n_out, dtype=np.float32) for n_out in layer_sizes[1:]]
+        return cls(weights, biases)
+
+    @classmethod
+    def load(cls, path: Path) -> ValueModel:
+        with np.load(path) as f:
+            n_layers = len([key for key in f.files if key.startswith("W")])
+            weights = [f[f"W{i}"] for i in range(n_layers)]
+            biases = [f[f"b{i}"] for i in range(n_layers)]
+        return cls(weights, biases)
+
+    def save(self, path: Path) -> None:
+        arrays = {f"W{i}": w for i, w in enumerate(self.weights)}
+        arrays.update({f"b{i}": b for i, b in enumerate(self.biases)})
+        with open(path, "wb") as f:
+            np.savez(f, **arrays)  # type: ignore
+
+    def forward(self, x: np.ndarray) -> list[np.ndarray]:
+        """各層の出力 (活性化後) を返す。最後の要素が (N, 1) の予測値"""
+        activations = [x]
+        for i, (w, b) in enumerate(zip(self.weights, self.biases)):
+            z = activations[-1] @ w + b
+            activations.append(np.tanh(z) if i == len(self.weights) - 1 else np.maximum(z, 0.0))
+        return activations
+
+    def predict(self, x: np.ndarray) -> np.ndarray:
+        prediction: np.ndarray = self.forward(x)[-1][:, 0]
+        return prediction
+
+
+class ValueScorer(gametree.BatchScorer[connectx_game.ConnectXState]):
+    """
+    ValueModel で局面を評価する scorer。score_batch に渡された局面を batch_size 件ずつ 1 回の行列演算で評価する。
+    終局した局面はモデルを通さず、player の勝ちを 1、負けを -1、引き分けを 0 とする。
+    """
+
+    def __init__(self, model: ValueModel, columns: int, rows: int, inarow: int, batch_size: int = 256) -> None:
+        if model.n_inputs != 2 * rows * columns + 1:
+            raise ValueError(f"the model expects {model.n_inputs} inputs, which does not fit a {rows}x{columns} board")
+        if batch_size <= 0:
+            raise ValueError("batch_size must be positive")
+        self.model = model
+        self.inarow = inarow
+        self.batch_size = batch_size
+
+    @classmethod
+    def load(cls, path: Path, columns: int, rows: int, inarow: int, batch_size: int = 256) -> ValueScorer:
+        return cls(ValueModel.load(path), columns, rows, inarow, batch_size)
+
+    def score_batch(self, states: Sequence[connectx_game.ConnectXState]) -> list[float]:
+        scores: list[float] = []
+        for start in range(0, len(states), self.batch_size):
+            chunk = states[start : start + self.batch_size]
+            grids = np.stack([state.grid for state in chunk])
+            next_players = np.array([state.next_player for state in chunk])
+            scores.extend(self.score_grids(grids, next_players).tolist())
+        return scores
+
+    def score_grids(self, grids: np.ndarray, next_players: np.ndarray) -> np.ndarray:
+        windows = connectx_game.get_windows_batch(grids, self.inarow)
+        player_won = (windows == 1).all(axis=-1).any(axis=-1)
+        opponent_won = (windows == 2).all(axis=-1).any(axis=-1)
+        full = (grids[:, 0] != 0).all(axis=-1)
+        scores = np.zeros(len(grids), dtype=np.float64)
+        scores[player_won] = 1.0
+        scores[opponent_won] = -1.0
+        ongoing = ~(player_won | opponent_won | full)
+        if ongoing.any():
+            # 見積もりが実際の勝ち負けと同点にならないようにして、勝てる手を先延ばしにしないようにする
+            prediction = self.model.predict(features(grids[ongoing], next_players[ongoing]))
+            scores[ongoing] = np.clip(prediction, -_MAX_ESTIMATE, _MAX_ESTIMATE)
+        return scores